@@ -0,0 +1 @@
+"""Microbenchmarks of the hot protocol paths, see `python -m benchmarks -h`."""
@@ -0,0 +1,7 @@
+from .environment import setup_settings
+
+setup_settings()
+
+from .runner import main # pylint:disable=wrong-import-position
+
+main()
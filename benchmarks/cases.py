@@ -0,0 +1,215 @@
+"""Benchmark cases.
+
+Every case is a setup function registered with `case`, it receives the event
+loop and returns the operation to measure, a callable without arguments.
+"""
+
+import asyncio
+
+from chatangobot.core.bus import FRAME, FRAME_REQUEST, decode, pack_frame
+from chatangobot.core.manager import Manager
+from chatangobot.core.recorder import FakeTransport
+from chatangobot.core.room import Room
+from chatangobot.core.settings import conf
+
+from .environment import drain, run_sync
+
+CASES = []
+
+ROOM_NAME = 'benchroom'
+MESSAGE_HTML = '<n000/><f x11000="0">hello &lt;world&gt; <b>bold</b> text'
+
+
+def case(name):
+    def register(setup):
+        CASES.append((name, setup))
+        return setup
+    return register
+
+
+class BenchManager(Manager):
+    """Manager that drops events, to measure parsing alone."""
+
+    def dispatch_event(self, channel, name, *args, **kwargs):
+        pass
+
+
+def create_room(loop, manager_class=BenchManager):
+    mgr = manager_class(loop=loop, pm=False)
+    drain(loop)
+
+    room = mgr.room_class(name=ROOM_NAME, loop=loop, mgr=mgr)
+    mgr.rooms[ROOM_NAME] = room
+    room.connected = True
+    room._conn = FakeTransport() # pylint:disable=protected-access
+    room.owner = mgr.user_class.create('owner')
+    room.mods.add(mgr.user)
+    return room
+
+
+def b_args(index, name='user'):
+    return ['1500000000.%i' % index, '%s%i' % (name, index % 100), '',
+            '12345678', 'unid%i' % (index % 100), str(index),
+            '10.0.0.%i' % (index % 250), '', '', MESSAGE_HTML]
+
+
+def fill_history(room, count=None):
+    if count is None:
+        count = conf['history']['size']
+    for index in range(count):
+        run_sync(room._rcmd_b(b_args(index))) # pylint:disable=protected-access
+        run_sync(room._rcmd_u([str(index), 'msg%i' % index])) # pylint:disable=protected-access
+
+
+@case('data_received')
+def data_received(loop):
+    room = create_room(loop)
+    frames = b''.join(('n:%x\r\n\x00' % index).encode('ascii')\
+            for index in range(50))
+
+    def op():
+        room.data_received(frames)
+        drain(loop)
+    return op
+
+
+@case('_process')
+def process(loop):
+    room = create_room(loop)
+
+    def op():
+        run_sync(room._process('n:1f')) # pylint:disable=protected-access
+    return op
+
+
+@case('_rcmd_b+_rcmd_u')
+def rcmd_b_u(loop):
+    room = create_room(loop)
+    args = b_args(1)
+    state = {'index': 0}
+
+    def op():
+        state['index'] += 1
+        index = str(state['index'])
+        args[5] = index
+        run_sync(room._rcmd_b(args)) # pylint:disable=protected-access
+        run_sync(room._rcmd_u([index, 'msg' + index])) # pylint:disable=protected-access
+    return op
+
+
+@case('clean_message')
+def clean_message(loop):
+    room = create_room(loop)
+
+    def op():
+        room.clean_message(MESSAGE_HTML)
+    return op
+
+
+@case('_parseFont')
+def parse_font(loop):
+    def op():
+        Room._parseFont(' x11000="0"') # pylint:disable=protected-access
+    return op
+
+
+@case('_getAnonId')
+def get_anon_id(loop):
+    def op():
+        Room._getAnonId('5504', '12345678') # pylint:disable=protected-access
+    return op
+
+
+@case('get_room_host')
+def get_room_host(loop):
+    room = create_room(loop)
+
+    def op():
+        room.mgr.get_room_host('somerandomroom')
+    return op
+
+
+@case('_addHistory')
+def add_history(loop):
+    room = create_room(loop)
+    fill_history(room)
+    msg = room._history[-1] # pylint:disable=protected-access
+
+    def op():
+        room._addHistory(msg) # pylint:disable=protected-access
+    return op
+
+
+@case('getLastMessage')
+def get_last_message(loop):
+    room = create_room(loop)
+    fill_history(room)
+    # worst case, not in history
+    user = room.user_class.create('absentuser')
+
+    def op():
+        room.getLastMessage(user)
+    return op
+
+
+@case('findUser')
+def find_user(loop):
+    room = create_room(loop)
+    for index in range(200):
+        room._userlist.append(room.user_class.create('user%i' % index)) # pylint:disable=protected-access
+
+    def op():
+        room.findUser('user150')
+    return op
+
+
+@case('_rcmd_blocklist(500)')
+def rcmd_blocklist(loop):
+    room = create_room(loop)
+    args = ';'.join('unid%i:10.0.%i.%i:banned%i:1500000000.%i:mod'\
+            % (index, index // 250, index % 250, index, index)\
+            for index in range(500)).split(':')
+
+    def op():
+        run_sync(room._rcmd_blocklist(args)) # pylint:disable=protected-access
+    return op
+
+
+@case('Room.message')
+def room_message(loop):
+    room = create_room(loop)
+    transport = room._conn # pylint:disable=protected-access
+
+    def op():
+        run_sync(room.message('hello <world>\nsecond line ~ tilde'))
+        del transport.written[:]
+    return op
+
+
+@case('dispatch_event')
+def dispatch_event(loop):
+    room = create_room(loop, manager_class=Manager)
+
+    def op():
+        room._call_event('onUserCountChange') # pylint:disable=protected-access
+        drain(loop)
+    return op
+
+
+@case('bus pack_frame+decode')
+def bus_frame(loop):
+    request = [ROOM_NAME, 'message', ['hello <world>', False]]
+
+    def op():
+        decode(pack_frame(FRAME_REQUEST, 1, request)[FRAME.size:])
+    return op
+
+
+def all_cases():
+    return list(CASES)
+
+
+def new_event_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
@@ -0,0 +1,50 @@
+"""Settings and fixtures shared by the benchmarks."""
+
+import asyncio
+import json
+import os
+import tempfile
+
+BENCH_SETTINGS = {
+    'authentication': {
+        'username': 'benchbot',
+        'password': 'benchpass',
+    },
+    'logging': {
+        'level': 'error',
+    },
+}
+
+
+def setup_settings():
+    """
+    Point SETTINGS_FILE to benchmark settings, unless already set.
+
+    Must be called before importing chatangobot.core.
+    """
+    if 'SETTINGS_FILE' in os.environ:
+        return
+
+    fd, path = tempfile.mkstemp(prefix='chatangobot-bench-', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(BENCH_SETTINGS, f)
+    os.environ['SETTINGS_FILE'] = path
+
+
+def run_sync(coro):
+    """
+    Run a coroutine that never yields to the event loop, without the loop.
+
+    Parsers and formatters are coroutines only by convention, driving them
+    directly keeps event loop overhead out of the measurements.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('Coroutine yielded to the event loop.')
+
+
+def drain(loop):
+    """Run tasks scheduled by the previous operation."""
+    loop.run_until_complete(asyncio.sleep(0))
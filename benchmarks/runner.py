@@ -0,0 +1,200 @@
+"""Run the benchmark cases, report ops/sec and allocations, and compare
+against the stored baseline.
+
+Usage:
+
+    python -m benchmarks [--save] [--tolerance 0.25] [--strict] [-k name]
+
+The baseline, benchmarks/baseline.json, holds the ops/sec of every case and
+the machine they were measured on: CPU model, CPU count and Python. The
+first run without one stores it. A case slower than its baseline by more
+than the tolerance, 25% by default, is a regression and the run exits
+non-zero; on another machine than the baseline's, regressions are only
+reported, unless --strict. Run with --save to store a new baseline after
+an intended change, or on a new machine.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from time import perf_counter
+
+from .cases import all_cases, new_event_loop
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+MIN_TIME = 0.2 # seconds per measurement
+REPEAT = 3
+ALLOC_OPS = 200
+
+
+def measure(op):
+    """
+    Best ops/sec out of REPEAT runs lasting at least MIN_TIME each.
+
+    @rtype: float
+    """
+    count = 1
+    while True:
+        started = perf_counter()
+        for _ in range(count):
+            op()
+        elapsed = perf_counter() - started
+        if elapsed >= MIN_TIME:
+            break
+        count *= 2
+
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        started = perf_counter()
+        for _ in range(count):
+            op()
+        best = min(best, perf_counter() - started)
+
+    return count / best
+
+
+def measure_allocations(op):
+    """
+    Memory allocated per operation, and memory still held afterwards.
+
+    @rtype: (float, float, float)
+    @return: peak traced bytes, and blocks and bytes still held afterwards,
+        per op
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(ALLOC_OPS):
+            op()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(max(stat.count_diff, 0) for stat in stats)
+    retained = sum(stat.size_diff for stat in stats)
+    return peak / ALLOC_OPS, blocks / ALLOC_OPS, retained / ALLOC_OPS
+
+
+def machine():
+    """
+    What the measurements depend on.
+
+    @rtype: dict
+    """
+    cpu = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    cpu = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return {
+        'cpu': cpu,
+        'cpu_count': os.cpu_count(),
+        'python': '%s %s' % (platform.python_implementation(),
+                platform.python_version()),
+        'system': platform.system(),
+    }
+
+
+def load_baseline():
+    """
+    @rtype: (dict, dict)
+    @return: case name to ops/sec, and the machine, None if unknown
+    """
+    try:
+        with open(BASELINE_FILE, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}, None
+    if 'cases' not in data:
+        # stored before machines were
+        return data, None
+    return data['cases'], data.get('machine')
+
+
+def save_baseline(results):
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump({
+            'machine': machine(),
+            'cases': {name: result['ops'] for name, result in\
+                    results.items()},
+        }, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Protocol microbenchmarks.')
+    parser.add_argument('--save', action='store_true',
+            help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+            help='allowed slowdown against the baseline, 0.25 is 25%%')
+    parser.add_argument('--strict', action='store_true',
+            help='fail on regressions against a baseline of another machine')
+    parser.add_argument('-k', dest='keyword', default=None,
+            help='only run cases containing this keyword')
+    args = parser.parse_args()
+
+    baseline, baseline_machine = load_baseline()
+    same_machine = baseline_machine == machine()
+    if baseline and not same_machine:
+        print('Baseline measured on another machine: %s' % (
+                json.dumps(baseline_machine, sort_keys=True)\
+                if baseline_machine else 'unknown'))
+    results = {}
+    regressions = []
+
+    print('%-24s %14s %12s %12s %12s %10s' % ('case', 'ops/sec',
+            'peak B/op', 'kept blk/op', 'kept B/op', 'baseline'))
+
+    for name, setup in all_cases():
+        if args.keyword and args.keyword not in name:
+            continue
+
+        loop = new_event_loop()
+        try:
+            op = setup(loop)
+            ops = measure(op)
+            peak, blocks, retained = measure_allocations(op)
+        finally:
+            loop.close()
+
+        results[name] = {'ops': ops}
+        change = ''
+        if name in baseline:
+            ratio = ops / baseline[name]
+            change = '%+.0f%%' % ((ratio - 1) * 100)
+            if ratio < 1 - args.tolerance:
+                regressions.append((name, ratio))
+                change += ' !'
+
+        print('%-24s %14.0f %12.0f %12.1f %12.0f %10s' % (name, ops, peak,
+                blocks, retained, change))
+
+    if args.save or not baseline:
+        if args.keyword:
+            baseline.update({name: result['ops'] for name, result in\
+                    results.items()})
+            results = {name: {'ops': ops} for name, ops in baseline.items()}
+        save_baseline(results)
+        print('Baseline saved to ' + BASELINE_FILE)
+        return
+
+    if regressions:
+        for name, ratio in regressions:
+            print('REGRESSION: %s runs at %.0f%% of baseline' % (name,
+                    ratio * 100))
+        if same_machine or args.strict:
+            sys.exit(1)
+        print('Not failing, the baseline is from another machine, see '
+                '--strict.')
@@ -0,0 +1,133 @@
+"""Soak test, runs a bot against the fake server and watches its memory.
+
+Every interval a tracemalloc snapshot is compared to the one taken after the
+warmup, the allocation sites that grew the most are printed together with
+the sizes of every internal container of the Manager, its rooms and pm.
+Containers that kept growing over the last samples are reported as leaks,
+and the exit status is non-zero.
+
+Usage:
+
+    python -m benchmarks.soak [--rooms 10] [--rate 20] [--duration 300] \\
+            [--interval 30] [--orphan-rate 0.01]
+"""
+
+import argparse
+import asyncio
+import sys
+import tracemalloc
+
+from .environment import setup_settings
+
+setup_settings()
+
+# pylint:disable=wrong-import-position
+from chatangobot.core.manager import Manager
+from chatangobot.core.settings import conf
+from chatangobot.fakeserver import FakeChatangoServer
+
+HOST = '127.0.0.1'
+TOP_SITES = 10
+GROWTH_SAMPLES = 4
+
+
+def find_growing(samples, count=GROWTH_SAMPLES):
+    """
+    Containers whose size increased in each of the last `count` samples.
+
+    @type samples: list of dict
+    @param samples: Manager.container_sizes() results, oldest first
+
+    @rtype: list of (str, int, int)
+    @return: name, first and last size
+    """
+    if len(samples) < count:
+        return []
+
+    recent = samples[-count:]
+    growing = []
+    for name in sorted(recent[-1]):
+        series = [sample.get(name, 0) for sample in recent]
+        if all(after > before for before, after in zip(series, series[1:])):
+            growing.append((name, samples[0].get(name, 0), series[-1]))
+    return growing
+
+
+def print_report(elapsed, baseline, sizes):
+    print('=== %.0fs ===' % elapsed)
+
+    stats = tracemalloc.take_snapshot().compare_to(baseline, 'lineno')
+    print('Top allocation sites by growth:')
+    for stat in stats[:TOP_SITES]:
+        print('  %s' % stat)
+
+    print('Containers:')
+    for name in sorted(sizes):
+        print('  %-40s %i' % (name, sizes[name]))
+    sys.stdout.flush()
+
+
+@asyncio.coroutine
+def soak(args):
+    server = FakeChatangoServer(rate=args.rate, orphan_rate=args.orphan_rate)
+    yield from server.start(HOST, args.port)
+
+    conf['servers']['chatroom_host'] = HOST
+    conf['servers']['chatroom_port'] = args.port
+
+    loop = asyncio.get_event_loop()
+    bot = Manager(loop=loop, pm=False)
+    bot.connect(*['soak%i' % index for index in range(args.rooms)])
+
+    yield from asyncio.sleep(args.warmup)
+    tracemalloc.start(args.frames)
+    baseline = tracemalloc.take_snapshot()
+    samples = []
+
+    started = loop.time()
+    while loop.time() - started < args.duration:
+        yield from asyncio.sleep(args.interval)
+        sizes = bot.container_sizes()
+        samples.append(sizes)
+        print_report(loop.time() - started, baseline, sizes)
+
+    tracemalloc.stop()
+    yield from bot.disconnect()
+    server.stop()
+
+    print('%i messages posted by the server.' % server.messages_posted)
+    return find_growing(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory soak test.')
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=20.0,
+            help='messages per second per room')
+    parser.add_argument('--orphan-rate', type=float, default=0.0,
+            help='fraction of messages never confirmed with a u frame')
+    parser.add_argument('--duration', type=float, default=300.0,
+            help='seconds, after the warmup')
+    parser.add_argument('--interval', type=float, default=30.0,
+            help='seconds between snapshots')
+    parser.add_argument('--warmup', type=float, default=10.0,
+            help='seconds before the baseline snapshot')
+    parser.add_argument('--frames', type=int, default=1,
+            help='traceback depth of allocation sites')
+    parser.add_argument('--port', type=int, default=18443)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    try:
+        growing = loop.run_until_complete(soak(args))
+    finally:
+        loop.close()
+
+    if growing:
+        for name, first, last in growing:
+            print('LEAK? %s grew from %i to %i' % (name, first, last))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -77,6 +77,15 @@ class AnonPMManager(object):
         self._channels = {}
 
 
+    def container_sizes(self):
+        """
+        Sizes of the internal containers, to watch memory usage.
+
+        @rtype: dict
+        """
+        return {'channels': len(self._channels)}
+
+
     @asyncio.coroutine
     def connect(self, username):
         channel = self.channel_class(loop=self._loop, mgr=self.mgr,
@@ -0,0 +1,601 @@
+"""Archive of every message of every room.
+
+Each room gets a directory of segments. A segment, "<seq>.seg", is a series
+of zlib compressed blocks of messages, its index, "<seq>.idx", has a record
+per block: time range, position, and the ids of its messages. Only the block
+time ranges are kept in memory, the sparse time index; the message ids of a
+segment are loaded when looked up. Its token index, "<seq>.tok", has the
+tokens of the messages of each block, for searches to only read the blocks
+holding every token of a query.
+
+Rooms only append to a list, blocks are compressed and written by a thread
+of the archive. Segments are rolled once larger than `segment_size`; rolled
+segments are compacted in the background: duplicate message ids are dropped
+and messages are packed into larger, better compressed blocks. Queries read
+segments through memory maps.
+"""
+
+import asyncio
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+import mmap
+import os
+import struct
+import zlib
+
+from .bus import decode, encode
+from .search import tokenize
+
+# first time, last time, offset, size, message count, ids size
+BLOCK = struct.Struct('<ddQIII')
+# size of the compressed tokens of a block
+TOKENS = struct.Struct('<I')
+
+ArchivedMessage = namedtuple('ArchivedMessage', ['msgid', 'time', 'username',
+        'puid', 'body', 'raw', 'ip', 'unid', 'nameColor', 'fontSize',
+        'fontFace', 'fontColor'])
+
+_Block = namedtuple('_Block', ['first', 'last', 'offset', 'size', 'count',
+        'ids_offset', 'ids_size'])
+
+
+class _Segment(object):
+    """A segment file and its block index."""
+
+    seq = None
+    path = None
+    index_path = None
+    tokens_path = None
+    compacted = False
+    blocks = None
+    size = 0
+
+    def __init__(self, directory, seq, compacted=False):
+        self.seq = seq
+        self.compacted = compacted
+        stem = os.path.join(directory, '%08i%s' % (seq,
+                '-c' if compacted else ''))
+        self.path = stem + '.seg'
+        self.index_path = stem + '.idx'
+        self.tokens_path = stem + '.tok'
+        self.blocks = []
+
+
+    def load(self):
+        """Read the block index, a truncated last record is ignored."""
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+
+        pos = 0
+        while pos + BLOCK.size <= len(data):
+            first, last, offset, size, count, ids_size = BLOCK.unpack_from(
+                    data, pos)
+            if pos + BLOCK.size + ids_size > len(data):
+                break
+            self.blocks.append(_Block(first, last, offset, size, count,
+                    pos + BLOCK.size, ids_size))
+            self.size = max(self.size, offset + size)
+            pos += BLOCK.size + ids_size
+
+
+    def ids(self):
+        """
+        Message id index of the segment.
+
+        @rtype: dict
+        @return: message id to block number
+        """
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+
+        result = {}
+        for number, block in enumerate(self.blocks):
+            for msgid in decode(data[block.ids_offset:block.ids_offset +\
+                    block.ids_size]):
+                result.setdefault(msgid, number)
+        return result
+
+
+class _TokenIndex(object):
+    """Token to block numbers of a segment, read as the segment grows."""
+
+    path = None
+    count = 0
+
+    _offset = 0
+    _postings = None
+
+    def __init__(self, path):
+        self.path = path
+        self._postings = {}
+
+
+    def update(self):
+        """Read the blocks indexed since the last update, if any."""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            # archived before token indexes
+            return
+
+        pos = 0
+        while pos + TOKENS.size <= len(data):
+            size, = TOKENS.unpack_from(data, pos)
+            if pos + TOKENS.size + size > len(data):
+                break
+            start = pos + TOKENS.size
+            for token in decode(zlib.decompress(data[start:start + size])):
+                numbers = self._postings.get(token)
+                if numbers is None:
+                    numbers = self._postings[token] = set()
+                numbers.add(self.count)
+            self.count += 1
+            pos = start + size
+        self._offset += pos
+
+
+    def blocks(self, tokens, count):
+        """
+        Numbers of the blocks which may hold every token, blocks not
+        indexed may hold anything.
+
+        @type count: int
+        @param count: blocks of the segment
+
+        @rtype: set of int
+        """
+        result = None
+        for token in sorted(tokens,
+                key=lambda token: len(self._postings.get(token, ()))):
+            numbers = self._postings.get(token, set())
+            result = set(numbers) if result is None else result & numbers
+            if not result:
+                break
+        result = set(number for number in result if number < count)\
+                if result is not None else set()
+        result.update(range(self.count, count))
+        return result
+
+
+class _SegmentWriter(object):
+    """Appends blocks to a segment."""
+
+    segment = None
+
+    _data = None
+    _index = None
+    _tokens = None
+
+    def __init__(self, segment):
+        self.segment = segment
+        self._data = open(segment.path, 'ab')
+        self._index = open(segment.index_path, 'ab')
+        self._tokens = open(segment.tokens_path, 'ab')
+
+
+    def write(self, records, level):
+        data = zlib.compress(encode(records), level)
+        ids = encode([record[0] for record in records])
+        times = [record[1] for record in records]
+        tokens = set()
+        for record in records:
+            tokens.update(tokenize(record[4]))
+        tokens = zlib.compress(encode(sorted(tokens)), level)
+
+        offset = self.segment.size
+        self._data.write(data)
+        self._data.flush()
+
+        # before the block record, tokens of a block not written are ignored
+        self._tokens.write(TOKENS.pack(len(tokens)) + tokens)
+        self._tokens.flush()
+
+        ids_offset = self._index.tell() + BLOCK.size
+        self._index.write(BLOCK.pack(min(times), max(times), offset, len(data),
+                len(records), len(ids)) + ids)
+        self._index.flush()
+
+        self.segment.blocks.append(_Block(min(times), max(times), offset,
+                len(data), len(records), ids_offset, len(ids)))
+        self.segment.size += len(data)
+
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+        self._tokens.close()
+
+
+class _RoomArchive(object):
+    """The segments of one room, used from the archive thread only."""
+
+    directory = None
+    segments = None
+    writer = None
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []
+        os.makedirs(directory, exist_ok=True)
+
+        found = {}
+        for name in os.listdir(directory):
+            stem, ext = os.path.splitext(name)
+            if ext == '.tmp':
+                os.unlink(os.path.join(directory, name))
+                continue
+            if ext != '.idx':
+                continue
+            seq, _, compacted = stem.partition('-')
+            # a compacted segment replaces its source
+            if compacted or int(seq) not in found:
+                found[int(seq)] = bool(compacted)
+
+        for seq, compacted in sorted(found.items()):
+            segment = _Segment(directory, seq, compacted)
+            if compacted:
+                self._remove_source(segment)
+            segment.load()
+            self.segments.append(segment)
+
+
+    def _remove_source(self, compacted):
+        source = _Segment(self.directory, compacted.seq)
+        for path in (source.path, source.tokens_path, source.index_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+    def append(self, records, segment_size, level):
+        """
+        Write a block.
+
+        @rtype: _Segment or None
+        @return: the segment rolled, to be compacted
+        """
+        if self.writer is None:
+            seq = self.segments[-1].seq + 1 if self.segments else 0
+            segment = _Segment(self.directory, seq)
+            self.segments.append(segment)
+            self.writer = _SegmentWriter(segment)
+
+        self.writer.write(records, level)
+        if self.writer.segment.size < segment_size:
+            return None
+
+        rolled = self.writer.segment
+        self.roll()
+        return rolled
+
+
+    def roll(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+    def compact(self, segment, block_size):
+        """Rewrite a rolled segment without duplicates, in larger blocks."""
+        seen = set()
+        records = []
+        for record in _read_segment(segment, segment.blocks):
+            if record[0] not in seen:
+                seen.add(record[0])
+                records.append(record)
+        records.sort(key=lambda record: record[1])
+
+        compacted = _Segment(self.directory, segment.seq, compacted=True)
+        final_paths = compacted.path, compacted.tokens_path,\
+                compacted.index_path
+        compacted.path += '.tmp'
+        compacted.tokens_path += '.tmp'
+        compacted.index_path += '.tmp'
+
+        writer = _SegmentWriter(compacted)
+        for start in range(0, len(records), block_size):
+            writer.write(records[start:start + block_size],
+                    zlib.Z_BEST_COMPRESSION)
+        writer.close()
+
+        # the index is renamed last, it makes the compacted segment valid
+        os.replace(compacted.path, final_paths[0])
+        os.replace(compacted.tokens_path, final_paths[1])
+        os.replace(compacted.index_path, final_paths[2])
+        compacted.path, compacted.tokens_path, compacted.index_path =\
+                final_paths
+        compacted.compacted = True
+
+        self.segments[self.segments.index(segment)] = compacted
+        self._remove_source(compacted)
+        return compacted
+
+
+def _read_segment(segment, blocks):
+    """Records of blocks of a segment, read through a memory map."""
+    if not blocks:
+        return
+    with open(segment.path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for block in blocks:
+                for record in decode(zlib.decompress(
+                        data[block.offset:block.offset + block.size])):
+                    yield record
+
+
+class Archive(object):
+    """Appends messages of every room to their archive, answers queries."""
+
+    directory = None
+    block_size = 256
+    compact_block_size = 4096
+    segment_size = 8 * 1024 * 1024
+    flush_interval = 5.0
+    level = 6
+    ids_cache_size = 8
+    tokens_cache_size = 64
+
+    _loop = None
+    _log = None
+    _executor = None
+    _rooms = None
+    _pending = None
+    _task = None
+    _ids = None
+    _tokens = None
+
+    def __init__(self, loop, directory, block_size=256,
+            segment_size=8 * 1024 * 1024, flush_interval=5.0):
+        self.directory = directory
+        self.block_size = block_size
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+
+        self._loop = loop
+        self._log = getLogger(type(self).__name__)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._rooms = {}
+        # room name to exported messages not written yet
+        self._pending = {}
+        # segment path to block count and message id index, least recent first
+        self._ids = OrderedDict()
+        # segment path to token index, least recent first
+        self._tokens = OrderedDict()
+
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+
+    def close(self):
+        """Stop and close the segments, call flush before."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._executor.submit(self._close_rooms)
+        self._executor.shutdown(wait=False)
+
+
+    def append(self, room, msg):
+        """
+        Archive a message, only a list append on the calling thread.
+
+        @type room: Room
+        @type msg: Message
+        """
+        pending = self._pending.get(room.name)
+        if pending is None:
+            pending = self._pending[room.name] = []
+        pending.append(room._export_message(msg)) # pylint:disable=protected-access
+
+        if len(pending) >= self.block_size * 4:
+            self._submit()
+
+
+    @asyncio.coroutine
+    def flush(self):
+        """Write the pending messages."""
+        yield from self._submit()
+
+
+    def _submit(self):
+        pending, self._pending = self._pending, {}
+        return self._loop.run_in_executor(self._executor, self._write,
+                pending)
+
+
+    def _write(self, pending):
+        for room_name, records in pending.items():
+            try:
+                room = self._room(room_name)
+                for start in range(0, len(records), self.block_size):
+                    rolled = room.append(records[start:start +\
+                            self.block_size], self.segment_size, self.level)
+                    if rolled is not None:
+                        self._executor.submit(self._compact, room, rolled)
+            except (OSError, ValueError):
+                self._log.exception('Cannot archive %i messages of %s',
+                        len(records), room_name)
+
+
+    def _compact(self, room, segment):
+        try:
+            room.compact(segment, self.compact_block_size)
+        except (OSError, ValueError):
+            self._log.exception('Cannot compact %s', segment.path)
+
+
+    def _room(self, room_name):
+        room = self._rooms.get(room_name)
+        if room is None:
+            room = self._rooms[room_name] = _RoomArchive(
+                    os.path.join(self.directory, room_name))
+            # left over by a crash or the previous run
+            for segment in room.segments:
+                if not segment.compacted:
+                    self._executor.submit(self._compact, room, segment)
+        return room
+
+
+    def _close_rooms(self):
+        for room in self._rooms.values():
+            room.roll()
+
+
+    @asyncio.coroutine
+    def _flush_periodically(self):
+        while True:
+            yield from asyncio.sleep(self.flush_interval)
+            if self._pending:
+                yield from self._submit()
+
+
+    @asyncio.coroutine
+    def query(self, room_name, start=None, end=None, limit=None):
+        """
+        Archived messages of a room, oldest first.
+
+        @type start: float
+        @param start: timestamp, included
+        @type end: float
+        @param end: timestamp, excluded
+        @type limit: int
+        @param limit: keep the oldest `limit` messages
+
+        @rtype: list of ArchivedMessage
+        """
+        yield from self.flush()
+        result = yield from self._loop.run_in_executor(self._executor,
+                self._query, room_name, start, end, limit)
+        return result
+
+
+    def _query(self, room_name, start, end, limit):
+        room = self._room(room_name)
+        result = []
+        for segment in room.segments:
+            blocks = [block for block in segment.blocks\
+                    if (start is None or block.last >= start) and\
+                    (end is None or block.first < end)]
+            for record in _read_segment(segment, blocks):
+                if (start is None or record[1] >= start) and\
+                        (end is None or record[1] < end):
+                    result.append(ArchivedMessage(*record))
+
+        result.sort(key=lambda msg: msg.time)
+        return result[:limit] if limit is not None else result
+
+
+    @asyncio.coroutine
+    def find(self, room_name, msgid):
+        """
+        Look a message up by id.
+
+        @rtype: ArchivedMessage or None
+        """
+        yield from self.flush()
+        result = yield from self._loop.run_in_executor(self._executor,
+                self._find, room_name, msgid)
+        return result
+
+
+    def _find(self, room_name, msgid):
+        room = self._room(room_name)
+        for segment in reversed(room.segments):
+            key = segment.path
+            # the active segment grows
+            count, ids = self._ids.get(key, (None, None))
+            if count != len(segment.blocks):
+                count, ids = self._ids[key] = (len(segment.blocks),
+                        segment.ids())
+                while len(self._ids) > self.ids_cache_size:
+                    self._ids.popitem(last=False)
+            self._ids.move_to_end(key)
+
+            number = ids.get(msgid)
+            if number is not None:
+                for record in _read_segment(segment,
+                        [segment.blocks[number]]):
+                    if record[0] == msgid:
+                        return ArchivedMessage(*record)
+        return None
+
+
+    @asyncio.coroutine
+    def search(self, room_name, tokens, match, start=None, end=None,
+            limit=50):
+        """
+        Archived messages of a room holding every token, newest first.
+
+        Only the blocks within [start, end) holding every token are read,
+        newest first, until `limit` messages matched.
+
+        @type tokens: set of str
+        @param tokens: lowercase tokens, see search.tokenize
+        @type match: callable
+        @param match: called with each ArchivedMessage holding every token,
+        in the archive thread, returns whether it is kept
+        @type start: float
+        @param start: timestamp, included
+        @type end: float
+        @param end: timestamp, excluded
+        @type limit: int
+        @param limit: keep the newest `limit` messages
+
+        @rtype: list of ArchivedMessage
+        """
+        yield from self.flush()
+        result = yield from self._loop.run_in_executor(self._executor,
+                self._search, room_name, tokens, match, start, end, limit)
+        return result
+
+
+    def _token_index(self, segment):
+        index = self._tokens.get(segment.path)
+        if index is None:
+            index = self._tokens[segment.path] = _TokenIndex(
+                    segment.tokens_path)
+            while len(self._tokens) > self.tokens_cache_size:
+                self._tokens.popitem(last=False)
+        self._tokens.move_to_end(segment.path)
+        if index.count < len(segment.blocks):
+            index.update()
+        return index
+
+
+    def _search(self, room_name, tokens, match, start, end, limit):
+        room = self._room(room_name)
+        candidates = []
+        for segment in room.segments:
+            count = len(segment.blocks)
+            for number in self._token_index(segment).blocks(tokens, count):
+                block = segment.blocks[number]
+                if (start is None or block.last >= start) and\
+                        (end is None or block.first < end):
+                    candidates.append((segment, block))
+        candidates.sort(key=lambda candidate: candidate[1].last, reverse=True)
+
+        result = []
+        seen = set()
+        for segment, block in candidates:
+            # older blocks cannot hold newer messages
+            if limit is not None and len(result) >= limit and\
+                    block.last < result[limit - 1].time:
+                break
+            for record in _read_segment(segment, [block]):
+                msg = ArchivedMessage(*record)
+                if msg.msgid in seen or\
+                        start is not None and msg.time < start or\
+                        end is not None and msg.time >= end:
+                    continue
+                words = set(tokenize(msg.body))
+                if tokens.issubset(words) and match(msg):
+                    seen.add(msg.msgid)
+                    result.append(msg)
+            result.sort(key=lambda msg: msg.time, reverse=True)
+            if limit is not None:
+                del result[limit:]
+        return result
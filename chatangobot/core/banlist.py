@@ -0,0 +1,177 @@
+"""Ban and unban records of a room, indexed by target, ip, unid and source.
+
+Large rooms have thousands of bans: records are slotted objects rather than
+dicts, item access is kept for code written against the dicts:
+
+    record['target'] is record.target
+"""
+
+
+class BanRecord(object):
+    """A ban or unban, of target, by src."""
+
+    __slots__ = ('unid', 'ip', 'target', 'time', 'src')
+
+    def __init__(self, unid, ip, target, time, src):
+        self.unid = unid
+        self.ip = ip
+        self.target = target
+        self.time = time
+        self.src = src
+
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+
+    def __repr__(self):
+        return '<BanRecord: %s by %s>' % (self.target.name, self.src.name)
+
+
+class Banlist(object):
+    """Records by target User, with secondary indexes."""
+
+    maxlen = None
+
+    _records = None
+    _ip_index = None
+    _unid_index = None
+    _src_index = None
+
+    def __init__(self, maxlen=None):
+        """
+        @type maxlen: int
+        @param maxlen: keep the most recent records only, None for all
+        """
+        self.maxlen = maxlen
+        self._records = {}
+        self._ip_index = {}
+        self._unid_index = {}
+        self._src_index = {}
+
+
+    def __len__(self):
+        return len(self._records)
+
+
+    def __iter__(self):
+        return iter(self._records)
+
+
+    def __contains__(self, target):
+        return target in self._records
+
+
+    def keys(self):
+        return self._records.keys()
+
+
+    def values(self):
+        return self._records.values()
+
+
+    def get(self, target, default=None):
+        return self._records.get(target, default)
+
+
+    def _indexes(self, record):
+        return ((self._ip_index, record.ip), (self._unid_index, record.unid),
+                (self._src_index, record.src))
+
+
+    def add(self, record):
+        """Add a record, replacing the one of the same target."""
+        self.remove(record.target)
+        self._records[record.target] = record
+        for index, key in self._indexes(record):
+            if key:
+                targets = index.get(key)
+                if targets is None:
+                    targets = index[key] = set()
+                targets.add(record.target)
+
+        # trimmed by a tenth at once, not on every add
+        if self.maxlen is not None and\
+                len(self._records) > self.maxlen + self.maxlen // 10:
+            for old in sorted(self._records.values(),
+                    key=lambda record: record.time)[:-self.maxlen]:
+                self.remove(old.target)
+
+
+    def remove(self, target):
+        """
+        Remove the record of a target.
+
+        @rtype: BanRecord or None
+        """
+        record = self._records.pop(target, None)
+        if record is None:
+            return None
+        for index, key in self._indexes(record):
+            targets = index.get(key)
+            if targets is not None:
+                targets.discard(target)
+                if not targets:
+                    del index[key]
+        return record
+
+
+    def clear(self):
+        self._records.clear()
+        self._ip_index.clear()
+        self._unid_index.clear()
+        self._src_index.clear()
+
+
+    def find(self, ip=None, unid=None, src=None):
+        """
+        Records matching every given criterion.
+
+        @type ip: str
+        @type unid: str
+        @type src: User
+        @param src: the moderator who banned
+
+        @rtype: list of BanRecord
+        """
+        targets = None
+        for index, key in ((self._ip_index, ip), (self._unid_index, unid),
+                (self._src_index, src)):
+            if key is None:
+                continue
+            found = index.get(key, ())
+            targets = set(found) if targets is None else targets & found
+        if targets is None:
+            targets = self._records
+        return [self._records[target] for target in targets]
+
+
+class Listing(object):
+    """Progress of a paged listing of the banlist or unbanlist."""
+
+    targets = None
+    # most entries a page held, the size the server actually pages by
+    largest = 0
+    # False once entries may have been skipped
+    complete = True
+
+    def __init__(self):
+        self.targets = set()
+
+
+    def __contains__(self, target):
+        return target in self.targets
+
+
+    def add(self, target):
+        """
+        @rtype: bool
+        @return: whether target was not listed yet
+        """
+        if target in self.targets:
+            return False
+        self.targets.add(target)
+        return True
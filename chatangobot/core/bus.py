@@ -0,0 +1,593 @@
+"""Event bus between the worker processes of the supervisor.
+
+The supervisor runs a `Broker` on a Unix socket, every worker's Manager
+connects to it with a `BusClient`. Workers tell the broker which rooms they
+joined, so requests for a room, like "message" or "ban", are routed to the
+worker owning it and answered back. Published events are forwarded to every
+other worker and dispatched as onBusEvent. When a worker takes a room over,
+see Manager.migrateRoom, the previous owner is told to leave it.
+
+Frames are a fixed header, see FRAME, followed by a value encoded with
+`encode`, a compact type-length-value format.
+"""
+
+import asyncio
+from logging import getLogger
+import os
+import struct
+
+from .monitor import Histogram
+
+# payload size, frame type, request id
+FRAME = struct.Struct('<IBI')
+
+FRAME_HELLO = 1
+FRAME_JOIN = 2
+FRAME_LEAVE = 3
+FRAME_PUBLISH = 4
+FRAME_REQUEST = 5
+FRAME_RESPONSE = 6
+
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_SIZE = struct.Struct('<I')
+
+
+class BusError(Exception):
+    """A request failed, timed out or no worker owns the room."""
+    pass
+
+
+def _encode(value, out):
+    if value is None:
+        out.append(ord('N'))
+    elif value is True:
+        out.append(ord('T'))
+    elif value is False:
+        out.append(ord('F'))
+    elif isinstance(value, int):
+        out.append(ord('i'))
+        out.extend(_INT.pack(value))
+    elif isinstance(value, float):
+        out.append(ord('d'))
+        out.extend(_FLOAT.pack(value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(ord('s'))
+        out.extend(_SIZE.pack(len(data)))
+        out.extend(data)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(ord('b'))
+        out.extend(_SIZE.pack(len(value)))
+        out.extend(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(ord('l'))
+        out.extend(_SIZE.pack(len(value)))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(ord('m'))
+        out.extend(_SIZE.pack(len(value)))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError('Cannot encode %s' % type(value).__name__)
+
+
+def encode(value):
+    """
+    Encode None, bool, int, float, str, bytes, list, tuple and dict.
+
+    @rtype: bytes
+    """
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def _decode(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == ord('N'):
+        return None, pos
+    if tag == ord('T'):
+        return True, pos
+    if tag == ord('F'):
+        return False, pos
+    if tag == ord('i'):
+        return _INT.unpack_from(data, pos)[0], pos + _INT.size
+    if tag == ord('d'):
+        return _FLOAT.unpack_from(data, pos)[0], pos + _FLOAT.size
+
+    size = _SIZE.unpack_from(data, pos)[0]
+    pos += _SIZE.size
+    if tag == ord('s'):
+        return bytes(data[pos:pos + size]).decode('utf-8'), pos + size
+    if tag == ord('b'):
+        return bytes(data[pos:pos + size]), pos + size
+    if tag == ord('l'):
+        items = []
+        for _ in range(size):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == ord('m'):
+        items = {}
+        for _ in range(size):
+            key, pos = _decode(data, pos)
+            items[key], pos = _decode(data, pos)
+        return items, pos
+
+    raise ValueError('Unknown tag %r at %i' % (chr(tag), pos - 1))
+
+
+def decode(data):
+    """Decode a value encoded with `encode`, tuples come back as lists."""
+    value, _ = _decode(memoryview(data), 0)
+    return value
+
+
+def pack_frame(frame_type, request_id, value):
+    payload = encode(value)
+    return FRAME.pack(len(payload), frame_type, request_id) + payload
+
+
+@asyncio.coroutine
+def read_frame(reader):
+    """
+    Read one frame.
+
+    @rtype: (int, int, object)
+    @return: frame type, request id and the decoded value
+    """
+    header = yield from reader.readexactly(FRAME.size)
+    size, frame_type, request_id = FRAME.unpack(header)
+    if size > MAX_PAYLOAD:
+        raise ValueError('Frame too large, %i bytes' % size)
+
+    payload = yield from reader.readexactly(size)
+    return frame_type, request_id, decode(payload)
+
+
+class _Peer(object):
+    """A worker connected to the broker."""
+
+    pid = None
+    rooms = None
+    writer = None
+
+    def __init__(self, writer):
+        self.rooms = set()
+        self.writer = writer
+
+
+    def send(self, frame_type, request_id, value):
+        if not self.writer.transport.is_closing():
+            self.writer.write(pack_frame(frame_type, request_id, value))
+
+
+class Broker(object):
+    """Routes requests to the worker owning a room, forwards events."""
+
+    path = None
+    routed = 0
+    published = 0
+
+    _log = None
+    _server = None
+    _peers = None
+    _owners = None
+    _pending = None
+    _next_id = 0
+
+    def __init__(self, path):
+        self.path = path
+        self._log = getLogger(type(self).__name__)
+        self._peers = set()
+        self._owners = {}
+        # broker request id to (origin peer, origin request id, target peer)
+        self._pending = {}
+
+
+    @asyncio.coroutine
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = yield from asyncio.start_unix_server(self._handle,
+                path=self.path)
+
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for peer in list(self._peers):
+            peer.writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+    def owner(self, room_name):
+        """The peer which joined a room, or None."""
+        return self._owners.get(room_name)
+
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        peer = _Peer(writer)
+        self._peers.add(peer)
+        try:
+            while True:
+                frame = yield from read_frame(reader)
+                self._route(peer, *frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError:
+            self._log.exception('Bad frame from worker %s', peer.pid)
+        finally:
+            self._drop(peer)
+            writer.close()
+
+
+    def _route(self, peer, frame_type, request_id, value):
+        if frame_type == FRAME_HELLO:
+            peer.pid, rooms = value
+            for room_name in rooms:
+                self._join(peer, room_name)
+
+        elif frame_type == FRAME_JOIN:
+            self._join(peer, value)
+
+        elif frame_type == FRAME_LEAVE:
+            peer.rooms.discard(value)
+            if self._owners.get(value) is peer:
+                del self._owners[value]
+
+        elif frame_type == FRAME_PUBLISH:
+            self.published += 1
+            for other in self._peers:
+                if other is not peer:
+                    other.send(FRAME_PUBLISH, 0, value)
+
+        elif frame_type == FRAME_REQUEST:
+            target = self._owners.get(value[0])
+            if target is None:
+                peer.send(FRAME_RESPONSE, request_id,
+                        [False, 'No worker owns room %s' % value[0]])
+                return
+
+            self._next_id = (self._next_id + 1) & 0xffffffff
+            self._pending[self._next_id] = (peer, request_id, target)
+            self.routed += 1
+            target.send(FRAME_REQUEST, self._next_id, value)
+
+        elif frame_type == FRAME_RESPONSE:
+            try:
+                origin, origin_id, _ = self._pending.pop(request_id)
+            except KeyError:
+                return
+            origin.send(FRAME_RESPONSE, origin_id, value)
+
+        else:
+            self._log.warning('Unknown frame type %i from worker %s',
+                    frame_type, peer.pid)
+
+
+    def _join(self, peer, room_name):
+        previous = self._owners.get(room_name)
+        if previous is not None and previous is not peer:
+            previous.rooms.discard(room_name)
+            previous.send(FRAME_LEAVE, 0, room_name)
+        self._owners[room_name] = peer
+        peer.rooms.add(room_name)
+
+
+    def _drop(self, peer):
+        self._peers.discard(peer)
+        for room_name in peer.rooms:
+            if self._owners.get(room_name) is peer:
+                del self._owners[room_name]
+
+        for request_id, (origin, origin_id, target) in\
+                list(self._pending.items()):
+            if origin is peer:
+                del self._pending[request_id]
+            elif target is peer:
+                del self._pending[request_id]
+                origin.send(FRAME_RESPONSE, origin_id,
+                        [False, 'Worker %s exited' % peer.pid])
+
+
+class BusClient(object):
+    """
+    A Manager's connection to the broker.
+
+    Requests for rooms joined by this Manager are executed directly, without
+    going through the broker.
+    """
+
+    # remote command name to Room method and whether the first argument is a
+    # user name, converted to a User
+    COMMANDS = {
+        'message': ('message', False),
+        'ban': ('banUser', True),
+        'unban': ('unban', True),
+        'clear': ('clearUser', True),
+        'delete': ('deleteUser', True),
+        'flag': ('flagUser', True),
+        'addmod': ('addMod', True),
+        'removemod': ('removeMod', True),
+        'clearall': ('clearall', False),
+        'level': ('getLevel', True),
+        'usernames': ('usernames', None),
+        'handoff': ('handoff', False),
+    }
+
+    path = None
+    timeout = 10.0
+    retry_delay = 1.0
+    latency = None
+    requests = 0
+    errors = 0
+
+    _mgr = None
+    _loop = None
+    _log = None
+    _writer = None
+    _task = None
+    _handlers = None
+    _pending = None
+    _next_id = 0
+    _closing = False
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+
+    def __init__(self, mgr, loop, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self.latency = Histogram()
+
+        self._mgr = mgr
+        self._loop = loop
+        self._log = getLogger(type(self).__name__)
+        self._handlers = {}
+        self._pending = {}
+
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.ensure_future(self._run())
+
+
+    def close(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending('Bus closed')
+
+
+    def register(self, name, func):
+        """
+        Add a remote command.
+
+        @type func: callable
+        @param func: called with the Room and the request arguments, may be
+            a coroutine, the result must be encodable
+        """
+        self._handlers[name] = func
+
+
+    def joined(self, room_name):
+        self._send(FRAME_JOIN, 0, room_name)
+
+
+    def left(self, room_name):
+        self._send(FRAME_LEAVE, 0, room_name)
+
+
+    def publish(self, topic, data=None):
+        """
+        Dispatch onBusEvent(topic, data) in every other worker.
+
+        @type topic: str
+        @param data: encodable value
+        """
+        self._send(FRAME_PUBLISH, 0, [topic, data])
+
+
+    @asyncio.coroutine
+    def handoff(self, room_name):
+        """
+        Ask the worker owning a room for its state, see Room.handoff.
+
+        @rtype: dict
+        @raise BusError: failed, timed out, or nobody joined the room
+        """
+        result = yield from self._remote(room_name.lower(), 'handoff', ())
+        return result
+
+
+    @asyncio.coroutine
+    def request(self, room_name, command, *args):
+        """
+        Run a command on a room, in whichever worker joined it.
+
+        @type room_name: str
+        @type command: str
+        @param command: one of COMMANDS or a registered command
+
+        @return: the command's result
+        @raise BusError: failed, timed out, or nobody joined the room
+        """
+        room_name = room_name.lower()
+        started = self._loop.time()
+        self.requests += 1
+        try:
+            if room_name in self._mgr.rooms:
+                result = yield from self._execute(room_name, command, args)
+            else:
+                result = yield from self._remote(room_name, command, args)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            duration = self._loop.time() - started
+            self.latency.observe(duration)
+            if self._mgr.metrics is not None:
+                self._mgr.metrics.bus_request(command, duration)
+
+        return result
+
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'requests': self.requests,
+            'errors': self.errors,
+            'pending': len(self._pending),
+            'latency': self.latency.as_dict(),
+        }
+
+
+    @asyncio.coroutine
+    def _remote(self, room_name, command, args):
+        if self._writer is None:
+            raise BusError('Not connected to the bus')
+
+        self._next_id = (self._next_id + 1) & 0xffffffff
+        request_id = self._next_id
+        try:
+            future = self._loop.create_future()
+        except AttributeError:
+            future = asyncio.Future()
+
+        self._pending[request_id] = future
+        self._send(FRAME_REQUEST, request_id, [room_name, command, list(args)])
+        try:
+            ok, result = yield from asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise BusError('Request %s to %s timed out' % (command,
+                    room_name))
+        finally:
+            self._pending.pop(request_id, None)
+
+        if not ok:
+            raise BusError(result)
+        return result
+
+
+    @asyncio.coroutine
+    def _execute(self, room_name, command, args):
+        room = self._mgr.getRoom(room_name)
+        if room is None:
+            raise BusError('Room %s was left' % room_name)
+
+        if command in self._handlers:
+            result = self._handlers[command](room, *args)
+        elif command in self.COMMANDS:
+            attr, user_arg = self.COMMANDS[command]
+            if user_arg is None:
+                return getattr(room, attr)
+            if user_arg:
+                args = (self._mgr.user_class.create(args[0]),) + tuple(
+                        args[1:])
+            result = getattr(room, attr)(*args)
+        else:
+            raise BusError('Unknown command %s' % command)
+
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            result = yield from result
+        return result
+
+
+    def _send(self, frame_type, request_id, value):
+        if self._writer is not None:
+            self._writer.write(pack_frame(frame_type, request_id, value))
+
+
+    def _fail_pending(self, reason):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_result((False, reason))
+        self._pending.clear()
+
+
+    @asyncio.coroutine
+    def _run(self):
+        warned = False
+        while not self._closing:
+            try:
+                reader, self._writer = yield from\
+                        asyncio.open_unix_connection(self.path)
+            except (OSError, ConnectionError):
+                if not warned:
+                    self._log.warning('Bus %s unavailable, retrying',
+                            self.path)
+                    warned = True
+                yield from asyncio.sleep(self.retry_delay)
+                continue
+
+            warned = False
+            self._send(FRAME_HELLO, 0, [os.getpid(), [room.name for room in\
+                    self._mgr.rooms.values() if not room.shadow]])
+            try:
+                while True:
+                    frame = yield from read_frame(reader)
+                    self._on_frame(*frame)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self._log.warning('Bus connection lost')
+            except ValueError:
+                self._log.exception('Bad frame from the bus')
+            finally:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                self._fail_pending('Bus connection lost')
+
+            yield from asyncio.sleep(self.retry_delay)
+
+
+    def _on_frame(self, frame_type, request_id, value):
+        if frame_type == FRAME_RESPONSE:
+            future = self._pending.get(request_id)
+            if future is not None and not future.done():
+                future.set_result(tuple(value))
+
+        elif frame_type == FRAME_REQUEST:
+            asyncio.ensure_future(self._answer(request_id, *value))
+
+        elif frame_type == FRAME_PUBLISH:
+            topic, data = value
+            self._mgr.dispatch_event(None, 'onBusEvent', topic, data)
+
+        elif frame_type == FRAME_LEAVE:
+            # another worker took the room over
+            asyncio.ensure_future(self._mgr.leaveRoom(value))
+
+
+    @asyncio.coroutine
+    def _answer(self, request_id, room_name, command, args):
+        try:
+            result = yield from self._execute(room_name, command, args)
+            response = [True, result]
+        except BusError as e:
+            response = [False, str(e)]
+        except Exception as e: # pylint:disable=broad-except
+            self._log.exception('Bus command %s failed', command)
+            response = [False, '%s: %s' % (type(e).__name__, e)]
+
+        try:
+            self._send(FRAME_RESPONSE, request_id, response)
+        except TypeError as e:
+            self._send(FRAME_RESPONSE, request_id, [False, str(e)])
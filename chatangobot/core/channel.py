@@ -1,15 +1,21 @@
 import asyncio
 
+from collections import namedtuple
 from re import search
+from time import perf_counter
 from uuid import uuid4
 from html import escape, unescape
 from logging import getLogger
 from circularbuffer import CircularBuffer # pylint:disable=no-name-in-module
 from bleach import clean
 
+from .recorder import RECORD_IN, RECORD_OUT
 from .settings import conf
 from ..utils import coro_later
 
+ChannelSnapshot = namedtuple('ChannelSnapshot', ['kind', 'name'])
+
+
 class BaseChannel(asyncio.Protocol):
     """Manages chatroom."""
 
@@ -53,6 +59,15 @@ class BaseChannel(asyncio.Protocol):
         raise NotImplementedError()
 
 
+    def snapshot(self):
+        """
+        Picklable copy of the channel, for use in other processes.
+
+        @rtype: ChannelSnapshot
+        """
+        return ChannelSnapshot(kind=type(self).__name__, name=self.name)
+
+
     @asyncio.coroutine
     def authenticate(self):
         raise NotImplementedError()
@@ -89,6 +104,9 @@ class BaseChannel(asyncio.Protocol):
                 self._log.info('Failed to connect, retrying in %i seconds...',
                         retry_delay)
 
+                if self.mgr.metrics is not None:
+                    self.mgr.metrics.connect_failed(self)
+
                 yield from asyncio.sleep(retry_delay)
             except: # pylint: disable=bare-except
                 break
@@ -135,6 +153,8 @@ class BaseChannel(asyncio.Protocol):
             self._log.warning(repr(exc))
 
         if not self.connected:
+            if self.mgr.recorder is not None:
+                self.mgr.recorder.forget(self)
             self._disconnect()
             self._future.set_result(None)
             self._future = None
@@ -145,6 +165,13 @@ class BaseChannel(asyncio.Protocol):
 
 
     def data_received(self, data):
+        tracer = self.mgr.tracer
+        if tracer is not None:
+            received = perf_counter()
+
+        if self.mgr.recorder is not None:
+            self.mgr.recorder.record(self, RECORD_IN, data)
+
         total = len(data)
         wrote = 0
         while self.connected and wrote < total:
@@ -157,12 +184,20 @@ class BaseChannel(asyncio.Protocol):
                 continue
 
             while True:
+                if tracer is not None:
+                    started = perf_counter()
+
                 recv = self._buf.read(pos)
                 # drop the \0
                 self._buf.read(1)
 
                 recv = recv.decode('utf-8', errors='replace').rstrip('\r\n')
-                asyncio.ensure_future(self._process(recv))
+                if tracer is None:
+                    trace = None
+                else:
+                    trace = tracer.begin(self, received, started)
+
+                asyncio.ensure_future(self._process(recv, trace))
 
                 try:
                     pos = self._buf.index(b'\0')
@@ -175,28 +210,43 @@ class BaseChannel(asyncio.Protocol):
 
 
     @asyncio.coroutine
-    def _process(self, recv):
+    def _process(self, recv, trace=None):
         """Process a command string.
 
         @type data: str
         @param data: the command string
+        @type trace: Trace
+        @param trace: trace context of the frame, if traced
         """
-        self._call_event('onRaw', recv)
-
         data = recv.split(':')
         cmd, args = data[0], data[1:]
 
+        if trace is not None:
+            trace.command = cmd
+            self.mgr.tracer.bind(trace)
+            started = perf_counter()
+
+        self._call_event('onRaw', recv)
+
+        if self.mgr.metrics is not None:
+            self.mgr.metrics.frame_received(self, cmd, len(recv))
+
         func = '_rcmd_' + cmd
         if hasattr(self, func):
-            yield from getattr(self, func)(args)
+            monitor = self.mgr.monitor
+            if monitor is None:
+                yield from getattr(self, func)(args)
+            else:
+                yield from monitor.timed(func, getattr(self, func)(args))
+
+            if trace is not None:
+                self.mgr.tracer.span(trace, 'parse', started, perf_counter())
         elif len(recv):
             self._log.warning('Unknown data received: ' + repr(recv))
 
 
     def _call_event(self, name, *args, **kwargs):
-        asyncio.ensure_future(getattr(self.mgr, name)(self, *args, **kwargs))
-        asyncio.ensure_future(self.mgr.onEventCalled(self, name, *args,
-                **kwargs))
+        self.mgr.dispatch_event(self, name, *args, **kwargs)
 
 
     def _send_command(self, *args):
@@ -206,16 +256,44 @@ class BaseChannel(asyncio.Protocol):
         @type args: [str, str, ...]
         @param args: command and list of arguments
         """
+        self._send_commands([args])
+
+
+    def _send_commands(self, commands):
+        """
+        Send commands in a single write.
+
+        @type commands: list of [str, str, ...]
+        @param commands: commands and their arguments
+        """
         if self._conn is None:
             return
 
-        if self._firstCommand:
-            terminator = b'\x00'
-            self._firstCommand = False
-        else:
-            terminator = b'\r\n\x00'
+        tracer = self.mgr.tracer
+        if tracer is not None:
+            started = perf_counter()
+
+        frames = []
+        for args in commands:
+            if self._firstCommand:
+                terminator = b'\x00'
+                self._firstCommand = False
+            else:
+                terminator = b'\r\n\x00'
+            frames.append(':'.join(args).encode('utf-8') + terminator)
+
+        self._conn.write(b''.join(frames))
+
+        for args, data in zip(commands, frames):
+            if tracer is not None:
+                tracer.sent(args[0], started)
+
+            if self.mgr.recorder is not None:
+                self.mgr.recorder.record(self, RECORD_OUT, data)
 
-        self._conn.write(':'.join(args).encode('utf-8') + terminator)
+            if self.mgr.metrics is not None:
+                self.mgr.metrics.frame_sent(self, args[0].split(':', 1)[0],
+                        len(data))
 
 
     @asyncio.coroutine
@@ -0,0 +1,158 @@
+"""Time of the bot, real or virtual.
+
+Delays all go through the event loop: asyncio.sleep, call_later and
+wait_for, the pings of channels, reconnect delays (utils.coro_later), the
+anon pm delay and the connection timeouts. Timestamps go through the clock
+of this module, modules import its time function in place of time.time:
+
+    from .clock import time
+
+For tests, VirtualTimeLoop runs timers without waiting: whenever nothing is
+ready, its time jumps to the next timer. Hours of bot lifetime take
+milliseconds:
+
+    loop = use_virtual_time()
+    manager = MyManager(loop)
+    loop.run_until_complete(asyncio.sleep(3600))
+
+Executor jobs, name resolution included, take real time but no virtual
+time: the loop waits for them before moving on. Network I/O is waited for
+only when no timer is scheduled, replies of a real server may come after
+timers due later.
+"""
+
+import asyncio
+import time as _time
+
+
+class Clock(object):
+    """Wall clock, seconds since the epoch."""
+
+    def time(self):
+        return _time.time()
+
+
+class VirtualClock(Clock):
+    """Wall clock following the time of a loop, a VirtualTimeLoop."""
+
+    loop = None
+    epoch = None
+
+    def __init__(self, loop, epoch=None):
+        """
+        @type loop: asyncio.AbstractEventLoop
+        @type epoch: float
+        @param epoch: wall clock time when the loop time was 0, defaults to
+        the current one
+        """
+        self.loop = loop
+        if epoch is None:
+            epoch = _time.time() - loop.time()
+        self.epoch = epoch
+
+
+    def time(self):
+        return self.epoch + self.loop.time()
+
+
+_clock = Clock()
+
+
+def time():
+    """Wall clock time of the current clock."""
+    return _clock.time()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """
+    Replace the current clock.
+
+    @type clock: Clock
+    @rtype: Clock
+    @return: the previous clock
+    """
+    global _clock # pylint:disable=global-statement
+    previous, _clock = _clock, clock
+    return previous
+
+
+class _VirtualSelector(object):
+    """Advances the time of its loop instead of blocking."""
+
+    _selector = None
+    _loop = None
+
+    def __init__(self, selector, loop):
+        self._selector = selector
+        self._loop = loop
+
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout is not None and timeout <= 0:
+            return events
+        if timeout is None or self._loop.executor_jobs:
+            # only I/O can wake the loop up, or the end of a job
+            return self._selector.select(timeout)
+        self._loop.advance(timeout)
+        return []
+
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop whose time advances to the next timer when idle."""
+
+    # executor jobs not done yet
+    executor_jobs = 0
+
+    _virtual_time = 0.0
+
+    def __init__(self, selector=None, start=0.0):
+        super(VirtualTimeLoop, self).__init__(selector)
+        self._virtual_time = start
+        self._selector = _VirtualSelector(self._selector, self)
+
+
+    def run_in_executor(self, executor, func, *args):
+        future = super(VirtualTimeLoop, self).run_in_executor(executor, func,
+                *args)
+        self.executor_jobs += 1
+        future.add_done_callback(self._job_done)
+        return future
+
+
+    def _job_done(self, future):
+        self.executor_jobs -= 1
+
+
+    def time(self):
+        return self._virtual_time
+
+
+    def advance(self, seconds):
+        """Move time forward, timers due run at the next iteration."""
+        self._virtual_time += seconds
+
+
+def use_virtual_time(epoch=None):
+    """
+    Create a VirtualTimeLoop, make it the current loop, and the current
+    clock follow it.
+
+    @type epoch: float
+    @param epoch: wall clock time when it starts, defaults to the current
+    one
+
+    @rtype: VirtualTimeLoop
+    """
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+    set_clock(VirtualClock(loop, epoch))
+    return loop
@@ -0,0 +1,590 @@
+"""Key-value datastore for handlers, with a write-behind cache.
+
+Writes go to the cache and are flushed to the backend in batches, every
+`flush_interval` seconds or once `batch_size` keys are dirty. Backends are
+blocking, they run in a thread of their own so the event loop never waits on
+the disk or the network, connecting included. Values are anything
+bus.encode supports.
+
+Backends, selected with datastore.backend, datastore.connect_args are given
+to their constructor:
+
+    sqlite  SQLite database in WAL mode, connect_args: database
+    log     append-only log with an in-memory index, compacted when mostly
+            garbage, for a single process, connect_args: path, fsync
+    redis   Redis compatible server, connect_args: host, port, db, password
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import getLogger
+import os
+import socket
+import sqlite3
+import struct
+
+from .bus import decode, encode
+
+_MISSING = object()
+_DELETED = object()
+
+
+class DatastoreError(Exception):
+    """The backend refused a command."""
+    pass
+
+
+class SQLiteBackend(object):
+    """SQLite database in WAL mode, one table of keys and blobs."""
+
+    # below SQLITE_MAX_VARIABLE_NUMBER
+    select_size = 500
+
+    _conn = None
+
+    def __init__(self, database='chatangobot.db', **kwargs):
+        self._conn = sqlite3.connect(database, check_same_thread=False,
+                **kwargs)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS kv '
+                '(key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self._conn.commit()
+
+
+    def get_many(self, keys):
+        result = {}
+        for start in range(0, len(keys), self.select_size):
+            chunk = keys[start:start + self.select_size]
+            cursor = self._conn.execute('SELECT key, value FROM kv WHERE key '
+                    'IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            for key, value in cursor:
+                result[key] = bytes(value)
+        return result
+
+
+    def write_batch(self, items):
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO kv VALUES (?, ?)',
+                    [(key, value) for key, value in items\
+                            if value is not None])
+            self._conn.executemany('DELETE FROM kv WHERE key = ?',
+                    [(key,) for key, value in items if value is None])
+
+
+    def close(self):
+        self._conn.close()
+
+
+class AppendLogBackend(object):
+    """
+    Append-only log of sets and deletes, every value is kept in memory.
+
+    The log is rewritten once it is `compact_ratio` times larger than its
+    live records.
+    """
+
+    # operation, key size, value size
+    RECORD = struct.Struct('<BII')
+    OP_SET = 1
+    OP_DELETE = 2
+
+    compact_ratio = 2.0
+    compact_min_size = 1024 * 1024
+
+    path = None
+    fsync = False
+
+    _file = None
+    _index = None
+    _size = 0
+    _live_size = 0
+
+    def __init__(self, path='chatangobot.log', fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._index = {}
+        self._load()
+        self._file = open(path, 'ab')
+
+
+    def _load(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with f:
+            data = f.read()
+
+        pos = 0
+        while pos + self.RECORD.size <= len(data):
+            op, key_size, value_size = self.RECORD.unpack_from(data, pos)
+            end = pos + self.RECORD.size + key_size + value_size
+            if end > len(data):
+                break
+            key = bytes(data[pos + self.RECORD.size:end - value_size])
+            key = key.decode('utf-8')
+            if op == self.OP_SET:
+                self._index[key] = data[end - value_size:end]
+            else:
+                self._index.pop(key, None)
+            pos = end
+
+        if pos < len(data):
+            # truncated by a crash
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+
+        self._size = pos
+        self._live_size = sum(self._record_size(key, value)\
+                for key, value in self._index.items())
+
+
+    def _record_size(self, key, value):
+        return self.RECORD.size + len(key.encode('utf-8')) + len(value)
+
+
+    def _pack(self, key, value):
+        key_data = key.encode('utf-8')
+        if value is None:
+            return self.RECORD.pack(self.OP_DELETE, len(key_data), 0) +\
+                    key_data
+        return self.RECORD.pack(self.OP_SET, len(key_data), len(value)) +\
+                key_data + value
+
+
+    def get_many(self, keys):
+        return {key: self._index[key] for key in keys if key in self._index}
+
+
+    def write_batch(self, items):
+        data = bytearray()
+        for key, value in items:
+            old = self._index.get(key)
+            if old is not None:
+                self._live_size -= self._record_size(key, old)
+            if value is None:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = value
+                self._live_size += self._record_size(key, value)
+            data.extend(self._pack(key, value))
+
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._size += len(data)
+
+        if self._size > self.compact_min_size and\
+                self._size > self._live_size * self.compact_ratio:
+            self.compact()
+
+
+    def compact(self):
+        """Rewrite the log with the live records only."""
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            for key, value in self._index.items():
+                f.write(self._pack(key, value))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._file.close()
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, 'ab')
+        self._size = self._live_size
+
+
+    def close(self):
+        self._file.close()
+
+
+class RedisBackend(object):
+    """Minimal client of the Redis protocol, commands are pipelined."""
+
+    _sock = None
+    _reader = None
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None,
+            timeout=10.0):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._reader = self._sock.makefile('rb')
+        if password:
+            self._execute([('AUTH', password)])
+        if db:
+            self._execute([('SELECT', str(db))])
+
+
+    @staticmethod
+    def _pack(args):
+        data = bytearray(('*%i\r\n' % len(args)).encode('ascii'))
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            data.extend(('$%i\r\n' % len(arg)).encode('ascii'))
+            data.extend(arg)
+            data.extend(b'\r\n')
+        return data
+
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by the server')
+
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            # raised once every reply of the pipeline was read
+            return DatastoreError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            size = int(rest)
+            if size < 0:
+                return None
+            return self._reader.read(size + 2)[:-2]
+        if kind == b'*':
+            size = int(rest)
+            if size < 0:
+                return None
+            return [self._read_reply() for _ in range(size)]
+        raise DatastoreError('Unknown reply %r' % line)
+
+
+    def _execute(self, commands):
+        data = bytearray()
+        for args in commands:
+            data.extend(self._pack(args))
+        try:
+            self._sock.sendall(data)
+            replies = [self._read_reply() for _ in commands]
+        except Exception:
+            # replies left unread would answer the next commands
+            self.close()
+            raise
+
+        for reply in replies:
+            if isinstance(reply, DatastoreError):
+                raise reply
+        return replies
+
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        values = self._execute([('MGET',) + tuple(keys)])[0]
+        return {key: value for key, value in zip(keys, values)\
+                if value is not None}
+
+
+    def write_batch(self, items):
+        self._execute([('SET', key, value) if value is not None else\
+                ('DEL', key) for key, value in items])
+
+
+    def close(self):
+        self._reader.close()
+        self._sock.close()
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'log': AppendLogBackend,
+    'redis': RedisBackend,
+}
+
+
+class Datastore(object):
+    """
+    Asynchronous key-value store in front of a blocking backend.
+
+    Keys are strings, prefixed with `prefix` in the backend. The backend is
+    given, or opened by `open_backend` in the datastore thread, on start or
+    on first use; until it opens, reads fail and writes stay dirty. An
+    opened backend is closed when a call fails, and opened again on next
+    use.
+    """
+
+    backend = None
+    prefix = ''
+    flush_interval = 1.0
+    batch_size = 500
+    cache_size = 10000
+
+    _loop = None
+    _log = None
+    _open_backend = None
+    _executor = None
+    _cache = None
+    _dirty = None
+    _lock = None
+    _task = None
+    _flushing = None
+
+    @property
+    def dirty(self):
+        """Number of keys waiting to be flushed."""
+        return len(self._dirty)
+
+
+    def __init__(self, loop, backend=None, prefix='', flush_interval=1.0,
+            batch_size=500, cache_size=10000, open_backend=None):
+        """
+        @type backend: object
+        @param backend: an open backend, or None to use open_backend
+        @type open_backend: callable
+        @param open_backend: creates the backend, called in the datastore
+        thread
+        """
+        self.backend = backend
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+
+        self._loop = loop
+        self._log = getLogger(type(self).__name__)
+        self._open_backend = open_backend
+        # sqlite connections must stay in one thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._lock = asyncio.Lock()
+
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+            if self.backend is None:
+                self._loop.run_in_executor(self._executor, self._open)\
+                        .add_done_callback(self._on_opened)
+
+
+    def _open(self):
+        """The backend, opened if needed, in the datastore thread."""
+        if self.backend is None:
+            self.backend = self._open_backend()
+        return self.backend
+
+
+    def _on_opened(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self._log.error('Cannot open the backend, retrying on use: %s',
+                    future.exception())
+
+
+    def _close_backend(self):
+        if self.backend is not None:
+            self.backend.close()
+
+
+    def close(self):
+        """Stop flushing and close the backend, call flush before."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._dirty:
+            self._log.warning('Closing with %i unsaved keys.',
+                    len(self._dirty))
+        self._executor.submit(self._close_backend)
+        self._executor.shutdown(wait=False)
+
+
+    def _call(self, method, *args):
+        backend = self._open()
+        try:
+            return getattr(backend, method)(*args)
+        except Exception:
+            if self._open_backend is not None:
+                # it may be out of sync, a new one is opened on next use
+                self.backend = None
+                try:
+                    backend.close()
+                except Exception: # pylint:disable=broad-except
+                    pass
+            raise
+
+
+    def _run(self, method, *args):
+        """Call a method of the backend in the datastore thread."""
+        return self._loop.run_in_executor(self._executor, self._call, method,
+                *args)
+
+
+    def _peek(self, key):
+        value = self._dirty.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                self._cache.move_to_end(key)
+        return value
+
+
+    def _remember(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+    @asyncio.coroutine
+    def _load(self, keys):
+        missing = [key for key in keys if key not in self._dirty and\
+                key not in self._cache]
+        if not missing:
+            return
+
+        values = yield from self._run('get_many', missing)
+        for key in missing:
+            # written while the backend was read
+            if key in self._dirty or key in self._cache:
+                continue
+            raw = values.get(key)
+            self._remember(key, _DELETED if raw is None else decode(raw))
+
+
+    @asyncio.coroutine
+    def get(self, key, default=None):
+        """
+        Get a value.
+
+        @type key: str
+        @param key: key, without prefix
+        @param default: returned if the key does not exist
+        """
+        key = self.prefix + key
+        yield from self._load([key])
+        value = self._peek(key)
+        return default if value is _MISSING or value is _DELETED else value
+
+
+    @asyncio.coroutine
+    def get_many(self, keys, default=None):
+        """
+        Get multiple values with one backend query.
+
+        @rtype: dict
+        @return: key to value, `default` for missing keys
+        """
+        yield from self._load([self.prefix + key for key in keys])
+        result = {}
+        for key in keys:
+            value = self._peek(self.prefix + key)
+            if value is _MISSING or value is _DELETED:
+                value = default
+            result[key] = value
+        return result
+
+
+    def set(self, key, value):
+        """
+        Set a value, it is written to the backend on the next flush.
+
+        @param value: None, bool, int, float, str, bytes, list or dict
+        """
+        encode(value) # fail early on values the backend cannot store
+        self._mark(self.prefix + key, value)
+
+
+    def delete(self, key):
+        self._mark(self.prefix + key, _DELETED)
+
+
+    @asyncio.coroutine
+    def incr(self, key, amount=1):
+        """
+        Add to a counter, missing counters start at 0.
+
+        @rtype: int or float
+        @return: the new value
+        """
+        key = self.prefix + key
+        yield from self._load([key])
+        value = self._peek(key)
+        if value is _MISSING or value is _DELETED:
+            value = 0
+        value += amount
+        self._mark(key, value)
+        return value
+
+
+    def _mark(self, key, value):
+        self._dirty[key] = value
+        self._remember(key, value)
+        if len(self._dirty) >= self.batch_size and self._flushing is None:
+            self._flushing = asyncio.ensure_future(self.flush())
+            self._flushing.add_done_callback(self._on_flushed)
+
+
+    def _on_flushed(self, future):
+        self._flushing = None
+        if not future.cancelled() and future.exception() is not None:
+            self._log.error('Flush failed: %s', future.exception())
+
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Write the dirty keys to the backend.
+
+        On failure the keys stay dirty, unless written again meanwhile.
+
+        @rtype: int
+        @return: number of keys written
+        """
+        yield from self._lock.acquire()
+        try:
+            batch, self._dirty = self._dirty, {}
+            if not batch:
+                return 0
+
+            items = [(key, None if value is _DELETED else encode(value))\
+                    for key, value in batch.items()]
+            try:
+                yield from self._run('write_batch', items)
+            except Exception:
+                for key, value in batch.items():
+                    self._dirty.setdefault(key, value)
+                raise
+
+            return len(items)
+        finally:
+            self._lock.release()
+
+
+    @asyncio.coroutine
+    def _flush_periodically(self):
+        while True:
+            yield from asyncio.sleep(self.flush_interval)
+            try:
+                yield from self.flush()
+            except Exception: # pylint:disable=broad-except
+                self._log.exception('Flush failed, retrying in %.1fs',
+                        self.flush_interval)
+
+
+def create_datastore(loop, config):
+    """
+    Create the Datastore configured in the "datastore" settings.
+
+    @type config: dict
+    @param config: conf['datastore']
+
+    @rtype: Datastore
+    """
+    try:
+        backend_class = BACKENDS[config['backend']]
+    except KeyError:
+        raise ValueError('Unknown datastore backend: %s' % config['backend'])
+
+    return Datastore(loop, prefix=config['prefix'],
+            flush_interval=config['flush_interval'],
+            batch_size=config['batch_size'],
+            cache_size=config['cache_size'],
+            open_backend=partial(backend_class, **config['connect_args']))
@@ -0,0 +1,319 @@
+"""Run event handlers outside of the event loop."""
+
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+EXECUTOR_PROCESS = 'process'
+EXECUTOR_THREAD = 'thread'
+
+QUEUE_FULL_WAIT = 'wait'
+QUEUE_FULL_DROP = 'drop'
+QUEUE_FULL_DROP_OLDEST = 'drop_oldest'
+QUEUE_FULL_POLICIES = (QUEUE_FULL_WAIT, QUEUE_FULL_DROP,
+        QUEUE_FULL_DROP_OLDEST)
+
+
+class QueueFull(Exception):
+    """Raised when a blocking handler was dropped by a full queue."""
+
+
+def cpu_bound(func):
+    """
+    Mark a function or an event handler as CPU-bound.
+
+    The Manager runs marked handlers inside its process pool, arguments are
+    replaced by their snapshots (see `snapshot`) and the return value is
+    delivered back on the event loop to the `<event>Result` handler, for
+    example `onMessageResult(room, user, message, result)`.
+
+    The handler runs in another process, so it has no access to the Manager,
+    declare it as a staticmethod:
+
+        @staticmethod
+        @cpu_bound
+        def onMessage(room, user, message):
+            return classify(message.body)
+
+    @type func: callable
+    @param func: module level function or staticmethod, must be picklable
+    """
+    func.executor = EXECUTOR_PROCESS
+    return func
+
+
+def blocking(func):
+    """
+    Mark an event handler as blocking.
+
+    The Manager runs marked handlers inside its bounded thread pool, so they
+    are plain functions instead of coroutines. The channel argument is
+    wrapped in a LoopProxy, calling its methods (`room.message(...)`) is
+    marshalled back onto the event loop:
+
+        @blocking
+        def onMessage(self, room, user, message):
+            reply = database.lookup(message.body)
+            room.message(reply).result()
+
+    Other arguments are replaced by their snapshots, see `snapshot`. Only
+    the LoopProxy and Manager.call_threadsafe may touch the objects of the
+    loop, rooms and the Manager included.
+
+    @type func: callable
+    @param func: the handler
+    """
+    func.executor = EXECUTOR_THREAD
+    return func
+
+
+def _create_future(loop):
+    try:
+        return loop.create_future()
+    except AttributeError:
+        return asyncio.Future(loop=loop)
+
+
+def call_threadsafe(loop, func, *args, **kwargs):
+    """
+    Call a function on the event loop from another thread.
+
+    Coroutines returned by the function are run to completion on the loop.
+
+    @rtype: concurrent.futures.Future
+    @return: resolved with the function's (or coroutine's) result
+    """
+    @asyncio.coroutine
+    def call():
+        result = func(*args, **kwargs)
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            result = yield from result
+        return result
+
+    return asyncio.run_coroutine_threadsafe(call(), loop)
+
+
+class LoopProxy(object):
+    """
+    Wraps an object owned by the event loop for use from worker threads.
+
+    Attribute reads are passed through, method calls are executed on the loop
+    and return a concurrent.futures.Future.
+    """
+
+    def __init__(self, target, loop):
+        self._target = target
+        self._loop = loop
+
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        return partial(call_threadsafe, self._loop, value)
+
+
+    def __repr__(self):
+        return '<LoopProxy: %r>' % self._target
+
+
+class HandlerLatency(object):
+    """Latency counters of a handler run in the thread pool."""
+
+    count = 0
+    errors = 0
+    dropped = 0
+    wait_total = 0.0
+    run_total = 0.0
+    run_max = 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'wait_avg': self.wait_total / self.count if self.count else 0.0,
+            'run_avg': self.run_total / self.count if self.count else 0.0,
+            'run_max': self.run_max,
+        }
+
+
+class _Job(object):
+
+    __slots__ = ('name', 'func', 'future', 'queued', 'started')
+
+    def __init__(self, name, func, future, queued):
+        self.name = name
+        self.func = func
+        self.future = future
+        self.queued = queued
+        self.started = None
+
+
+class ThreadBridge(object):
+    """
+    Bounded thread pool for blocking handlers.
+
+    At most `max_workers` jobs run at once and up to `queue_size` more wait
+    in line, `when_full` decides what happens to the next job: "wait" until
+    there is room, "drop" it, or "drop_oldest" queued job instead.
+    """
+
+    stats = None
+
+    _loop = None
+    _pool = None
+    _queue = None
+    _waiters = None
+    _running = 0
+
+    def __init__(self, loop, max_workers, queue_size,
+            when_full=QUEUE_FULL_WAIT):
+        if when_full not in QUEUE_FULL_POLICIES:
+            raise ValueError('Unknown queue full policy: ' + when_full)
+
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.when_full = when_full
+        self.stats = {}
+
+        self._loop = loop
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._queue = deque()
+        self._waiters = deque()
+
+
+    @property
+    def pending(self):
+        return self._running + len(self._queue)
+
+
+    def _get_stats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = HandlerLatency()
+        return stats
+
+
+    def _is_full(self):
+        return self._running >= self.max_workers and\
+                len(self._queue) >= self.queue_size
+
+
+    @asyncio.coroutine
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Run `func` in the thread pool and wait for its result.
+
+        @type name: str
+        @param name: name for the latency report, the handler's name
+        @raise QueueFull: the job was dropped
+        """
+        while self._is_full():
+            if self.when_full == QUEUE_FULL_DROP or\
+                    self.when_full == QUEUE_FULL_DROP_OLDEST and\
+                    not self._queue:
+                # no queued job to drop instead, with a queue_size of 0
+                self._get_stats(name).dropped += 1
+                raise QueueFull(name)
+
+            elif self.when_full == QUEUE_FULL_DROP_OLDEST:
+                job = self._queue.popleft()
+                self._get_stats(job.name).dropped += 1
+                if not job.future.done():
+                    job.future.set_exception(QueueFull(job.name))
+
+            else:
+                waiter = _create_future(self._loop)
+                self._waiters.append(waiter)
+                yield from waiter
+
+        job = _Job(name, partial(func, *args, **kwargs),
+                _create_future(self._loop), self._loop.time())
+
+        if self._running < self.max_workers:
+            self._start(job)
+        else:
+            self._queue.append(job)
+
+        result = yield from job.future
+        return result
+
+
+    def _start(self, job):
+        self._running += 1
+        job.started = self._loop.time()
+        self._get_stats(job.name).wait_total += job.started - job.queued
+
+        future = self._loop.run_in_executor(self._pool, job.func)
+        future.add_done_callback(partial(self._finished, job))
+
+
+    def _finished(self, job, future):
+        self._running -= 1
+
+        elapsed = self._loop.time() - job.started
+        stats = self._get_stats(job.name)
+        stats.count += 1
+        stats.run_total += elapsed
+        stats.run_max = max(stats.run_max, elapsed)
+
+        if not job.future.done():
+            if future.cancelled():
+                # the pool was shut down
+                job.future.cancel()
+            elif future.exception() is not None:
+                stats.errors += 1
+                job.future.set_exception(future.exception())
+            else:
+                job.future.set_result(future.result())
+
+        if self._queue:
+            self._start(self._queue.popleft())
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+def snapshot(obj):
+    """
+    Replace live chat objects with picklable copies.
+
+    Objects with a `snapshot` method (Message, User, channels) are replaced
+    by its result, lists and tuples are converted item by item, anything else
+    is returned unchanged.
+    """
+    take = getattr(obj, 'snapshot', None)
+    if take is not None:
+        return take()
+    if type(obj) in (list, tuple, set):
+        return type(obj)(snapshot(item) for item in obj)
+    return obj
+
+
+def create_process_pool(max_workers=None):
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+
+@asyncio.coroutine
+def run_in_process(loop, pool, func, *args, **kwargs):
+    """
+    Run `func` in `pool` with snapshots of its arguments.
+
+    @rtype: object
+    @return: whatever `func` returned, on the event loop
+    """
+    args = [snapshot(arg) for arg in args]
+    kwargs = {key: snapshot(val) for key, val in kwargs.items()}
+    result = yield from loop.run_in_executor(pool, partial(func, *args,
+            **kwargs))
+
+    return result
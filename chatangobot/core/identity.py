@@ -0,0 +1,208 @@
+"""Identities across rooms, to catch banned users coming back.
+
+Every message links the name of its sender with its unid, ip and the puid
+of the user, in a union-find of keys: "n:<name>", "u:<unid>", "i:<ip>" and
+"p:<puid>". Names sharing any of them, directly or through other names,
+end up in the same set. Bans of every room mark the set of their target.
+
+Anon names, "!anon<id>" and "#<name>", are not keys: the id of anons has 4
+digits and unrelated anons share it. Ips are not linked by default, users
+behind a NAT share them.
+
+Observations expire by generation: a generation takes links for `ttl`
+seconds, or until it holds `max_keys` keys, then becomes the previous one
+and a new one starts; the previous one is dropped at the next rotation.
+Bans are kept apart and marked again in each new generation.
+"""
+
+from .clock import time
+
+
+class _Generation(object):
+    """A union-find of keys, with the bans of each set at its root."""
+
+    started = None
+
+    _parent = None
+    _size = None
+    _bans = None
+
+    def __init__(self, started):
+        self.started = started
+        self._parent = {}
+        self._size = {}
+        # root to set of (room name, banned name)
+        self._bans = {}
+
+
+    def __len__(self):
+        return len(self._parent)
+
+
+    def find(self, key):
+        """Root of the set of a key, None if unknown."""
+        parent = self._parent
+        if key not in parent:
+            return None
+        while parent[key] != key:
+            # path halving
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+
+    def _root(self, key):
+        root = self.find(key)
+        if root is None:
+            root = self._parent[key] = key
+            self._size[key] = 1
+        return root
+
+
+    def union(self, keys):
+        """Link keys, return the root of their set."""
+        root = None
+        for key in keys:
+            other = self._root(key)
+            if root is None or other == root:
+                root = other
+                continue
+            # union by size, the smaller tree goes under the larger
+            if self._size[root] < self._size[other]:
+                root, other = other, root
+            self._parent[other] = root
+            self._size[root] += self._size.pop(other)
+            bans = self._bans.pop(other, None)
+            if bans:
+                self._bans.setdefault(root, set()).update(bans)
+        return root
+
+
+    def ban(self, keys, ban):
+        root = self.union(keys)
+        self._bans.setdefault(root, set()).add(ban)
+
+
+    def unban(self, key, ban):
+        root = self.find(key)
+        bans = self._bans.get(root)
+        if bans is not None:
+            bans.discard(ban)
+            if not bans:
+                del self._bans[root]
+
+
+    def bans(self, key):
+        root = self.find(key)
+        return self._bans.get(root, ()) if root is not None else ()
+
+
+def _keys(name, unid, ip, puid):
+    keys = []
+    if not name.startswith(('!', '#')):
+        keys.append('n:' + name)
+    if unid:
+        keys.append('u:' + unid)
+    if ip:
+        keys.append('i:' + ip)
+    if puid:
+        keys.append('p:' + puid)
+    return keys
+
+
+class IdentityGraph(object):
+    """Links names through unid, ip and puid, see module doc."""
+
+    ttl = 86400.0
+    max_keys = 1000000
+    link_ip = False
+
+    _current = None
+    _previous = None
+    # (room name, banned name) to the keys of the ban
+    _bans = None
+
+    def __init__(self, ttl=86400.0, max_keys=1000000, link_ip=False):
+        """
+        @type ttl: float
+        @param ttl: seconds a generation takes links
+        @type max_keys: int
+        @param max_keys: keys of a generation before it is rotated
+        @type link_ip: bool
+        @param link_ip: True links ips too, shared by users behind a NAT
+        """
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.link_ip = link_ip
+        self._current = _Generation(time())
+        self._bans = {}
+
+
+    def __len__(self):
+        return len(self._current) +\
+                (len(self._previous) if self._previous is not None else 0)
+
+
+    def _rotate(self, now):
+        self._previous = self._current
+        self._current = _Generation(now)
+        for ban, keys in self._bans.items():
+            self._current.ban(keys, ban)
+
+
+    def _keys(self, name, unid, ip, puid):
+        return _keys(name, unid, ip if self.link_ip else None, puid)
+
+
+    def observe(self, room_name, name, unid=None, ip=None, puid=None,
+            now=None):
+        """
+        Link a name with its unid, ip and puid.
+
+        @rtype: set of str
+        @return: names banned from the room linked to name, but name
+        """
+        if now is None:
+            now = time()
+        if now - self._current.started >= self.ttl or\
+                len(self._current) >= self.max_keys:
+            self._rotate(now)
+
+        keys = self._keys(name, unid, ip, puid)
+        if not keys:
+            return set()
+        self._current.union(keys)
+
+        bans = set(self._current.bans(keys[0]))
+        if self._previous is not None:
+            # the keys are not linked together there, each may have a set
+            for key in keys:
+                bans.update(self._previous.bans(key))
+        return set(banned for ban_room, banned in bans\
+                if ban_room == room_name and banned != name)
+
+
+    def ban(self, room_name, name, unid=None, ip=None):
+        """Mark the identity of a name banned from a room."""
+        ban = (room_name, name)
+        keys = self._keys(name, unid, ip, None)
+        if not keys:
+            return
+        self._bans[ban] = keys
+        self._current.ban(keys, ban)
+
+
+    def unban(self, room_name, name):
+        ban = (room_name, name)
+        keys = self._bans.pop(ban, None)
+        if keys is None:
+            return
+        for generation in (self._current, self._previous):
+            if generation is not None:
+                generation.unban(keys[0], ban)
+
+
+    def forget(self, room_name):
+        """Drop the bans of a room, once left."""
+        for ban in [ban for ban in self._bans if ban[0] == room_name]:
+            self.unban(*ban)
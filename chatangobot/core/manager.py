@@ -1,12 +1,35 @@
 import asyncio
+from inspect import ismethod
 from logging import getLogger
 
+from .executor import EXECUTOR_PROCESS, EXECUTOR_THREAD, LoopProxy,\
+        QueueFull, ThreadBridge, call_threadsafe, create_process_pool,\
+        run_in_process, snapshot
 from .settings import conf
 from .room import Room
+from . import user as user_module
 from .user import User
 from .pm import PM
 from .anonpm import AnonPMManager
+from .archive import Archive
+from .bus import BusClient, BusError
+from .datastore import create_datastore
+from .identity import IdentityGraph
 from .message import Message
+from .persistence import StateStore
+from .metrics import ChatMetrics, MetricsServer
+from .monitor import LoopMonitor
+from .recorder import Recorder
+from .search import SearchIndex
+from .spam import SpamDetector
+from .stats import ActivityStats
+from .tracing import Tracer
+from .wordfilter import WordFilter
+
+# coalesced events: dispatched once per window with the last arguments, or
+# as a batch event with the list of the first argument of each
+COALESCE_LATEST = 'latest'
+COALESCE_BATCH = 'batch'
 
 class Manager(object):
     """Class that manages multiple connections."""
@@ -17,13 +40,43 @@ class Manager(object):
     anonpm_class = AnonPMManager
     message_class = Message
 
+    # event to (mode, batch event), windows are in conf['coalesce']
+    coalesced_events = {
+        'onUserCountChange': (COALESCE_LATEST, None),
+        'onJoin': (COALESCE_BATCH, 'onJoinBatch'),
+        'onLeave': (COALESCE_BATCH, 'onLeaveBatch'),
+    }
+
     user = None
     rooms = None
     pm = None
+    monitor = None
+    metrics = None
+    tracer = None
+    recorder = None
+    bus = None
+    state_store = None
+    datastore = None
+    archive = None
+    search = None
+    wordfilter = None
+    spam = None
+    identity = None
+    stats = None
 
     _loop = None
     _log = None
     _future = None
+    _process_pool = None
+    _thread_bridge = None
+    _metrics_server = None
+    _snapshot_task = None
+    _wordfilter_task = None
+    # (channel, event) to the timer of the current window, and the
+    # arguments received in it
+    _coalesced = None
+    # room, or None for every room, to its batch of messages
+    _message_batches = None
 
     @property
     def roomnames(self):
@@ -35,6 +88,8 @@ class Manager(object):
         self._log = getLogger(type(self).__name__)
 
         self.rooms = {}
+        self._coalesced = {}
+        self._message_batches = {}
         self.user = self.user_class.create(conf['authentication']['username'])
 
         if pm:
@@ -44,6 +99,70 @@ class Manager(object):
             else:
                 self.pm = self.anonpm_class(loop=loop, mgr=self) # pylint: disable=redefined-variable-type
 
+        if conf['monitor']['enabled']:
+            self.monitor = LoopMonitor(loop,
+                    interval=conf['monitor']['interval'],
+                    threshold=conf['monitor']['threshold'],
+                    top=conf['monitor']['top'])
+            self.monitor.start()
+
+        if conf['metrics']['enabled']:
+            self.metrics = ChatMetrics(self,
+                    max_series=conf['metrics']['max_series'])
+            self._metrics_server = MetricsServer(self.metrics,
+                    conf['metrics']['host'], conf['metrics']['port'])
+            asyncio.ensure_future(self._metrics_server.start())
+
+        if conf['tracing']['enabled']:
+            self.tracer = Tracer(conf['tracing']['path'],
+                    sample_rate=conf['tracing']['sample_rate'])
+
+        if conf['recorder']['enabled']:
+            self.recorder = Recorder(conf['recorder']['directory'])
+
+        if conf['datastore']['backend']:
+            self.datastore = create_datastore(loop, conf['datastore'])
+            self.datastore.start()
+
+        if conf['archive']['enabled']:
+            self.archive = Archive(loop, conf['archive']['directory'],
+                    block_size=conf['archive']['block_size'],
+                    segment_size=conf['archive']['segment_size'],
+                    flush_interval=conf['archive']['flush_interval'])
+            self.archive.start()
+
+        if conf['search']['enabled']:
+            self.search = SearchIndex(archive=self.archive)
+
+        if conf['spam']['enabled']:
+            self.spam = SpamDetector(window=conf['spam']['window'],
+                    message_limit=conf['spam']['message_limit'],
+                    duplicate_limit=conf['spam']['duplicate_limit'],
+                    duplicate_similarity=conf['spam']['duplicate_similarity'],
+                    raid_window=conf['spam']['raid_window'],
+                    raid_limit=conf['spam']['raid_limit'],
+                    max_keys=conf['spam']['max_keys'])
+
+        if conf['stats']['enabled']:
+            self.stats = ActivityStats(max_active=conf['stats']['max_active'],
+                    top_size=conf['stats']['top_size'])
+
+        if conf['identity']['enabled']:
+            self.identity = IdentityGraph(ttl=conf['identity']['ttl'],
+                    max_keys=conf['identity']['max_keys'],
+                    link_ip=conf['identity']['link_ip'])
+
+        if conf['wordfilter']['path']:
+            self.wordfilter = WordFilter(path=conf['wordfilter']['path'])
+
+        if conf['persistence']['enabled']:
+            self.state_store = StateStore(loop,
+                    conf['persistence']['directory'])
+
+        if conf['bus']['enabled']:
+            self.bus = BusClient(self, loop, conf['bus']['path'],
+                    timeout=conf['bus']['timeout'])
+
         asyncio.ensure_future(self.onInit())
 
 
@@ -57,6 +176,10 @@ class Manager(object):
         @rtype: str
         @return: the server's hostname
         """
+        port = conf['servers']['chatroom_port']
+        if conf['servers']['chatroom_host']:
+            return (conf['servers']['chatroom_host'], port)
+
         specials = {
             'mitvcanal': 56,
             'animeultimacom': 34,
@@ -177,7 +300,6 @@ class Manager(object):
                     break
 
         host = 's%s.chatango.com' % sn
-        port = conf['servers']['chatroom_port']
         return (host, port)
 
 
@@ -193,6 +315,26 @@ class Manager(object):
         return (host, port)
 
 
+    @property
+    def process_pool(self):
+        """The process pool used for cpu_bound handlers, created on demand."""
+        if self._process_pool is None:
+            self._process_pool = create_process_pool(
+                    conf['executor']['processes'])
+        return self._process_pool
+
+
+    @property
+    def thread_bridge(self):
+        """The thread pool used for blocking handlers, created on demand."""
+        if self._thread_bridge is None:
+            self._thread_bridge = ThreadBridge(self._loop,
+                    max_workers=conf['executor']['threads'],
+                    queue_size=conf['executor']['thread_queue_size'],
+                    when_full=conf['executor']['thread_queue_full'])
+        return self._thread_bridge
+
+
     def get_user_credentials(self):
         username = conf['authentication']['username']
         password = conf['authentication']['password']
@@ -200,12 +342,14 @@ class Manager(object):
 
 
     @asyncio.coroutine
-    def joinRoom(self, room_name):
+    def joinRoom(self, room_name, shadow=False):
         """
         Join a room or return None if already joined.
 
         @type room: str
         @param room: room to join
+        @type shadow: bool
+        @param shadow: do not dispatch events, see migrateRoom
 
         @rtype: Room or None
         @return: True or nothing
@@ -214,7 +358,15 @@ class Manager(object):
         room = self.rooms.get(room_name)
         if room is None:
             room = self.room_class(name=room_name, loop=self._loop, mgr=self)
+            room.shadow = shadow
             self.rooms[room_name] = room
+            if self.bus is not None and not shadow:
+                self.bus.joined(room_name)
+
+            if self.state_store is not None and not shadow:
+                state = self.state_store.load(room_name)
+                if state is not None:
+                    room.import_state(state)
 
         if not room.connected:
             yield from room.connect()
@@ -232,9 +384,72 @@ class Manager(object):
         """
         try:
             room = self.rooms.pop(room_name.lower())
-            yield from room.disconnect()
         except KeyError:
-            pass
+            return
+
+        if self.bus is not None:
+            self.bus.left(room.name)
+        if self.state_store is not None:
+            yield from self.state_store.save_all([room])
+        if self.search is not None:
+            self.search.remove_room(room.name)
+        if self.spam is not None:
+            self.spam.forget(room.name)
+        if self.identity is not None:
+            self.identity.forget(room.name)
+        if self.stats is not None:
+            self.stats.forget(room.name)
+        # timers of the room would fire once it is gone
+        self.flushCoalesced(room)
+        batch = self._message_batches.get(room)
+        if batch is not None:
+            self._flush_messages(room, batch)
+        yield from room.disconnect()
+        if self.recorder is not None:
+            self.recorder.forget(room)
+
+
+    @asyncio.coroutine
+    def migrateRoom(self, room_name, timeout=30.0):
+        """
+        Take a room over from the worker which joined it, without a gap.
+
+        The room is joined in shadow mode, once its history was received the
+        other worker hands its state over through the bus and stops
+        dispatching events. Messages both workers have seen are
+        de-duplicated by msgid, the other worker leaves the room once this
+        one is registered as its owner.
+
+        @type room_name: str
+        @param room_name: room to take over
+        @type timeout: float
+        @param timeout: seconds to wait for the connection
+
+        @rtype: Room
+        @return: the room
+        """
+        if self.bus is None:
+            room = yield from self.joinRoom(room_name)
+            return room
+
+        room_name = room_name.lower()
+        room = yield from self.joinRoom(room_name, shadow=True)
+
+        deadline = self._loop.time() + timeout
+        while room.connected and not room.inited and\
+                self._loop.time() < deadline:
+            yield from asyncio.sleep(0.1)
+
+        handled = set()
+        try:
+            state = yield from self.bus.handoff(room_name)
+            handled = room.import_state(state)
+        except BusError as e:
+            self._log.info('Joining %s without handoff: %s', room_name, e)
+
+        room.activate(handled)
+        self.bus.joined(room_name)
+        return room
 
 
     def getRoom(self, room_name):
@@ -257,6 +472,17 @@ class Manager(object):
             except AttributeError:
                 self._future = asyncio.Future()
 
+        if self.bus is not None:
+            self.bus.start()
+
+        if self.state_store is not None and self._snapshot_task is None:
+            self._snapshot_task = asyncio.ensure_future(self._save_states())
+
+        if self.wordfilter is not None and self._wordfilter_task is None:
+            interval = conf['wordfilter']['reload_interval']
+            self._wordfilter_task = asyncio.ensure_future(
+                    self.wordfilter.watch(interval))
+
         if isinstance(self.pm, self.pm_class):
             asyncio.ensure_future(self.pm.connect()) # pylint:disable=no-value-for-parameter
 
@@ -269,7 +495,13 @@ class Manager(object):
 
 
     def disconnect(self):
+        self.flushMessages()
+        self.flushCoalesced()
+
         tasks = []
+        if self.state_store is not None:
+            tasks.append(asyncio.ensure_future(self.state_store.save_all(
+                    list(self.rooms.values()))))
         if self.pm:
             future = self.pm.disconnect()
             if future is not None:
@@ -280,14 +512,311 @@ class Manager(object):
             if future is not None:
                 tasks.append(future)
 
+        if self.datastore is not None:
+            tasks.append(asyncio.ensure_future(self.datastore.flush()))
+        if self.archive is not None:
+            tasks.append(asyncio.ensure_future(self.archive.flush()))
+
         future = asyncio.gather(*tasks, loop=self._loop, return_exceptions=True)
         future.add_done_callback(self._future.set_result)
+        future.add_done_callback(self._on_disconnected)
 
         result = self._future
         self._future = None
         return result
 
 
+    def _on_disconnected(self, future=None):
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        if self.tracer is not None:
+            self.tracer.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.bus is not None:
+            self.bus.close()
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        if self.state_store is not None:
+            self.state_store.close()
+        if self._wordfilter_task is not None:
+            self._wordfilter_task.cancel()
+            self._wordfilter_task = None
+        if self.datastore is not None:
+            self.datastore.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+            self._process_pool = None
+        if self._thread_bridge is not None:
+            self._thread_bridge.shutdown()
+            self._thread_bridge = None
+
+
+    @asyncio.coroutine
+    def _save_states(self):
+        interval = conf['persistence']['interval']
+        while True:
+            yield from asyncio.sleep(interval)
+            yield from self.state_store.save_all(list(self.rooms.values()))
+
+
+    def container_sizes(self):
+        """
+        Sizes of the internal containers of the Manager, its rooms and pm.
+
+        @rtype: dict
+        @return: flat dictionary, keys like "room.<name>.history"
+        """
+        users = user_module._users # pylint:disable=protected-access
+        sizes = {
+            'rooms': len(self.rooms),
+            'users': len(users),
+            'users.msgs': sum(len(user._msgs) for user in users.values()), # pylint:disable=protected-access
+            'users.sids': sum(len(user._sids) for user in users.values()), # pylint:disable=protected-access
+        }
+        for room in self.rooms.values():
+            for key, size in room.container_sizes().items():
+                sizes['room.%s.%s' % (room.name, key)] = size
+
+        if self.pm is not None:
+            for key, size in self.pm.container_sizes().items():
+                sizes['pm.' + key] = size
+
+        return sizes
+
+
+    def dispatch_event(self, channel, name, *args, **kwargs):
+        """
+        Schedule the handler of an event, and onEventCalled.
+
+        @type channel: BaseChannel
+        @param channel: room or pm where the event occured
+        @type name: str
+        @param name: name of the handler, for example "onMessage"
+        """
+        window = conf['coalesce'].get(name)
+        if window and name in self.coalesced_events:
+            if kwargs:
+                raise TypeError('Coalesced event %s takes no keyword '
+                        'arguments.' % name)
+            key = (channel, name)
+            held = self._coalesced.get(key)
+            if held is None:
+                handle = self._loop.call_later(window, self._flush_coalesced,
+                        key)
+                held = self._coalesced[key] = (handle, [])
+            held[1].append(args)
+            return
+
+        self._dispatch_event(channel, name, *args, **kwargs)
+
+
+    def _flush_coalesced(self, key):
+        held = self._coalesced.pop(key, None)
+        if held is None:
+            return
+        handle, pending = held
+        handle.cancel()
+
+        channel, name = key
+        mode, batch_name = self.coalesced_events[name]
+        if mode == COALESCE_LATEST:
+            self._dispatch_event(channel, name, *pending[-1])
+        else:
+            self._dispatch_event(channel, batch_name,
+                    [args[0] for args in pending])
+
+
+    def flushCoalesced(self, channel=None):
+        """
+        Dispatch the coalesced events held now.
+
+        @type channel: BaseChannel
+        @param channel: events of this room or pm only, None for all
+        """
+        for key in list(self._coalesced):
+            if channel is None or key[0] is channel:
+                self._flush_coalesced(key)
+
+
+    def batchMessage(self, room, message):
+        """
+        Add a message to its batch, instead of dispatching onMessage, see
+        conf['message_batch'].
+
+        @type room: Room
+        @param room: room where the message was received
+        @type message: Message
+        @param message: received message
+        """
+        key = room if conf['message_batch']['per_room'] else None
+        batch = self._message_batches.get(key)
+        if batch is None:
+            batch = self._message_batches[key] = []
+            self._loop.call_later(conf['message_batch']['interval'],
+                    self._flush_messages, key, batch)
+        batch.append(message)
+
+        if self.metrics is not None:
+            self.metrics.messages.inc(self.metrics.channel_label(room))
+
+        if len(batch) >= conf['message_batch']['size']:
+            self._flush_messages(key, batch)
+
+
+    def _flush_messages(self, key, batch):
+        # flushed already, by size
+        if self._message_batches.get(key) is not batch:
+            return
+        del self._message_batches[key]
+        self._dispatch_event(key, 'onMessageBatch', batch)
+
+
+    def flushMessages(self):
+        """Dispatch the batches of messages now."""
+        for key, batch in list(self._message_batches.items()):
+            self._flush_messages(key, batch)
+
+
+    def _dispatch_event(self, channel, name, *args, **kwargs):
+        handler = getattr(self, name)
+        executor = getattr(handler, 'executor', None)
+        if executor == EXECUTOR_PROCESS:
+            coro = self._call_in_process(channel, name, handler, args, kwargs)
+        elif executor == EXECUTOR_THREAD:
+            coro = self._call_in_thread(channel, name, handler, args, kwargs)
+        else:
+            coro = handler(channel, *args, **kwargs)
+            if self.monitor is not None:
+                coro = self.monitor.timed(name, coro)
+
+        if self.tracer is not None:
+            coro = self.tracer.traced(name, coro)
+
+        task = asyncio.ensure_future(coro)
+
+        if self.metrics is not None:
+            self.metrics.event(channel, name)
+            started = self._loop.time()
+            task.add_done_callback(lambda _: self.metrics.handler_done(name,
+                    self._loop.time() - started))
+
+        asyncio.ensure_future(self.onEventCalled(channel, name, *args,
+                **kwargs))
+
+
+    @asyncio.coroutine
+    def _call_in_process(self, channel, name, handler, args, kwargs):
+        if ismethod(handler):
+            self._log.error('cpu_bound handler %s must be a staticmethod.',
+                    name)
+            return
+
+        try:
+            result = yield from run_in_process(self._loop, self.process_pool,
+                    handler, channel, *args, **kwargs)
+        except Exception: # pylint:disable=broad-except
+            self._log.exception('cpu_bound handler %s failed.', name)
+            return
+
+        result_name = name + 'Result'
+        if hasattr(self, result_name):
+            self.dispatch_event(channel, result_name, *args, result=result,
+                    **kwargs)
+
+
+    @asyncio.coroutine
+    def _call_in_thread(self, channel, name, handler, args, kwargs):
+        # messages and users reach the room, they must not leave the loop
+        args = [snapshot(arg) for arg in args]
+        kwargs = {key: snapshot(val) for key, val in kwargs.items()}
+        try:
+            yield from self.thread_bridge.submit(name, handler,
+                    LoopProxy(channel, self._loop), *args, **kwargs)
+        except QueueFull:
+            self._log.warning('Thread pool is full, dropped %s.', name)
+        except Exception: # pylint:disable=broad-except
+            self._log.exception('blocking handler %s failed.', name)
+
+
+    def call_threadsafe(self, func, *args, **kwargs):
+        """
+        Call a function on the event loop, from a blocking handler.
+
+        @rtype: concurrent.futures.Future
+        @return: the function's result, coroutines are awaited on the loop
+        """
+        return call_threadsafe(self._loop, func, *args, **kwargs)
+
+
+    def handler_latency(self):
+        """
+        Latency report of blocking handlers.
+
+        @rtype: dict
+        @return: handler name to count, errors, dropped, wait and run times
+        """
+        if self._thread_bridge is None:
+            return {}
+        return {name: stats.as_dict() for name, stats in\
+                self._thread_bridge.stats.items()}
+
+
+    def loop_stats(self):
+        """
+        Event loop lag and time spent in parsers and handlers.
+
+        @rtype: dict or None
+        @return: see LoopMonitor.stats, None if monitor.enabled is off
+        """
+        if self.monitor is None:
+            return None
+        return self.monitor.stats()
+
+
+    @asyncio.coroutine
+    def request(self, room_name, command, *args):
+        """
+        Run a command on a room joined by any worker of the supervisor.
+
+        @type room_name: str
+        @param room_name: room
+        @type command: str
+        @param command: see BusClient.COMMANDS, for example "message" or "ban"
+
+        @return: the command's result
+        @raise BusError: failed, timed out, or no worker joined the room
+        """
+        if self.bus is None:
+            raise BusError('bus.enabled is off')
+
+        result = yield from self.bus.request(room_name, command, *args)
+        return result
+
+
+    @asyncio.coroutine
+    def run_in_process(self, func, *args, **kwargs):
+        """
+        Run a CPU-bound function in the process pool.
+
+        Message, User and Room arguments are replaced by their snapshots.
+
+        @type func: callable
+        @param func: picklable function, see executor.cpu_bound
+
+        @return: the function's return value
+        """
+        result = yield from run_in_process(self._loop, self.process_pool,
+                func, *args, **kwargs)
+
+        return result
+
+
     ## Commands
 
 
@@ -523,6 +1052,77 @@ class Manager(object):
         pass
 
 
+    @asyncio.coroutine
+    def onWordMatch(self, room, user, message, match):
+        """
+        Called after onMessage when a message contains a word of the word
+        list, see conf['wordfilter'].
+
+        @type room: Room
+        @param room: room where the event occured
+        @type user: User
+        @param user: owner of message
+        @type message: Message
+        @param message: received message
+        @type match: wordfilter.Match
+        @param match: the first word found, and its position in the body
+        """
+        pass
+
+
+    @asyncio.coroutine
+    def onSpamDetected(self, room, user, message, detection):
+        """
+        Called after onMessage when a flood, copies or a raid are detected,
+        see conf['spam'], the configured action is taken already.
+
+        @type room: Room
+        @param room: room where the event occured
+        @type user: User
+        @param user: sender of the message, None for a raid
+        @type message: Message
+        @param message: the message detected, None for a raid
+        @type detection: spam.Detection
+        @param detection: what was detected
+        """
+        pass
+
+
+    @asyncio.coroutine
+    def onBanEvasion(self, room, user, message, banned):
+        """
+        Called after onMessage when the sender shares a unid, ip or puid,
+        directly or through other names, with users banned from the room,
+        see conf['identity'], the configured action is taken already.
+
+        @type room: Room
+        @param room: room where the event occured
+        @type user: User
+        @param user: owner of message
+        @type message: Message
+        @param message: received message
+        @type banned: list of User
+        @param banned: the banned users linked
+        """
+        pass
+
+
+    @asyncio.coroutine
+    def onMessageBatch(self, room, messages):
+        """
+        Called instead of onMessage when messages are batched, see
+        conf['message_batch'], with up to size messages received within
+        interval seconds.
+
+        @type room: Room
+        @param room: room where the messages were received, None when
+        batches are not per room, see Message.room
+        @type messages: list of Message
+        @param messages: received messages, oldest first
+        """
+        pass
+
+
     @asyncio.coroutine
     def onHistoryMessage(self, room, user, message):
         """
@@ -564,6 +1164,34 @@ class Manager(object):
         pass
 
 
+    @asyncio.coroutine
+    def onJoinBatch(self, room, users):
+        """
+        Called instead of onJoin when it is coalesced, see
+        conf['coalesce'], once per window with every user that joined.
+
+        @type room: Room
+        @param room: room where the event occured
+        @type users: list of User
+        @param users: users that joined, in order, maybe more than once
+        """
+        pass
+
+
+    @asyncio.coroutine
+    def onLeaveBatch(self, room, users):
+        """
+        Called instead of onLeave when it is coalesced, see
+        conf['coalesce'], once per window with every user that left.
+
+        @type room: Room
+        @param room: room where the event occured
+        @type users: list of User
+        @param users: users that left, in order, maybe more than once
+        """
+        pass
+
+
     @asyncio.coroutine
     def onRaw(self, room, raw):
         """
@@ -591,7 +1219,8 @@ class Manager(object):
     @asyncio.coroutine
     def onUserCountChange(self, room):
         """
-        Called when the user count changes.
+        Called when the user count changes, at most once per window when
+        coalesced, see conf['coalesce'].
 
         @type room: Room
         @param room: room where the event occured
@@ -838,6 +1467,20 @@ class Manager(object):
         pass
 
 
+    @asyncio.coroutine
+    def onBusEvent(self, room, topic, data):
+        """
+        Called when another worker published an event on the bus.
+
+        @type room: None
+        @param room: always None
+        @type topic: str
+        @param topic: the event
+        @param data: value published with it
+        """
+        pass
+
+
     @asyncio.coroutine
     def onUserList(self, room, user_list):
         """
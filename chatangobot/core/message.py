@@ -1,3 +1,10 @@
+from collections import namedtuple
+
+MessageSnapshot = namedtuple('MessageSnapshot', ['msgid', 'time', 'user',
+        'body', 'room', 'raw', 'ip', 'unid', 'nameColor', 'fontSize',
+        'fontFace', 'fontColor'])
+
+
 class Message(object):
     """Class that represents a message."""
 
@@ -13,6 +20,7 @@ class Message(object):
     fontSize = 12
     fontFace = '0'
     fontColor = '000'
+    trace = None
 
     @property
     def id(self):
@@ -44,6 +52,21 @@ class Message(object):
         self.room.deleteMessage(self)
 
 
+    def snapshot(self):
+        """
+        Picklable copy of the Message, for use in other processes.
+
+        @rtype: MessageSnapshot
+        @return: the user is a UserSnapshot and the room is its name
+        """
+        return MessageSnapshot(msgid=self.msgid, time=self.time,
+                user=self.user.snapshot() if self.user else None,
+                body=self.body, room=self.room.name if self.room else None,
+                raw=self.raw, ip=self.ip, unid=self.unid,
+                nameColor=self.nameColor, fontSize=self.fontSize,
+                fontFace=self.fontFace, fontColor=self.fontColor)
+
+
     def __init__(self, **kw):
         for attr, val in kw.items():
             if val is not None:
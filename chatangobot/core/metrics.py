@@ -0,0 +1,367 @@
+"""Prometheus compatible metrics of rooms, pm and connections."""
+
+import asyncio
+from logging import getLogger
+
+from . import user as user_module
+from .monitor import DEFAULT_BUCKETS, Histogram
+from .settings import conf
+
+OVERFLOW_LABEL = '_other'
+# headers of a scrape request, more are refused
+MAX_HEADERS = 100
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n')\
+            .replace('"', r'\"')
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value))\
+            for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    """
+    A family of time series sharing a name.
+
+    Label values are bounded, once `max_series` series exist new label
+    values are folded into a single "_other" series.
+    """
+
+    kind = None
+
+    name = None
+    help = None
+    labelnames = None
+    max_series = 0
+
+    _series = None
+
+    def __init__(self, name, help_text, labelnames=(), max_series=200):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._series = {}
+
+
+    def _new_series(self):
+        raise NotImplementedError()
+
+
+    def labels(self, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            if len(self._series) >= self.max_series:
+                labels = (OVERFLOW_LABEL,) * len(labels)
+                series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = self._new_series()
+        return series
+
+
+    def clear(self):
+        self._series.clear()
+
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s %s' % (self.name, self.kind)]
+
+        for labels, series in sorted(self._series.items()):
+            lines.extend(self._render_series(labels, series))
+        return lines
+
+
+    def _render_series(self, labels, series):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames,
+                labels), _format_value(series[0]))]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def _new_series(self):
+        return [0]
+
+
+    def inc(self, *labels, amount=1):
+        self.labels(*labels)[0] += amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def _new_series(self):
+        return [0]
+
+
+    def set(self, value, *labels):
+        self.labels(*labels)[0] = value
+
+
+class HistogramMetric(Metric):
+
+    kind = 'histogram'
+
+    buckets = DEFAULT_BUCKETS
+
+    def _new_series(self):
+        return Histogram(self.buckets)
+
+
+    def observe(self, value, *labels):
+        self.labels(*labels).observe(value)
+
+
+    def _render_series(self, labels, series):
+        lines = []
+        for bound, count in series.cumulative():
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(
+                    self.labelnames, labels, ('le', _format_value(bound))),
+                    count))
+
+        label_text = _format_labels(self.labelnames, labels)
+        lines.append('%s_sum%s %s' % (self.name, label_text,
+                _format_value(series.total)))
+        lines.append('%s_count%s %s' % (self.name, label_text, series.count))
+        return lines
+
+
+class ChatMetrics(object):
+    """
+    Metrics of a Manager and its channels.
+
+    Channels report frames and bytes, the Manager reports dispatched events
+    and handler latency. Sizes of internal containers are collected when
+    scraped.
+    """
+
+    # event name to (metric attribute, extra label)
+    EVENT_METRICS = {
+        'onMessage': ('messages', None),
+        'onReconnect': ('reconnects', None),
+        'onConnectFail': ('connect_failures', None),
+        'onLoginFail': ('connect_failures', None),
+        'onFloodWarning': ('flood_warnings', 'warning'),
+        'onFloodBan': ('flood_warnings', 'ban'),
+        'onFloodBanRepeat': ('flood_warnings', 'ban_repeat'),
+        'onBan': ('bans', None),
+        'onUnban': ('unbans', None),
+    }
+
+    mgr = None
+
+    _metrics = None
+
+    def __init__(self, mgr, max_series=200):
+        self.mgr = mgr
+        self._metrics = []
+
+        def add(metric):
+            self._metrics.append(metric)
+            return metric
+
+        self.frames_in = add(Counter('chatango_frames_received_total',
+                'Frames received by command.', ('channel', 'command'),
+                max_series))
+        self.bytes_in = add(Counter('chatango_bytes_received_total',
+                'Bytes received by command.', ('channel', 'command'),
+                max_series))
+        self.frames_out = add(Counter('chatango_frames_sent_total',
+                'Frames sent by command.', ('channel', 'command'),
+                max_series))
+        self.bytes_out = add(Counter('chatango_bytes_sent_total',
+                'Bytes sent by command.', ('channel', 'command'), max_series))
+        self.messages = add(Counter('chatango_messages_total',
+                'Messages received by room.', ('channel',), max_series))
+        self.reconnects = add(Counter('chatango_reconnects_total',
+                'Reconnections by channel.', ('channel',), max_series))
+        self.connect_failures = add(Counter(
+                'chatango_connect_failures_total',
+                'Failed connections or logins by channel.', ('channel',),
+                max_series))
+        self.flood_warnings = add(Counter('chatango_flood_warnings_total',
+                'Flood warnings and bans by channel.', ('channel', 'kind'),
+                max_series))
+        self.bans = add(Counter('chatango_bans_total',
+                'Ban events by room.', ('channel',), max_series))
+        self.unbans = add(Counter('chatango_unbans_total',
+                'Unban events by room.', ('channel',), max_series))
+        self.events = add(Counter('chatango_events_total',
+                'Dispatched events by name.', ('event',), max_series))
+        self.handler_seconds = add(HistogramMetric(
+                'chatango_handler_seconds',
+                'Time from dispatch to completion of event handlers.',
+                ('handler',), max_series))
+        self.bus_seconds = add(HistogramMetric('chatango_bus_request_seconds',
+                'Round trip of bus requests by command.', ('command',),
+                max_series))
+        self.history_size = add(Gauge('chatango_history_size',
+                'Messages kept in room history.', ('channel',), max_series))
+        self.userlist_size = add(Gauge('chatango_userlist_size',
+                'Entries in room userlist.', ('channel',), max_series))
+        self.users = add(Gauge('chatango_users',
+                'Users in the User registry.'))
+        self.rooms = add(Gauge('chatango_rooms', 'Joined rooms.'))
+
+
+    @staticmethod
+    def channel_label(channel):
+        if channel.name is None:
+            return type(channel).__name__.lower()
+        return channel.name
+
+
+    def frame_received(self, channel, command, size):
+        label = self.channel_label(channel)
+        self.frames_in.inc(label, command)
+        self.bytes_in.inc(label, command, amount=size)
+
+
+    def frame_sent(self, channel, command, size):
+        label = self.channel_label(channel)
+        self.frames_out.inc(label, command)
+        self.bytes_out.inc(label, command, amount=size)
+
+
+    def event(self, channel, name):
+        self.events.inc(name)
+        try:
+            attr, extra = self.EVENT_METRICS[name]
+        except KeyError:
+            return
+
+        if extra is None:
+            getattr(self, attr).inc(self.channel_label(channel))
+        else:
+            getattr(self, attr).inc(self.channel_label(channel), extra)
+
+
+    def connect_failed(self, channel):
+        self.connect_failures.inc(self.channel_label(channel))
+
+
+    def handler_done(self, name, duration):
+        self.handler_seconds.observe(duration, name)
+
+
+    def bus_request(self, command, duration):
+        self.bus_seconds.observe(duration, command)
+
+
+    def collect(self):
+        """Update gauges from the Manager's containers."""
+        self.history_size.clear()
+        self.userlist_size.clear()
+        for room in self.mgr.rooms.values():
+            self.history_size.set(len(room._history), room.name) # pylint:disable=protected-access
+            self.userlist_size.set(len(room._userlist), room.name) # pylint:disable=protected-access
+
+        self.users.set(len(user_module._users)) # pylint:disable=protected-access
+        self.rooms.set(len(self.mgr.rooms))
+
+
+    def render(self):
+        """
+        Metrics in Prometheus text exposition format.
+
+        @rtype: str
+        """
+        self.collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """Minimal HTTP server answering every GET with the metrics."""
+
+    metrics = None
+    host = None
+    port = None
+
+    _log = None
+    _server = None
+
+    def __init__(self, metrics, host, port):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._log = getLogger(type(self).__name__)
+
+
+    @asyncio.coroutine
+    def start(self):
+        self._server = yield from asyncio.start_server(self._handle,
+                self.host, self.port)
+
+        self._log.info('Serving metrics on %s:%i', self.host, self.port)
+
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+
+    @asyncio.coroutine
+    def _read_request(self, reader):
+        """Request line, headers are skipped, None if there are too many."""
+        request = yield from reader.readline()
+        for _ in range(MAX_HEADERS + 1):
+            line = yield from reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return request
+        return None
+
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        try:
+            try:
+                request = yield from asyncio.wait_for(
+                        self._read_request(reader),
+                        conf['connection']['timeout'])
+            except (asyncio.TimeoutError, ValueError):
+                # silent client, or a line over the limit of the reader
+                return
+
+            if request is None:
+                status = '431 Request Header Fields Too Large'
+                body = b''
+            elif request.split(b' ', 1)[0] == b'GET':
+                status = '200 OK'
+                body = self.metrics.render().encode('utf-8')
+            else:
+                status = '405 Method Not Allowed'
+                body = b''
+
+            writer.write(('HTTP/1.0 %s\r\n'
+                    'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                    'Content-Length: %i\r\n\r\n' % (status, len(body)))\
+                    .encode('ascii') + body)
+
+            yield from writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,199 @@
+"""Event loop lag and slow callback instrumentation."""
+
+import asyncio
+from bisect import bisect_left
+from logging import getLogger
+from time import perf_counter
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0)
+
+
+class Histogram(object):
+    """Fixed buckets histogram of durations."""
+
+    buckets = None
+    counts = None
+    count = 0
+    total = 0.0
+    max = 0.0
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def cumulative(self):
+        """
+        Cumulative bucket counts.
+
+        @rtype: list of (float, int)
+        @return: upper bound and the count of values below it
+        """
+        result = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'buckets': self.cumulative(),
+        }
+
+
+class LoopMonitor(object):
+    """
+    Measures event loop lag and the time spent inside parsers and handlers.
+
+    A periodic tick sleeps for `interval` seconds, the extra time it took to
+    wake up is the loop lag. Coroutines run through `timed` are attributed
+    the time spent running their steps, time spent waiting is not counted.
+    """
+
+    interval = 1.0
+    threshold = 0.1
+    top = 5
+
+    lag = None
+    timings = None
+
+    _loop = None
+    _log = None
+    _task = None
+    _recent = None
+    _slow = None
+
+    def __init__(self, loop, interval=1.0, threshold=0.1, top=5):
+        self.interval = interval
+        self.threshold = threshold
+        self.top = top
+
+        self.lag = Histogram()
+        self.timings = {}
+
+        self._loop = loop
+        self._log = getLogger(type(self).__name__)
+        self._recent = {}
+        self._slow = {}
+
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._tick())
+
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+    @asyncio.coroutine
+    def _tick(self):
+        while True:
+            expected = self._loop.time() + self.interval
+            yield from asyncio.sleep(self.interval)
+            lag = max(0.0, self._loop.time() - expected)
+            self.lag.observe(lag)
+
+            if lag > self.threshold:
+                self._log.warning('Event loop lagged %.3fs, top offenders: %s',
+                        lag, ', '.join('%s %.3fs' % item for item in\
+                        self.top_offenders()) or 'none')
+
+            self._recent.clear()
+
+
+    def record(self, name, duration):
+        """
+        Record time spent on the event loop.
+
+        @type name: str
+        @param name: parser or handler name
+        @type duration: float
+        @param duration: in seconds
+        """
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = Histogram()
+        timing.observe(duration)
+
+        self._recent[name] = self._recent.get(name, 0.0) + duration
+        if duration > self.threshold:
+            self._slow[name] = self._slow.get(name, 0) + 1
+
+
+    def top_offenders(self):
+        """
+        Names that spent the most time on the event loop since the last tick.
+
+        @rtype: list of (str, float)
+        """
+        return sorted(self._recent.items(), key=lambda item: item[1],
+                reverse=True)[:self.top]
+
+
+    @asyncio.coroutine
+    def timed(self, name, coro):
+        """
+        Run a coroutine, recording the time spent running it.
+
+        @type name: str
+        @param name: parser or handler name
+        """
+        busy = 0.0
+        value = None
+        error = None
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    if error is None:
+                        future = coro.send(value)
+                    else:
+                        future = coro.throw(error)
+                except StopIteration as e:
+                    return e.value
+                finally:
+                    busy += perf_counter() - start
+
+                value, error = None, None
+                try:
+                    value = yield future
+                except BaseException as e: # pylint:disable=broad-except
+                    error = e
+        finally:
+            self.record(name, busy)
+
+
+    def stats(self):
+        """
+        Loop lag and per-name timings.
+
+        @rtype: dict
+        @return: "lag" and "timings" histograms, and "slow" counts of runs
+            above the threshold
+        """
+        return {
+            'lag': self.lag.as_dict(),
+            'timings': {name: timing.as_dict() for name, timing in\
+                    self.timings.items()},
+            'slow': dict(self._slow),
+        }
@@ -0,0 +1,126 @@
+"""Room state snapshots, to restart without losing history and banlists.
+
+Every room is saved to its own file, "<name>.state", a magic number followed
+by the zlib compressed Room.export_state, encoded with bus.encode. Files are
+replaced atomically, a crash while saving leaves the previous snapshot.
+
+States are exported on the event loop, then encoded, compressed and written
+by a thread of the store.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+from hashlib import md5
+from logging import getLogger
+import zlib
+
+from .bus import decode, encode
+
+MAGIC = b'CBS1'
+
+
+class StateStore(object):
+    """Saves and loads room snapshots in a directory."""
+
+    directory = None
+
+    _loop = None
+    _log = None
+    _executor = None
+    _digests = None
+
+    def __init__(self, loop, directory):
+        self.directory = directory
+        self._loop = loop
+        self._log = getLogger(type(self).__name__)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # room name to digest of the last saved snapshot
+        self._digests = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+
+    def path(self, room_name):
+        return os.path.join(self.directory, room_name + '.state')
+
+
+    @asyncio.coroutine
+    def save(self, room):
+        """
+        Save a room, unless it did not change since the last save.
+
+        @rtype: bool
+        @return: whether the file was written
+        """
+        written = yield from self._loop.run_in_executor(self._executor,
+                self._write, room.name, room.export_state())
+        return written
+
+
+    def _write(self, room_name, state):
+        data = MAGIC + zlib.compress(encode(state))
+        digest = md5(data).digest()
+        if self._digests.get(room_name) == digest:
+            return False
+
+        path = self.path(room_name)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        self._digests[room_name] = digest
+        return True
+
+
+    @asyncio.coroutine
+    def save_all(self, rooms):
+        """
+        Save rooms, skipping the ones in shadow mode, owned by another worker.
+
+        @rtype: int
+        @return: number of files written
+        """
+        written = 0
+        for room in list(rooms):
+            if room.shadow:
+                continue
+            try:
+                written += yield from self.save(room)
+            except OSError:
+                self._log.exception('Cannot save the state of %s', room.name)
+        return written
+
+
+    def close(self):
+        """Stop the thread, once the pending saves are written."""
+        self._executor.shutdown(wait=False)
+
+
+    def load(self, room_name):
+        """
+        Load the snapshot of a room.
+
+        @rtype: dict or None
+        @return: see Room.export_state, None if missing or unreadable
+        """
+        try:
+            with open(self.path(room_name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError:
+            self._log.exception('Cannot read the state of %s', room_name)
+            return None
+
+        try:
+            if not data.startswith(MAGIC):
+                raise ValueError('bad magic number')
+            state = decode(zlib.decompress(data[len(MAGIC):]))
+        except (ValueError, IndexError, zlib.error) as e:
+            self._log.warning('Ignoring the state of %s: %s', room_name, e)
+            return None
+
+        self._digests[room_name] = md5(data).digest()
+        return state
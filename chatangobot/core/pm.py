@@ -1,9 +1,9 @@
 import asyncio
-from time import time
 import aiohttp
 import async_timeout
 
 from .channel import BaseChannel
+from .clock import time
 from .settings import conf
 
 class PM(BaseChannel):
@@ -31,6 +31,19 @@ class PM(BaseChannel):
         return self.mgr.get_pm_host()
 
 
+    def container_sizes(self):
+        """
+        Sizes of the internal containers, to watch memory usage.
+
+        @rtype: dict
+        """
+        return {
+            'contacts': len(self.contacts),
+            'blocklist': len(self.blocklist),
+            'status': len(self._status),
+        }
+
+
     def _disconnect(self):
         self._call_event('onPMDisconnect')
 
@@ -73,7 +86,7 @@ class PM(BaseChannel):
         session = aiohttp.ClientSession(loop=self._loop)
         try:
             with async_timeout.timeout(conf['connection']['timeout']):
-                resp = yield from session.post('https://chatango.com/login',
+                resp = yield from session.post(conf['servers']['login_url'],
                         data=payload)
 
                 token = resp.cookies['auth.chatango.com'].value
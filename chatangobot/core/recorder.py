@@ -0,0 +1,211 @@
+"""Record and replay raw Chatango traffic.
+
+Every channel gets its own append-only capture file, a sequence of records:
+
+    time (float64), direction (b'I' or b'O'), size (uint32), data
+
+Inbound records are the chunks given to data_received, unsplit, so replaying
+them also exercises frame splitting. Outbound records are the frames written
+by _send_command.
+"""
+
+import asyncio
+import os
+import struct
+from logging import getLogger
+
+from .clock import time
+
+RECORD_IN = b'I'
+RECORD_OUT = b'O'
+
+HEADER = struct.Struct('<dcI')
+
+
+def capture_name(channel):
+    """Capture file name of a channel, "room-<name>.rec" or "pm.rec"."""
+    kind = type(channel).__name__.lower()
+    if channel.name is None:
+        return kind + '.rec'
+    return '%s-%s.rec' % (kind, channel.name)
+
+
+def read_records(path):
+    """
+    Read a capture file.
+
+    A truncated last record, from a crashed recorder, is ignored.
+
+    @rtype: iterator of (float, bytes, bytes)
+    @return: time, direction and data of each record
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+
+            timestamp, direction, size = HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+
+            yield timestamp, direction, data
+
+
+class Recorder(object):
+    """Writes the traffic of every channel to capture files."""
+
+    directory = None
+
+    _files = None
+    _log = None
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = {}
+        self._log = getLogger(type(self).__name__)
+
+        os.makedirs(directory, exist_ok=True)
+
+
+    def _get_file(self, channel):
+        f = self._files.get(channel)
+        if f is None:
+            path = os.path.join(self.directory, capture_name(channel))
+            f = self._files[channel] = open(path, 'ab')
+        return f
+
+
+    def record(self, channel, direction, data):
+        """
+        Append a record.
+
+        @type direction: bytes
+        @param direction: RECORD_IN or RECORD_OUT
+        @type data: bytes
+        @param data: raw traffic
+        """
+        try:
+            f = self._get_file(channel)
+            f.write(HEADER.pack(time(), direction, len(data)))
+            f.write(data)
+        except OSError:
+            self._log.exception('Failed to record %s', capture_name(channel))
+
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+
+
+    def forget(self, channel):
+        """
+        Close the capture file of a channel, once disconnected. A channel
+        joined again appends to the same file, through a new one.
+        """
+        f = self._files.pop(channel, None)
+        if f is not None:
+            f.close()
+
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+class FakeTransport(asyncio.Transport):
+    """Transport collecting written data instead of sending it."""
+
+    written = None
+    closed = False
+
+    def __init__(self):
+        super(FakeTransport, self).__init__()
+        self.written = []
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def close(self):
+        self.closed = True
+
+
+    def is_closing(self):
+        return self.closed
+
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class Replayer(object):
+    """
+    Feeds the inbound records of a capture file into a channel.
+
+    The channel is attached to a FakeTransport, without authenticating nor
+    pinging. With `speed` set, the original timing is reproduced (2.0 plays
+    twice as fast), otherwise records are fed as fast as possible.
+    """
+
+    channel = None
+    path = None
+    speed = None
+    transport = None
+
+    records = 0
+    size = 0
+    elapsed = 0.0
+
+    def __init__(self, channel, path, speed=None):
+        self.channel = channel
+        self.path = path
+        self.speed = speed
+        self.transport = FakeTransport()
+
+
+    @asyncio.coroutine
+    def run(self, batch=100, settle=10):
+        """
+        Replay the capture.
+
+        @type batch: int
+        @param batch: records fed between yielding to the event loop, when
+            replaying as fast as possible
+        @type settle: int
+        @param settle: event loop iterations given at the end to parsers and
+            handlers still running
+        """
+        loop = self.channel._loop # pylint:disable=protected-access
+        self.channel.connected = True
+        self.channel._conn = self.transport # pylint:disable=protected-access
+        self.channel._firstCommand = True # pylint:disable=protected-access
+
+        started = loop.time()
+        first = None
+        for timestamp, direction, data in read_records(self.path):
+            if direction != RECORD_IN:
+                continue
+
+            if self.speed:
+                if first is None:
+                    first = timestamp
+                delay = (timestamp - first) / self.speed -\
+                        (loop.time() - started)
+                if delay > 0:
+                    yield from asyncio.sleep(delay)
+
+            elif self.records % batch == 0:
+                yield from asyncio.sleep(0)
+
+            self.channel.data_received(data)
+            self.records += 1
+            self.size += len(data)
+
+        for _ in range(settle):
+            yield from asyncio.sleep(0)
+
+        self.elapsed = loop.time() - started
@@ -1,18 +1,33 @@
 import asyncio
 import random
 
-from time import time
+from collections import namedtuple
 
+from .banlist import Banlist, BanRecord, Listing
 from .channel import BaseChannel
+from .clock import time
 from .settings import conf
 
 ROOM_OWNER = 2
 ROOM_MODERATOR = 1
 
 MAX_LAST_MESSAGES = 5
+
+# bulk moderation actions and per target results, see Room.bulkModerate
+BULK_BAN = 'ban'
+BULK_CLEAR = 'clear'
+BULK_DELETE = 'delete'
+BULK_SENT = 'sent'
+BULK_NOT_FOUND = 'not found' # no message in history to act on
+BULK_DUPLICATE = 'duplicate' # covered by the command of another target
+BULK_DENIED = 'denied' # the bot is not a moderator
+BULK_DISCONNECTED = 'disconnected'
 UNICODE_WHITESPACES = (u'\u200A', u'\u200B', u'\u200C', u'\u200D', u'\u2060',
         u'\u2063', u'\uFEFF')
 
+RoomSnapshot = namedtuple('RoomSnapshot', ['kind', 'name', 'usercount',
+        'ownername', 'modnames'])
+
 
 class Struct(object):
     def __init__(self, **entries):
@@ -28,6 +43,7 @@ class Room(BaseChannel):
     owner = None
     usercount = 0
     silent = False
+    shadow = False # connected, but events are not dispatched, see activate
     mods = None
 
     _botname = None
@@ -35,11 +51,22 @@ class Room(BaseChannel):
     _userlist = None
     _banlist = None
     _unbanlist = None
+    # blocklist kind being listed to the targets seen so far
+    _banlistListing = None
     _mqueue = None
     _connectAmmount = 0
     _premium = False
     _msgs = None
     _i_log = None
+    _shadow_msgs = None
+    _floodWarnings = 0
+    # names of ban evaders to the time their ban was sent, until confirmed
+    _evasionBans = None
+
+    # history messages by user name, unid and ip
+    _userIndex = None
+    _unidIndex = None
+    _ipIndex = None
 
     _uid = None
     _aid = None
@@ -58,20 +85,43 @@ class Room(BaseChannel):
         self._history = []
         self._userlist = []
         self._msgs = {}
-        self._banlist = {}
-        self._unbanlist = {}
+        self._banlist = Banlist()
+        self._unbanlist = Banlist(maxlen=conf['banlist']['unbanlist_size'])
+        self._banlistListing = {}
         self._i_log = []
+        self._shadow_msgs = []
         self._last_messages = []
+        self._userIndex = {}
+        self._unidIndex = {}
+        self._ipIndex = {}
+        self._evasionBans = {}
 
 
     def get_server(self):
         return self.mgr.get_room_host(self.name)
 
 
+    def snapshot(self):
+        """
+        Picklable copy of the Room, for use in other processes.
+
+        @rtype: RoomSnapshot
+        """
+        return RoomSnapshot(kind=type(self).__name__, name=self.name,
+                usercount=self.usercount,
+                ownername=self.owner.name if self.owner else None,
+                modnames=self.modnames)
+
+
     def _disconnect(self):
         self._call_event('onDisconnect')
 
 
+    def _call_event(self, name, *args, **kwargs):
+        if not self.shadow:
+            super(Room, self)._call_event(name, *args, **kwargs)
+
+
     @asyncio.coroutine
     def authenticate(self):
         """Chatango authentication."""
@@ -99,6 +149,12 @@ class Room(BaseChannel):
             return self._botname
 
 
+    @property
+    def inited(self):
+        """Whether the history was received, after the first connection."""
+        return self._connectAmmount > 0
+
+
     @property
     def userlist(self):
         return self._get_userlist()
@@ -162,6 +218,136 @@ class Room(BaseChannel):
             return ul
 
 
+    def container_sizes(self):
+        """
+        Sizes of the internal containers, to watch memory usage.
+
+        @rtype: dict
+        """
+        return {
+            'history': len(self._history),
+            'userlist': len(self._userlist),
+            'msgs': len(self._msgs),
+            'mqueue': len(self._mqueue),
+            'banlist': len(self._banlist),
+            'unbanlist': len(self._unbanlist),
+            'i_log': len(self._i_log),
+            'shadow_msgs': len(self._shadow_msgs),
+            'last_messages': len(self._last_messages),
+            'mods': len(self.mods),
+        }
+
+
+    def export_state(self):
+        """
+        History, moderators and banlists, to move the room to another worker.
+
+        @rtype: dict
+        @return: plain values only, see bus.encode
+        """
+        return {
+            'name': self.name,
+            'owner': self.owner.name if self.owner else None,
+            'mods': self.modnames,
+            'history': [self._export_message(msg) for msg in self._history\
+                    if msg.msgid is not None],
+            'banlist': [self._export_record(record) for record in\
+                    self._banlist.values()],
+            'unbanlist': [self._export_record(record) for record in\
+                    self._unbanlist.values()],
+        }
+
+
+    def import_state(self, state):
+        """
+        Merge state exported by another worker, what was received from the
+        server already is kept. Messages are de-duplicated by msgid.
+
+        @type state: dict
+        @param state: see export_state
+
+        @rtype: set of str
+        @return: ids of the messages in the state
+        """
+        if self.owner is None and state['owner']:
+            self.owner = self.user_class.create(state['owner'])
+        if not self.mods:
+            for name in state['mods']:
+                self.mods.add(self.user_class.create(name))
+
+        for records, data in ((self._banlist, state['banlist']),
+                (self._unbanlist, state['unbanlist'])):
+            for values in data:
+                record = self._import_record(values)
+                if record.target not in records:
+                    self._addRecord(records, record)
+
+        self._mergeHistory(self._import_message(values) for values in\
+                state['history'])
+
+        return set(values[0] for values in state['history'])
+
+
+    def handoff(self):
+        """
+        Export the state and stop dispatching events, the worker taking the
+        room over calls this through the bus, see Manager.migrateRoom.
+
+        @rtype: dict
+        @return: see export_state
+        """
+        state = self.export_state()
+        self.shadow = True
+        return state
+
+
+    def activate(self, handled=()):
+        """
+        Leave shadow mode, messages received meanwhile and not handled by
+        the previous worker are dispatched now.
+
+        @type handled: set of str
+        @param handled: ids of the messages the previous worker has seen
+        """
+        self.shadow = False
+        missed, self._shadow_msgs = self._shadow_msgs, []
+        for msg in missed:
+            if msg.msgid is not None and msg.msgid not in handled:
+                self._dispatchMessage(msg)
+
+
+    @staticmethod
+    def _export_message(msg):
+        return [msg.msgid, msg.time, msg.user.name, msg.user.puid, msg.body,
+                msg.raw, msg.ip, msg.unid, msg.nameColor, msg.fontSize,
+                msg.fontFace, msg.fontColor]
+
+
+    def _import_message(self, values):
+        msgid, mtime, name, puid, body, raw, ip, unid, nameColor, fontSize,\
+                fontFace, fontColor = values
+
+        user = self.user_class.create(name)
+        if puid and not user.puid:
+            user.puid = puid
+
+        return msgid, self.message_class(time=mtime, user=user, body=body,
+                raw=raw, ip=ip, unid=unid, nameColor=nameColor,
+                fontSize=fontSize, fontFace=fontFace, fontColor=fontColor)
+
+
+    @staticmethod
+    def _export_record(record):
+        return [record.unid, record.ip, record.target.name, record.time,
+                record.src.name]
+
+
+    def _import_record(self, values):
+        unid, ip, target, mtime, src = values
+        return BanRecord(unid, ip, self.user_class.create(target), mtime,
+                self.user_class.create(src))
+
+
     def disconnect(self):
         future = super(Room, self).disconnect()
 
@@ -417,14 +603,126 @@ class Room(BaseChannel):
         return False
 
 
+    @asyncio.coroutine
+    def bulkModerate(self, action, users=(), messages=(), ips=(), unids=()):
+        """
+        Ban, clear or delete many targets at once. (Moderator only)
+
+        Users, ips and unids are resolved to their last message in history.
+        Bans and clears are sent once per unid and ip, deletes once per
+        message. Commands are sent in batches of conf['moderation']
+        ['batch_size'] per write, every conf['moderation']['batch_interval']
+        seconds, slowing down twice on each flood warning.
+
+        @type action: str
+        @param action: BULK_BAN, BULK_CLEAR or BULK_DELETE
+        @type users: iterable of User
+        @type messages: iterable of Message
+        @type ips: iterable of str
+        @type unids: iterable of str
+
+        @rtype: dict
+        @return: target, as given, to BULK_SENT, BULK_NOT_FOUND,
+        BULK_DUPLICATE, BULK_DENIED or BULK_DISCONNECTED
+        """
+        if action not in (BULK_BAN, BULK_CLEAR, BULK_DELETE):
+            raise ValueError('unknown action %r' % action)
+
+        targets = [(user, self._lastIndexed(self._userIndex, user.name))\
+                for user in users]
+        targets.extend((msg, msg if msg.msgid is not None else None)\
+                for msg in messages)
+        targets.extend((ip, self._lastIndexed(self._ipIndex, ip))\
+                for ip in ips)
+        targets.extend((unid, self._lastIndexed(self._unidIndex, unid))\
+                for unid in unids)
+
+        result = {}
+        if self.getLevel(self.user) < ROOM_MODERATOR:
+            for target, _ in targets:
+                result[target] = BULK_DENIED
+            return result
+
+        commands = []
+        seen = set()
+        for target, msg in targets:
+            if msg is None:
+                result[target] = BULK_NOT_FOUND
+                continue
+
+            if action == BULK_DELETE:
+                keys = [msg.msgid]
+                command = ('delmsg', msg.msgid)
+            else:
+                keys = [key for key in (('unid', msg.unid), ('ip', msg.ip))\
+                        if key[1]]
+                name = msg.user.name
+                if action == BULK_BAN:
+                    command = ('block', msg.unid, msg.ip, name)
+                else:
+                    if name[0] in ('!', '#'):
+                        name = ''
+                    command = ('delallmsg', msg.unid, msg.ip, name)
+
+            if any(key in seen for key in keys):
+                result[target] = BULK_DUPLICATE
+                continue
+            seen.update(keys)
+            commands.append((target, command))
+
+        batch_size = conf['moderation']['batch_size']
+        interval = conf['moderation']['batch_interval']
+        warnings = self._floodWarnings
+        for start in range(0, len(commands), batch_size):
+            if start:
+                yield from asyncio.sleep(interval)
+                if self._floodWarnings != warnings:
+                    warnings = self._floodWarnings
+                    interval *= 2
+
+            batch = commands[start:start + batch_size]
+            if self._conn is None:
+                status = BULK_DISCONNECTED
+            else:
+                self._send_commands([command for _, command in batch])
+                status = BULK_SENT
+            for target, _ in batch:
+                result[target] = status
+
+        return result
+
+
     def requestBanlist(self):
-        """Request an updated banlist."""
-        self._send_command('blocklist', 'block', '', 'next', '500')
+        """Request an updated banlist, every page of it."""
+        self._banlistListing['block'] = Listing()
+        self._requestBlocklistPage('block', '')
 
 
     def requestUnBanlist(self):
-        """Request an updated banlist."""
-        self._send_command('blocklist', 'unblock', '', 'next', '500')
+        """Request an updated unbanlist, every page of it."""
+        self._banlistListing['unblock'] = Listing()
+        self._requestBlocklistPage('unblock', '')
+
+
+    def _requestBlocklistPage(self, kind, before):
+        self._send_command('blocklist', kind, before, 'next',
+                str(conf['banlist']['page_size']))
+
+
+    def findBanRecords(self, ip=None, unid=None, src=None):
+        """
+        Bans matching every given criterion.
+
+        @type ip: str
+        @param ip: ip address
+        @type unid: str
+        @param unid: unid
+        @type src: User
+        @param src: moderator who banned
+
+        @rtype: list of BanRecord
+        """
+        return self._banlist.find(ip=ip, unid=unid, src=src)
 
 
     def rawUnban(self, name, ip, unid):
@@ -454,7 +752,7 @@ class Room(BaseChannel):
         """
         rec = self._getBanRecord(user)
         if rec:
-            self.rawUnban(rec['target'].name, rec['ip'], rec['unid'])
+            self.rawUnban(rec.target.name, rec.ip, rec.unid)
             return True
         else:
             return False
@@ -476,15 +774,7 @@ class Room(BaseChannel):
     def getLastMessage(self, user=None):
         """get last message said by user in a room"""
         if user:
-            try:
-                i = 1
-                while True:
-                    msg = self._history[-i]
-                    if msg.user == user:
-                        return msg
-                    i += 1
-            except IndexError:
-                return None
+            return self._lastIndexed(self._userIndex, user.name)
         else:
             try:
                 return self._history[-1]
@@ -511,6 +801,27 @@ class Room(BaseChannel):
             return None
 
 
+    @staticmethod
+    def _lastIndexed(index, key):
+        msgs = index.get(key)
+        if not msgs:
+            return None
+        # the last added wins a tie
+        return max(reversed(msgs), key=lambda msg: msg.time)
+
+
+    def _indexHistory(self, msg):
+        for index, key in ((self._userIndex, msg.user.name),
+                (self._unidIndex, msg.unid), (self._ipIndex, msg.ip)):
+            if key:
+                msgs = index.get(key)
+                if msgs is None:
+                    msgs = index[key] = []
+                msgs.append(msg)
+        if self.mgr.search is not None:
+            self.mgr.search.add(msg)
+
+
     def _addHistory(self, msg):
         """
         Add a message to history.
@@ -519,12 +830,60 @@ class Room(BaseChannel):
         @param msg: message
         """
         self._history.append(msg)
+        self._indexHistory(msg)
         if len(self._history) > conf['history']['size']:
             rest, self._history = (self._history[:-conf['history']['size']],
                     self._history[-conf['history']['size']:])
 
             for msg in rest:
-                msg.detach()
+                self._dropHistory(msg)
+
+
+    def _dropHistory(self, msg):
+        """
+        Forget a message removed from history.
+
+        @type msg: Message
+        @param msg: message
+        """
+        for index, key in ((self._userIndex, msg.user.name),
+                (self._unidIndex, msg.unid), (self._ipIndex, msg.ip)):
+            msgs = index.get(key)
+            if msgs and msg in msgs:
+                msgs.remove(msg)
+                if not msgs:
+                    del index[key]
+        if self.mgr.search is not None:
+            self.mgr.search.remove(msg)
+        msg.detach()
+
+
+    def _mergeHistory(self, items):
+        """
+        Merge messages into history by time, skipping known message ids.
+
+        @type items: iterable of (str, Message)
+        @param items: message id and message
+
+        @rtype: list of Message
+        @return: the messages added and kept
+        """
+        added = []
+        for msgid, msg in items:
+            if msgid not in self._msgs:
+                msg.attach(self, msgid)
+                added.append(msg)
+
+        if added:
+            size = conf['history']['size']
+            history = sorted(self._history + added, key=lambda msg: msg.time)
+            for msg in added:
+                self._indexHistory(msg)
+            for msg in history[:-size]:
+                self._dropHistory(msg)
+            self._history = history[-size:]
+
+        return [msg for msg in added if msg.msgid is not None]
 
 
     @staticmethod
@@ -619,13 +978,15 @@ class Room(BaseChannel):
         self.requestUnBanlist()
         if self._connectAmmount == 0:
             self._call_event('onConnect')
-            for msg in reversed(self._i_log):
-                user = msg.user
-                self._call_event('onHistoryMessage', user, msg)
-                self._addHistory(msg)
-            self._i_log.clear()
         else:
             self._call_event('onReconnect')
+
+        # known messages, restored or seen before reconnecting, are skipped
+        for msg in self._mergeHistory(reversed(self._i_log)):
+            if self.mgr.archive is not None and not self.shadow:
+                self.mgr.archive.append(self, msg)
+            self._call_event('onHistoryMessage', msg.user, msg)
+        self._i_log.clear()
         self._connectAmmount += 1
 
 
@@ -695,6 +1056,9 @@ class Room(BaseChannel):
                 ip=ip, nameColor=nameColor, fontColor=fontColor,
                 fontFace=fontFace, fontSize=fontSize, unid=unid, room=self)
 
+        if self.mgr.tracer is not None:
+            msg.trace = self.mgr.tracer.current()
+
         self._mqueue[i] = msg
 
 
@@ -710,9 +1074,65 @@ class Room(BaseChannel):
                 msg.user.nameColor = msg.nameColor
 
             del self._mqueue[args[0]]
+            if args[1] in self._msgs:
+                # handed over by the worker this room was migrated from
+                return
+
             msg.attach(self, args[1])
+            if msg.trace is not None:
+                # measure from the arrival of the "b" frame
+                self.mgr.tracer.bind(msg.trace)
             self._addHistory(msg)
+            if self.shadow:
+                # dispatched by activate, unless the previous worker did
+                self._shadow_msgs.append(msg)
+                del self._shadow_msgs[:-conf['history']['size']]
+            else:
+                self._dispatchMessage(msg)
+
+
+    def _dispatchMessage(self, msg):
+        """Archive, count and check a new message, fire its events."""
+        if self.mgr.archive is not None:
+            self.mgr.archive.append(self, msg)
+        if self.mgr.stats is not None:
+            self.mgr.stats.message(self.name, msg.user.name)
+        if conf['message_batch']['enabled']:
+            self.mgr.batchMessage(self, msg)
+        else:
             self._call_event('onMessage', msg.user, msg)
+        if self.mgr.wordfilter is not None:
+            match = self.mgr.wordfilter.search(msg.body)
+            if match is not None:
+                self._call_event('onWordMatch', msg.user, msg, match)
+        if self.mgr.spam is not None:
+            detections = self.mgr.spam.message(self.name, msg)
+            for detection in detections:
+                self._call_event('onSpamDetected', msg.user, msg, detection)
+            if detections:
+                self._spamAction(msg)
+        if self.mgr.identity is not None:
+            banned = self.mgr.identity.observe(self.name, msg.user.name,
+                    unid=msg.unid, ip=msg.ip, puid=msg.user.puid,
+                    now=msg.time)
+            if banned:
+                self._call_event('onBanEvasion', msg.user, msg,
+                        [self.user_class.create(name) for name in\
+                        sorted(banned)])
+                if conf['identity']['action'] == 'ban':
+                    self._banEvader(msg)
+
+
+    def _banEvader(self, msg):
+        """Ban the sender of a message, once until the ban is confirmed."""
+        if self.getLevel(self.user) < ROOM_MODERATOR:
+            return
+        now = time()
+        sent = self._evasionBans.get(msg.user.name)
+        if sent is not None and now - sent < conf['identity']['ban_retry']:
+            return
+        self._evasionBans[msg.user.name] = now
+        self.ban(msg)
 
 
     @asyncio.coroutine
@@ -734,7 +1154,7 @@ class Room(BaseChannel):
             else:
                 nameColor = None
 
-        #i = args[5]
+        msgid = args[5]
         unid = args[4]
         user = self.user_class.create(name)
         if puid:
@@ -750,7 +1170,7 @@ class Room(BaseChannel):
                 ip=ip, nameColor=nameColor, fontColor=fontColor,
                 fontFace=fontFace, fontSize=fontSize, unid=unid, room=self)
 
-        self._i_log.append(msg)
+        self._i_log.append((msgid, msg))
 
 
     @asyncio.coroutine
@@ -765,12 +1185,37 @@ class Room(BaseChannel):
             user = self.user_class.create(name=name, room=self)
             user.addSessionId(self, data[0])
             self._userlist.append(user)
+        if self.mgr.spam is not None:
+            # not new when they join again, after a reconnect
+            self.mgr.spam.known(self.name, [user.name for user in\
+                    self._userlist])
         self._call_event('onUserList', self._userlist)
 
 
+    def _spamAction(self, msg):
+        action = conf['spam']['action']
+        if action == 'ban':
+            self.ban(msg)
+        elif action == 'clear':
+            self.clearUser(msg.user)
+
+
     @asyncio.coroutine
     def _rcmd_participant(self, args):
         name = args[3].lower()
+        if self.mgr.stats is not None and not self.shadow:
+            if args[0] == '0':
+                self.mgr.stats.leave(self.name)
+            else:
+                self.mgr.stats.join(self.name)
+        if self.mgr.spam is not None and not self.shadow and args[0] == '1':
+            try:
+                now = float(args[5])
+            except (IndexError, ValueError):
+                now = None
+            for detection in self.mgr.spam.join(self.name,
+                    None if name == 'none' else name, now):
+                self._call_event('onSpamDetected', None, None, detection)
         if name == "none":
             return
         user = self.user_class.create(name)
@@ -799,6 +1244,7 @@ class Room(BaseChannel):
 
     @asyncio.coroutine
     def _rcmd_show_fw(self, args):
+        self._floodWarnings += 1
         self._call_event('onFloodWarning')
 
 
@@ -818,8 +1264,10 @@ class Room(BaseChannel):
         if msg:
             if msg in self._history:
                 self._history.remove(msg)
+                if self.mgr.stats is not None and not self.shadow:
+                    self.mgr.stats.delete(self.name)
                 self._call_event('onMessageDelete', msg.user, msg)
-                msg.detach()
+                self._dropHistory(msg)
 
 
     @asyncio.coroutine
@@ -835,51 +1283,88 @@ class Room(BaseChannel):
         except ValueError as e:
             self._log.debug('Invalid user count %s.', args)
             raise
+        if self.mgr.stats is not None and not self.shadow:
+            self.mgr.stats.set_usercount(self.name, self.usercount)
         self._call_event('onUserCountChange')
 
 
-    @asyncio.coroutine
-    def _rcmd_blocklist(self, args):
-        self._banlist = dict()
-        sections = ':'.join(args).split(';')
-        for section in sections:
-            params = section.split(":")
-            if len(params) != 5:
-                continue
-            if params[2] == '':
-                continue
+    def _addRecord(self, records, record):
+        records.add(record)
+        if records is self._banlist and self.mgr.identity is not None:
+            self.mgr.identity.ban(self.name, record.target.name,
+                    unid=record.unid, ip=record.ip)
 
-            user = self.user_class.create(params[2])
-            self._banlist[user] = {
-                'unid': params[0],
-                'ip': params[1],
-                'target': user,
-                'time': float(params[3]),
-                'src': self.user_class.create(params[4]),
-            }
-        self._call_event('onBanlistUpdate')
 
+    def _removeRecord(self, records, target):
+        records.remove(target)
+        if records is self._banlist and self.mgr.identity is not None:
+            self.mgr.identity.unban(self.name, target.name)
 
-    @asyncio.coroutine
-    def _rcmd_unblocklist(self, args):
-        self._unbanlist = dict()
-        sections = ':'.join(args).split(';')
-        for section in sections:
+
+    def _mergeBlocklist(self, kind, records, args):
+        """
+        Merge a page of the banlist or unbanlist, request the next one.
+
+        @rtype: bool
+        @return: whether the list is complete
+        """
+        listing = self._banlistListing.get(kind)
+        count = added = 0
+        oldest = newest = None
+        for section in ':'.join(args).split(';'):
             params = section.split(':')
             if len(params) != 5:
                 continue
+            count += 1
+            mtime = float(params[3])
+            if oldest is None or mtime < oldest:
+                oldest = mtime
+            if newest is None or mtime > newest:
+                newest = mtime
             if params[2] == '':
                 continue
 
             user = self.user_class.create(params[2])
-            self._unbanlist[user] = {
-                'unid': params[0],
-                'ip': params[1],
-                'target': user,
-                'time': float(params[3]),
-                'src': self.user_class.create(params[4]),
-            }
-        self._call_event('onUnBanlistUpdate')
+            self._addRecord(records, BanRecord(params[0], params[1], user,
+                    mtime, self.user_class.create(params[4])))
+            if listing is not None and listing.add(user):
+                added += 1
+
+        if listing is not None and count:
+            # the server lists entries strictly older than the cursor: the
+            # next page starts at the oldest time again, entries sharing it
+            # did not all fit, the ones seen are skipped
+            listing.largest = max(listing.largest, count)
+            if added:
+                before = '%.2f' % (oldest + 0.01)
+            else:
+                # nothing new, step past the oldest time, a page full of it
+                # may hide more entries
+                before = '%.2f' % oldest
+                if oldest == newest and count >= listing.largest:
+                    listing.complete = False
+            self._requestBlocklistPage(kind, before)
+            return False
+
+        self._banlistListing.pop(kind, None)
+        if listing is not None and listing.complete and kind == 'block':
+            # unbanned while we were not listening
+            for target in [target for target in records\
+                    if target not in listing]:
+                self._removeRecord(records, target)
+        return True
+
+
+    @asyncio.coroutine
+    def _rcmd_blocklist(self, args):
+        if self._mergeBlocklist('block', self._banlist, args):
+            self._call_event('onBanlistUpdate')
+
+
+    @asyncio.coroutine
+    def _rcmd_unblocklist(self, args):
+        if self._mergeBlocklist('unblock', self._unbanlist, args):
+            self._call_event('onUnBanlistUpdate')
 
 
     @asyncio.coroutine
@@ -888,13 +1373,12 @@ class Room(BaseChannel):
             return
         target = self.user_class.create(args[2])
         user = self.user_class.create(args[3])
-        self._banlist[target] = {
-            'unid': args[0],
-            'ip': args[1],
-            'target': target,
-            'time': float(args[4]),
-            'src': user,
-        }
+        self._evasionBans.pop(target.name, None)
+        self._addRecord(self._banlist, BanRecord(args[0], args[1], target,
+                float(args[4]), user))
+        listing = self._banlistListing.get('block')
+        if listing is not None:
+            listing.add(target)
         self._call_event('onBan', user, target)
 
 
@@ -904,14 +1388,9 @@ class Room(BaseChannel):
             return
         target = self.user_class.create(args[2])
         user = self.user_class.create(args[3])
-        del self._banlist[target]
-        self._unbanlist[user] = {
-            'unid': args[0],
-            'ip': args[1],
-            'target': target,
-            'time': float(args[4]),
-            'src': user,
-        }
+        self._removeRecord(self._banlist, target)
+        self._unbanlist.add(BanRecord(args[0], args[1], target,
+                float(args[4]), user))
         self._call_event('onUnban', user, target)
 
 
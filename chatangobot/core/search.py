@@ -0,0 +1,242 @@
+"""Full-text search over the history of every room.
+
+The index is updated as messages enter and leave room history, so it never
+holds more than history.size messages per room. Postings map a token to the
+messages containing it, per room and over every room, for queries on one
+room or all.
+
+Queries are words, all required, and double quoted phrases:
+
+    spam "buy now"
+
+Older messages are searched in the archive, when enabled, see
+SearchIndex.search_archive.
+"""
+
+import asyncio
+import re
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+PHRASE_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    """
+    Lowercase words of a text.
+
+    @rtype: list of str
+    """
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def parse_query(query):
+    """
+    Split a query into words and phrases.
+
+    @rtype: (set of str, list of tuple of str)
+    @return: every token required, and the phrases, each a token sequence
+    """
+    tokens = set()
+    phrases = []
+    for phrase, word in PHRASE_RE.findall(query):
+        words = tokenize(phrase or word)
+        tokens.update(words)
+        if phrase and len(words) > 1:
+            phrases.append(tuple(words))
+    return tokens, phrases
+
+
+def _contains(tokens, phrase):
+    size = len(phrase)
+    first = phrase[0]
+    for pos, token in enumerate(tokens):
+        if token == first and tuple(tokens[pos:pos + size]) == phrase:
+            return True
+    return False
+
+
+def _matches(tokens, phrases, msg_time, username, since, until, user):
+    if since is not None and msg_time < since:
+        return False
+    if until is not None and msg_time >= until:
+        return False
+    if user is not None and username != user:
+        return False
+    return all(_contains(tokens, phrase) for phrase in phrases)
+
+
+class SearchIndex(object):
+    """Inverted index of the messages in room history."""
+
+    archive = None
+
+    _postings = None
+    _all_postings = None
+    _docs = None
+    _rooms = None
+
+    @property
+    def size(self):
+        """Number of indexed messages."""
+        return len(self._docs)
+
+
+    def __init__(self, archive=None):
+        self.archive = archive
+        # token to room name to messages
+        self._postings = {}
+        # token to messages of every room
+        self._all_postings = {}
+        # message to its tokens
+        self._docs = {}
+        # room name to its messages
+        self._rooms = {}
+
+
+    def add(self, msg):
+        if msg in self._docs:
+            return
+        tokens = tokenize(msg.body)
+        self._docs[msg] = tokens
+
+        room_name = msg.room.name
+        self._rooms.setdefault(room_name, set()).add(msg)
+        for token in set(tokens):
+            rooms = self._postings.get(token)
+            if rooms is None:
+                rooms = self._postings[token] = {}
+                self._all_postings[token] = set()
+            docs = rooms.get(room_name)
+            if docs is None:
+                docs = rooms[room_name] = set()
+            docs.add(msg)
+            self._all_postings[token].add(msg)
+
+
+    def remove(self, msg):
+        tokens = self._docs.pop(msg, None)
+        if tokens is None:
+            return
+
+        room_name = msg.room.name
+        messages = self._rooms[room_name]
+        messages.discard(msg)
+        if not messages:
+            del self._rooms[room_name]
+
+        for token in set(tokens):
+            self._all_postings[token].discard(msg)
+            rooms = self._postings[token]
+            docs = rooms[room_name]
+            docs.discard(msg)
+            if not docs:
+                del rooms[room_name]
+                if not rooms:
+                    del self._postings[token]
+                    del self._all_postings[token]
+
+
+    def remove_room(self, room_name):
+        """Drop every message of a room, once left."""
+        for msg in list(self._rooms.get(room_name, ())):
+            self.remove(msg)
+
+
+    def _candidates(self, tokens, room_name):
+        sets = []
+        for token in tokens:
+            if room_name is None:
+                docs = self._all_postings.get(token)
+            else:
+                docs = self._postings.get(token, {}).get(room_name)
+            if not docs:
+                return set()
+            sets.append(docs)
+
+        # smallest first, the intersection shrinks fastest
+        sets.sort(key=len)
+        result = set(sets[0])
+        for docs in sets[1:]:
+            result.intersection_update(docs)
+            if not result:
+                break
+        return result
+
+
+    def search(self, query, room_name=None, since=None, until=None, user=None,
+            limit=50):
+        """
+        Messages in history matching a query, newest first.
+
+        @type query: str
+        @param query: words and double quoted phrases, all required
+        @type room_name: str
+        @param room_name: one room, or None for every room
+        @type since: float
+        @param since: timestamp, included
+        @type until: float
+        @param until: timestamp, excluded
+        @type user: str or User
+        @param user: messages of this user only
+        @type limit: int
+        @param limit: maximum number of messages returned
+
+        @rtype: list of Message
+        """
+        tokens, phrases = parse_query(query)
+        if not tokens:
+            return []
+        if hasattr(user, 'name'):
+            user = user.name
+        if user is not None:
+            user = user.lower()
+
+        result = [msg for msg in self._candidates(tokens, room_name)\
+                if _matches(self._docs[msg], phrases, msg.time, msg.user.name,
+                        since, until, user)]
+        result.sort(key=lambda msg: msg.time, reverse=True)
+        return result[:limit]
+
+
+    @asyncio.coroutine
+    def search_archive(self, query, room_names, since=None, until=None,
+            user=None, limit=50):
+        """
+        Archived messages matching a query, newest first.
+
+        Only the archive blocks within [since, until) holding every word of
+        the query are read, newest first, until `limit` messages matched,
+        see Archive.search.
+
+        @type room_names: list of str
+        @param room_names: rooms to search
+        @type limit: int
+        @param limit: maximum number of messages returned, required
+
+        @rtype: list of archive.ArchivedMessage
+        """
+        if self.archive is None:
+            raise RuntimeError('archive.enabled is off')
+        if limit is None:
+            raise ValueError('limit is required')
+
+        tokens, phrases = parse_query(query)
+        if not tokens:
+            return []
+        if hasattr(user, 'name'):
+            user = user.name
+        if user is not None:
+            user = user.lower()
+
+        def match(msg):
+            return _matches(tokenize(msg.body), phrases, msg.time,
+                    msg.username, since, until, user)
+
+        result = []
+        for room_name in room_names:
+            messages = yield from self.archive.search(room_name, tokens,
+                    match, start=since, end=until, limit=limit)
+            result.extend(messages)
+
+        result.sort(key=lambda msg: msg.time, reverse=True)
+        return result[:limit]
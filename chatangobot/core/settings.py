@@ -10,8 +10,12 @@ DEFAULT_SETTINGS = {
         'password': None,
     },
     'datastore': {
+        'backend': None, # sqlite, log or redis, see core.datastore
         'connect_args': {},
         'prefix': 'chatango_bot_', # prefix of stored data's dictionary key
+        'flush_interval': 1.0, # seconds between writes to the backend
+        'batch_size': 500, # dirty keys flushed before the interval
+        'cache_size': 10000, # keys kept in memory
     },
     'connection': {
         'buffer_size': 65536,
@@ -25,7 +29,9 @@ DEFAULT_SETTINGS = {
         'anonymous_pm_port': 5222,
         'pm_host': 'c1.chatango.com',
         'pm_port': 5222,
+        'chatroom_host': None, # all rooms on one host, see fakeserver
         'chatroom_port': 443,
+        'login_url': 'https://chatango.com/login',
     },
     'logging': {
         'level': 'info',
@@ -54,6 +60,101 @@ DEFAULT_SETTINGS = {
         'text_typeface': '1',
         'text_size': 11,
     },
+    'executor': {
+        'processes': None, # process pool size for cpu_bound, None is per core
+        'threads': 8, # thread pool size for blocking handlers
+        'thread_queue_size': 100,
+        'thread_queue_full': 'wait', # wait, drop or drop_oldest
+    },
+    'monitor': {
+        'enabled': False,
+        'interval': 1.0, # seconds between loop lag measurements
+        'threshold': 0.1, # seconds, lag or handler run time reported as slow
+        'top': 5, # number of offenders logged
+    },
+    'metrics': {
+        'enabled': False,
+        'host': '127.0.0.1',
+        'port': 9108,
+        'max_series': 200, # per metric, extra label values become "_other"
+    },
+    'tracing': {
+        'enabled': False,
+        'path': 'chatango-trace.json', # Trace Event Format
+        'sample_rate': 1.0, # fraction of inbound frames traced
+    },
+    'recorder': {
+        'enabled': False,
+        'directory': 'captures', # one capture file per channel
+    },
+    'archive': {
+        'enabled': False,
+        'directory': 'archive', # one directory of segments per room
+        'block_size': 256, # messages compressed together
+        'segment_size': 8388608, # bytes, larger segments are rolled
+        'flush_interval': 5.0, # seconds between block writes
+    },
+    'stats': {
+        'enabled': False, # activity statistics of rooms, see core.stats
+        'max_active': 10000, # active chatters tracked per room and window
+        'top_size': 10, # most active users kept
+    },
+    'search': {
+        'enabled': False, # index the history of every room, see core.search
+    },
+    'identity': {
+        'enabled': False, # link names across rooms, see core.identity
+        'ttl': 86400.0, # seconds a generation of links is fed
+        'max_keys': 1000000, # names, unids, ips and puids per generation
+        'link_ip': False, # link names sharing an ip, NATs share them
+        'action': None, # None or 'ban' users linked to a banned one
+        'ban_retry': 60.0, # seconds before banning an evader again
+    },
+    'message_batch': {
+        'enabled': False, # onMessageBatch instead of onMessage
+        'size': 100, # messages, a full batch is dispatched right away
+        'interval': 1.0, # seconds a batch is held at most
+        'per_room': True, # False batches the messages of every room
+    },
+    'coalesce': {
+        # seconds events are held and coalesced, see Manager.coalesced_events
+        'onUserCountChange': 0.0, # the last one only
+        'onJoin': 0.0, # one onJoinBatch instead
+        'onLeave': 0.0, # one onLeaveBatch instead
+    },
+    'wordfilter': {
+        'path': None, # word list file, one per line, see core.wordfilter
+        'reload_interval': 5.0, # seconds between checks of the file
+    },
+    'banlist': {
+        'page_size': 500, # records per blocklist request
+        'unbanlist_size': 1000, # most recent unbans kept per room
+    },
+    'moderation': {
+        'batch_size': 10, # commands per write of Room.bulkModerate
+        'batch_interval': 1.0, # seconds between writes
+    },
+    'spam': {
+        'enabled': False, # detect floods, copies and raids, see core.spam
+        'window': 10.0, # seconds
+        'message_limit': 6, # messages of a user, ip or unid per window
+        'duplicate_limit': 3, # near-duplicate messages per window
+        'duplicate_similarity': 0.7, # estimated jaccard similarity
+        'raid_window': 10.0, # seconds
+        'raid_limit': 15, # joins of anons and new users per raid_window
+        'max_keys': 1024, # users, ips and unids tracked per room
+        'action': None, # None, 'ban' or 'clear' the sender
+    },
+    'persistence': {
+        'enabled': False,
+        'directory': 'state', # one snapshot file per room
+        'interval': 60.0, # seconds between snapshots
+    },
+    'bus': {
+        'enabled': False,
+        'path': 'chatangobot.sock', # unix socket of the supervisor's broker
+        'timeout': 10.0, # seconds to wait for the answer of a request
+    },
     'services': [],
 }
 
@@ -0,0 +1,293 @@
+"""Spam, flood and raid detection.
+
+Rooms feed every message and join to the SpamDetector of the Manager, it
+keeps per room, in bounded memory:
+
+    - sliding windows of message times per user, ip and unid, a flood is
+      more than `message_limit` messages from one of them within `window`
+    - MinHash signatures of the recent message bodies, indexed by band, a
+      flood of copies is `duplicate_limit` near-duplicates within `window`,
+      whoever sent them
+    - a sliding window of join times, a raid is `raid_limit` joins of
+      anons or users new to the room within `raid_window`; users in the
+      room when joined, who joined or spoke since, are not new
+
+A detection fires onSpamDetected, once per key and window.
+"""
+
+from collections import OrderedDict, deque, namedtuple
+
+from .clock import time
+from .wordfilter import normalize
+
+Detection = namedtuple('Detection', ['kind', 'key', 'count', 'window'])
+Detection.__doc__ = """What was detected: kind is one of FLOOD, DUPLICATE
+and RAID, key the user name, ip or unid flooding, "user:<name>",
+"ip:<ip>", "unid:<unid>", count the number of messages or joins."""
+
+FLOOD = 'flood'
+DUPLICATE = 'duplicate'
+RAID = 'raid'
+
+# MinHash buckets, bands of rows, and characters per shingle
+BUCKETS = 16
+ROWS = 4
+SHINGLE = 4
+# bodies shorter than this, once normalised, are not compared
+MIN_LENGTH = 12
+
+
+def signature(text):
+    """
+    MinHash signature of a normalised text, one permutation hashing: each
+    shingle hash goes to a bucket, which keeps the smallest.
+
+    @rtype: tuple of int
+    @return: BUCKETS values, None for empty buckets
+    """
+    buckets = [None] * BUCKETS
+    for start in range(max(len(text) - SHINGLE + 1, 1)):
+        value = hash(text[start:start + SHINGLE])
+        number = value % BUCKETS
+        if buckets[number] is None or value < buckets[number]:
+            buckets[number] = value
+    return tuple(buckets)
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of the texts of two signatures."""
+    same = total = 0
+    for a, b in zip(first, second):
+        if a is None and b is None:
+            continue
+        total += 1
+        same += a == b
+    return same / total if total else 0.0
+
+
+def _bands(sig):
+    return [(start, sig[start:start + ROWS])\
+            for start in range(0, BUCKETS, ROWS)]
+
+
+class _RoomTracker(object):
+    """Windows and signatures of one room."""
+
+    recent_size = None
+    rates = None
+    recent = None
+    bands = None
+    joins = None
+    seen = None
+    fired = None
+
+    def __init__(self, recent_size, join_limit):
+        self.recent_size = recent_size
+        # key to message times, least recent key first
+        self.rates = OrderedDict()
+        # (time, signature, user name) of recent bodies, oldest first
+        self.recent = deque()
+        # band to the recent bodies having it, oldest first
+        self.bands = {}
+        self.joins = deque(maxlen=join_limit)
+        # user names joined before, least recent first
+        self.seen = OrderedDict()
+        # key to the time its last detection expires
+        self.fired = OrderedDict()
+
+
+    def add_recent(self, entry):
+        self.recent.append(entry)
+        for band in _bands(entry[1]):
+            entries = self.bands.get(band)
+            if entries is None:
+                entries = self.bands[band] = deque()
+            entries.append(entry)
+
+
+    def similar(self, sig, threshold, limit):
+        """
+        Recent bodies sharing a band with a signature and similar enough,
+        newest first, at most limit.
+
+        @rtype: list of tuple
+        """
+        result = []
+        checked = set()
+        for band in _bands(sig):
+            for entry in reversed(self.bands.get(band, ())):
+                if id(entry) in checked:
+                    continue
+                checked.add(id(entry))
+                if similarity(sig, entry[1]) >= threshold:
+                    result.append(entry)
+                    if len(result) >= limit:
+                        return result
+        return result
+
+
+    def forget_recent(self, until):
+        while self.recent and (self.recent[0][0] < until or\
+                len(self.recent) > self.recent_size):
+            entry = self.recent.popleft()
+            # the oldest body is the oldest of each of its bands
+            for band in _bands(entry[1]):
+                entries = self.bands[band]
+                entries.popleft()
+                if not entries:
+                    del self.bands[band]
+
+
+class SpamDetector(object):
+    """Detects floods, copies and raids in every room, see module doc."""
+
+    window = 10.0
+    message_limit = 6
+    duplicate_limit = 3
+    duplicate_similarity = 0.7
+    raid_window = 10.0
+    raid_limit = 15
+    max_keys = 1024
+
+    _rooms = None
+
+    def __init__(self, window=10.0, message_limit=6, duplicate_limit=3,
+            duplicate_similarity=0.7, raid_window=10.0, raid_limit=15,
+            max_keys=1024):
+        self.window = window
+        self.message_limit = message_limit
+        self.duplicate_limit = duplicate_limit
+        self.duplicate_similarity = duplicate_similarity
+        self.raid_window = raid_window
+        self.raid_limit = raid_limit
+        self.max_keys = max_keys
+        self._rooms = {}
+
+
+    def _tracker(self, room_name):
+        tracker = self._rooms.get(room_name)
+        if tracker is None:
+            tracker = self._rooms[room_name] = _RoomTracker(self.max_keys,
+                    self.raid_limit)
+        return tracker
+
+
+    def forget(self, room_name):
+        """Drop the state of a room, once left."""
+        self._rooms.pop(room_name, None)
+
+
+    def _see(self, tracker, name):
+        """Mark a user name seen, return whether it was seen before."""
+        seen = tracker.seen
+        if name in seen:
+            seen.move_to_end(name)
+            return True
+        seen[name] = None
+        while len(seen) > self.max_keys:
+            seen.popitem(last=False)
+        return False
+
+
+    def known(self, room_name, names):
+        """
+        Mark users as seen, not new when they join, the users in the room
+        when joined.
+
+        @type names: list of str
+        """
+        tracker = self._tracker(room_name)
+        for name in names:
+            self._see(tracker, name)
+
+
+    def _fire(self, tracker, key, now, window):
+        """Whether a detection of key is new, not fired within window."""
+        until = tracker.fired.get(key)
+        if until is not None and until > now:
+            return False
+        tracker.fired[key] = now + window
+        tracker.fired.move_to_end(key)
+        while len(tracker.fired) > self.max_keys:
+            tracker.fired.popitem(last=False)
+        return True
+
+
+    def message(self, room_name, msg):
+        """
+        Track a message.
+
+        @type room_name: str
+        @type msg: Message
+
+        @rtype: list of Detection
+        """
+        tracker = self._tracker(room_name)
+        now = msg.time
+        result = []
+        self._see(tracker, msg.user.name)
+
+        keys = ['user:' + msg.user.name]
+        if msg.ip:
+            keys.append('ip:' + msg.ip)
+        if msg.unid:
+            keys.append('unid:' + msg.unid)
+
+        rates = tracker.rates
+        for key in keys:
+            times = rates.get(key)
+            if times is None:
+                # the last message_limit + 1 times are enough to tell
+                times = rates[key] = deque(maxlen=self.message_limit + 1)
+            else:
+                rates.move_to_end(key)
+            times.append(now)
+            if len(times) == times.maxlen and\
+                    now - times[0] <= self.window and\
+                    self._fire(tracker, FLOOD + key, now, self.window):
+                result.append(Detection(FLOOD, key, len(times), self.window))
+        while len(rates) > self.max_keys:
+            rates.popitem(last=False)
+
+        text = normalize(msg.body or '')[0]
+        tracker.forget_recent(now - self.window)
+        if len(text) >= MIN_LENGTH:
+            sig = signature(text)
+            copies = tracker.similar(sig, self.duplicate_similarity,
+                    self.duplicate_limit - 1)
+            count = len(copies) + 1
+            key = 'user:' + msg.user.name
+            if count >= self.duplicate_limit and\
+                    self._fire(tracker, DUPLICATE + key, now, self.window):
+                result.append(Detection(DUPLICATE, key, count, self.window))
+            tracker.add_recent((now, sig, msg.user.name))
+
+        return result
+
+
+    def join(self, room_name, name, now=None):
+        """
+        Track a join.
+
+        @type room_name: str
+        @type name: str
+        @param name: user name, None for anons
+        @type now: float
+        @param now: join time, defaults to the current time
+
+        @rtype: list of Detection
+        """
+        tracker = self._tracker(room_name)
+        if now is None:
+            now = time()
+
+        if name is not None and self._see(tracker, name):
+            return []
+
+        joins = tracker.joins
+        joins.append(now)
+        if len(joins) == joins.maxlen and\
+                now - joins[0] <= self.raid_window and\
+                self._fire(tracker, RAID, now, self.raid_window):
+            return [Detection(RAID, None, len(joins), self.raid_window)]
+        return []
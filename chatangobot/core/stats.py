@@ -0,0 +1,487 @@
+"""Activity statistics of rooms, updated as events arrive.
+
+Every room, and all of them together, keep:
+
+    - messages, joins, leaves and deletions over the last minute, 5
+      minutes, hour and day, in rings of buckets with a running total
+    - active chatters, users who spoke, over the last minute, 5 minutes
+      and hour, and an estimate of unique chatters over the last day and
+      since the start, with HyperLogLog
+    - the user count, and its peak over the last day
+    - the most active users, with a count-min sketch halved every hour
+
+Queries take constant time, whatever the traffic, see RoomStats.
+"""
+
+from collections import OrderedDict
+from math import log
+
+from .clock import time
+
+MINUTE = 60
+FIVE_MINUTES = 300
+HOUR = 3600
+DAY = 86400
+
+# window to the number of buckets of its rings
+WINDOWS = OrderedDict([(MINUTE, 60), (FIVE_MINUTES, 60), (HOUR, 60),
+        (DAY, 96)])
+
+_MASK64 = 2 ** 64 - 1
+
+
+class RingCounter(object):
+    """Events over a sliding window, in buckets, with a running total."""
+
+    width = None
+
+    _counts = None
+    _total = 0
+    _head = None
+
+    def __init__(self, span, buckets):
+        self.width = span / buckets
+        self._counts = [0] * buckets
+
+
+    def _advance(self, number):
+        if self._head is None:
+            self._head = number
+            return
+        if number <= self._head:
+            return
+        size = len(self._counts)
+        for step in range(self._head + 1,
+                self._head + 1 + min(number - self._head, size)):
+            self._total -= self._counts[step % size]
+            self._counts[step % size] = 0
+        self._head = number
+
+
+    def add(self, now, amount=1):
+        number = int(now // self.width)
+        self._advance(number)
+        if number <= self._head - len(self._counts):
+            return
+        self._counts[number % len(self._counts)] += amount
+        self._total += amount
+
+
+    def total(self, now):
+        self._advance(int(now // self.width))
+        return self._total
+
+
+class RingMax(RingCounter):
+    """Largest value over a sliding window."""
+
+    def add(self, now, amount=1):
+        number = int(now // self.width)
+        self._advance(number)
+        if number <= self._head - len(self._counts):
+            return
+        index = number % len(self._counts)
+        self._counts[index] = max(self._counts[index], amount)
+
+
+    def total(self, now):
+        self._advance(int(now // self.width))
+        return max(self._counts)
+
+
+class HyperLogLog(object):
+    """Estimate of the number of distinct items."""
+
+    precision = None
+
+    registers = None
+    _estimate = None
+
+    def __init__(self, precision=10):
+        """
+        @type precision: int
+        @param precision: 2 ** precision registers, the standard error is
+        1.04 / sqrt(2 ** precision), 3.25% by default
+        """
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+
+
+    def add(self, item):
+        value = hash(item) & _MASK64
+        index = value & (len(self.registers) - 1)
+        rank = 64 - self.precision - (value >> self.precision).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            self._estimate = None
+
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        self._estimate = None
+
+
+    def clear(self):
+        self.registers = bytearray(len(self.registers))
+        self._estimate = 0
+
+
+    def count(self):
+        if self._estimate is None:
+            self._estimate = _estimate(self.registers)
+        return self._estimate
+
+
+def _estimate(registers):
+    size = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / size)
+    estimate = alpha * size * size /\
+            sum(2.0 ** -register for register in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * size and zeros:
+        # linear counting, more accurate for small counts
+        return int(round(size * log(size / zeros)))
+    return int(round(estimate))
+
+
+class HyperLogLogRing(object):
+    """Distinct items over a sliding window, an HyperLogLog per bucket."""
+
+    width = None
+    precision = None
+
+    _sketches = None
+    _head = None
+    _merged = None
+
+    def __init__(self, span, buckets, precision=10):
+        self.width = span / buckets
+        self.precision = precision
+        self._sketches = [HyperLogLog(precision) for _ in range(buckets)]
+        # the buckets but the newest, merged once per bucket
+        self._merged = HyperLogLog(precision)
+
+
+    def _advance(self, number):
+        if self._head is None:
+            self._head = number
+            return
+        if number <= self._head:
+            return
+        size = len(self._sketches)
+        for step in range(self._head + 1,
+                self._head + 1 + min(number - self._head, size)):
+            self._sketches[step % size].clear()
+        self._head = number
+
+        self._merged.clear()
+        for step in range(number - size + 1, number):
+            self._merged.merge(self._sketches[step % size])
+
+
+    def add(self, now, item):
+        self._advance(int(now // self.width))
+        self._sketches[self._head % len(self._sketches)].add(item)
+
+
+    def count(self, now):
+        self._advance(int(now // self.width))
+        newest = self._sketches[self._head % len(self._sketches)]
+        return _estimate(bytearray(map(max, self._merged.registers,
+                newest.registers)))
+
+
+class CountMinSketch(object):
+    """Approximate counts of items, and the top ones."""
+
+    width = None
+    depth = None
+    top_size = None
+
+    _rows = None
+    _top = None
+
+    def __init__(self, width=1024, depth=4, top_size=10):
+        self.width = width
+        self.depth = depth
+        self.top_size = top_size
+        self._rows = [[0] * width for _ in range(depth)]
+        # item to estimated count, of the top_size items
+        self._top = {}
+
+
+    def _indexes(self, item):
+        value = hash(item) & _MASK64
+        low, high = value & 0xffffffff, value >> 32
+        return [(low + row * high) % self.width for row in range(self.depth)]
+
+
+    def add(self, item, amount=1):
+        estimate = None
+        for row, index in zip(self._rows, self._indexes(item)):
+            row[index] += amount
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+
+        top = self._top
+        if item in top or len(top) < self.top_size:
+            top[item] = estimate
+            return
+        smallest = min(top, key=top.get)
+        if estimate > top[smallest]:
+            del top[smallest]
+            top[item] = estimate
+
+
+    def estimate(self, item):
+        return min(row[index] for row, index in\
+                zip(self._rows, self._indexes(item)))
+
+
+    def top(self, count=None):
+        """
+        @rtype: list of (item, int)
+        @return: most counted items first
+        """
+        items = sorted(self._top.items(), key=lambda item: -item[1])
+        return items[:count] if count is not None else items
+
+
+    def halve(self):
+        """Halve every count, older counts weigh less and less."""
+        for row in self._rows:
+            row[:] = [value >> 1 for value in row]
+        self._top = dict((item, value >> 1)\
+                for item, value in self._top.items() if value >> 1)
+
+
+class RoomStats(object):
+    """Statistics of a room, or of every room, see module doc."""
+
+    usercount = 0
+    max_active = None
+
+    _messages = None
+    _joins = None
+    _leaves = None
+    _deletions = None
+    _active = None
+    _unique_day = None
+    _unique = None
+    _peak = None
+    _chatters = None
+    _halved = None
+
+    def __init__(self, max_active=10000, top_size=10):
+        self.max_active = max_active
+        self._messages = {}
+        self._joins = {}
+        self._leaves = {}
+        self._deletions = {}
+        for counters in (self._messages, self._joins, self._leaves,
+                self._deletions):
+            for window, buckets in WINDOWS.items():
+                counters[window] = RingCounter(window, buckets)
+        # window to user name to the time they last spoke, oldest first
+        self._active = dict((window, OrderedDict()) for window in WINDOWS\
+                if window != DAY)
+        self._unique_day = HyperLogLogRing(DAY, 24)
+        self._unique = HyperLogLog()
+        self._peak = RingMax(DAY, WINDOWS[DAY])
+        self._chatters = CountMinSketch(top_size=top_size)
+
+
+    def _count(self, counters, now):
+        for counter in counters.values():
+            counter.add(now)
+
+
+    def _expire(self, window, now):
+        active = self._active[window]
+        while active:
+            name, seen = next(iter(active.items()))
+            if seen >= now - window and len(active) <= self.max_active:
+                break
+            del active[name]
+
+
+    def message(self, name, now):
+        self._count(self._messages, now)
+        for window, active in self._active.items():
+            active.pop(name, None)
+            active[name] = now
+            self._expire(window, now)
+        self._unique_day.add(now, name)
+        self._unique.add(name)
+
+        if self._halved is None:
+            self._halved = now
+        elif now - self._halved >= HOUR:
+            self._chatters.halve()
+            self._halved = now
+        self._chatters.add(name)
+
+
+    def join(self, now):
+        self._count(self._joins, now)
+
+
+    def leave(self, now):
+        self._count(self._leaves, now)
+
+
+    def delete(self, now):
+        self._count(self._deletions, now)
+
+
+    def set_usercount(self, count, now):
+        self.usercount = count
+        self._peak.add(now, count)
+
+
+    def messages(self, window=MINUTE, now=None):
+        """
+        Messages received over a window.
+
+        @type window: int
+        @param window: MINUTE, FIVE_MINUTES, HOUR or DAY
+        """
+        return self._messages[window].total(time() if now is None else now)
+
+
+    def joins(self, window=MINUTE, now=None):
+        return self._joins[window].total(time() if now is None else now)
+
+
+    def leaves(self, window=MINUTE, now=None):
+        return self._leaves[window].total(time() if now is None else now)
+
+
+    def deletions(self, window=MINUTE, now=None):
+        return self._deletions[window].total(time() if now is None else now)
+
+
+    def active(self, window=MINUTE, now=None):
+        """
+        Users who spoke over a window, estimated for DAY.
+
+        @type window: int
+        @param window: MINUTE, FIVE_MINUTES, HOUR or DAY
+        """
+        now = time() if now is None else now
+        if window == DAY:
+            return self._unique_day.count(now)
+        self._expire(window, now)
+        return len(self._active[window])
+
+
+    def unique(self):
+        """Estimate of the users who spoke since the start."""
+        return self._unique.count()
+
+
+    def peak_usercount(self, now=None):
+        """Largest user count over the last day."""
+        # the current count, if it did not change for a day
+        return max(self._peak.total(time() if now is None else now),
+                self.usercount)
+
+
+    def top_chatters(self, count=None):
+        """
+        Most active users, counts are halved every hour.
+
+        @rtype: list of (str, int)
+        @return: user names and estimated message counts
+        """
+        return self._chatters.top(count)
+
+
+    def summary(self, now=None):
+        """
+        Everything, for a dashboard or a !stats command.
+
+        @rtype: dict
+        """
+        now = time() if now is None else now
+        result = {
+            'usercount': self.usercount,
+            'peak_usercount': self.peak_usercount(now),
+            'unique': self.unique(),
+            'top_chatters': self.top_chatters(),
+        }
+        for window, label in ((MINUTE, '1m'), (FIVE_MINUTES, '5m'),
+                (HOUR, '1h'), (DAY, '24h')):
+            result['messages_' + label] = self.messages(window, now)
+            result['joins_' + label] = self.joins(window, now)
+            result['leaves_' + label] = self.leaves(window, now)
+            result['deletions_' + label] = self.deletions(window, now)
+            result['active_' + label] = self.active(window, now)
+        return result
+
+
+class ActivityStats(object):
+    """Statistics of every room, and of all of them together."""
+
+    max_active = None
+    top_size = None
+    total = None
+
+    _rooms = None
+
+    def __init__(self, max_active=10000, top_size=10):
+        self.max_active = max_active
+        self.top_size = top_size
+        self.total = RoomStats(max_active, top_size)
+        self._rooms = {}
+
+
+    def room(self, room_name):
+        """
+        @rtype: RoomStats
+        """
+        stats = self._rooms.get(room_name)
+        if stats is None:
+            stats = self._rooms[room_name] = RoomStats(self.max_active,
+                    self.top_size)
+        return stats
+
+
+    def forget(self, room_name):
+        """Drop the statistics of a room, once left, totals are kept."""
+        stats = self._rooms.pop(room_name, None)
+        if stats is not None:
+            self.total.usercount -= stats.usercount
+
+
+    def message(self, room_name, name, now=None):
+        now = time() if now is None else now
+        self.room(room_name).message(name, now)
+        self.total.message(name, now)
+
+
+    def join(self, room_name, now=None):
+        now = time() if now is None else now
+        self.room(room_name).join(now)
+        self.total.join(now)
+
+
+    def leave(self, room_name, now=None):
+        now = time() if now is None else now
+        self.room(room_name).leave(now)
+        self.total.leave(now)
+
+
+    def delete(self, room_name, now=None):
+        now = time() if now is None else now
+        self.room(room_name).delete(now)
+        self.total.delete(now)
+
+
+    def set_usercount(self, room_name, count, now=None):
+        now = time() if now is None else now
+        stats = self.room(room_name)
+        previous = stats.usercount
+        stats.set_usercount(count, now)
+        self.total.set_usercount(self.total.usercount - previous + count,
+                now)
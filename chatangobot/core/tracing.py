@@ -0,0 +1,224 @@
+"""Latency tracing from frame receipt to reply write.
+
+Spans are written in the Trace Event Format (JSON array of complete "X"
+events) understood by chrome://tracing and Perfetto, the format allows the
+array to be left unterminated so the file is only ever appended to. Closing
+the tracer terminates the array, for tools needing a complete file, the
+next run continues it.
+"""
+
+import asyncio
+import json
+import os
+import random
+from itertools import count
+from logging import getLogger
+from time import perf_counter
+from weakref import WeakKeyDictionary
+
+from ..utils import current_task
+
+
+class Trace(object):
+    """Trace context of an inbound frame."""
+
+    __slots__ = ('id', 'channel', 'received', 'command')
+
+    def __init__(self, trace_id, channel, received):
+        self.id = trace_id
+        self.channel = channel
+        self.received = received
+        self.command = None
+
+
+class Tracer(object):
+    """
+    Records spans of traced frames and exports them to a file.
+
+    Recorded spans: "decode" (frame split and utf-8 decode), "parse" (the
+    _rcmd_* parser), "dispatch" (handler scheduled until it runs), "handler"
+    (the on* handler), "send" (_send_command) and "reply" (frame receipt
+    until a command was sent while handling it).
+    """
+
+    path = None
+    sample_rate = 1.0
+    buffer_size = 1000
+
+    _events = None
+    _file = None
+    _ids = None
+    _log = None
+    _pid = None
+    _tasks = None
+
+    def __init__(self, path, sample_rate=1.0, buffer_size=1000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+
+        self._events = []
+        self._ids = count(1)
+        self._log = getLogger(type(self).__name__)
+        self._pid = os.getpid()
+        self._tasks = WeakKeyDictionary()
+
+
+    def begin(self, channel, received, decode_started):
+        """
+        Start a trace for a frame.
+
+        @type received: float
+        @param received: perf_counter() when the data arrived
+        @type decode_started: float
+        @param decode_started: perf_counter() when the frame was split off
+
+        @rtype: Trace or None
+        @return: None if not sampled
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+
+        trace = Trace(next(self._ids), channel.name or type(channel).__name__,
+                received)
+
+        self.span(trace, 'decode', decode_started, perf_counter())
+        return trace
+
+
+    def bind(self, trace):
+        """Make `trace` the trace context of the running task."""
+        task = current_task()
+        if task is not None and trace is not None:
+            self._tasks[task] = trace
+
+
+    def current(self):
+        """
+        Trace context of the running task.
+
+        @rtype: Trace or None
+        """
+        task = current_task()
+        if task is None:
+            return None
+        return self._tasks.get(task)
+
+
+    def span(self, trace, name, start, end, **args):
+        args['channel'] = trace.channel
+        args['trace'] = trace.id
+        if trace.command is not None:
+            args['command'] = trace.command
+
+        self._events.append({
+            'name': name,
+            'cat': 'chatango',
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self._pid,
+            'tid': trace.id,
+            'args': args,
+        })
+
+        if len(self._events) >= self.buffer_size:
+            self.flush()
+
+
+    @asyncio.coroutine
+    def _traced(self, trace, name, scheduled, coro):
+        self.bind(trace)
+        started = perf_counter()
+        self.span(trace, 'dispatch', scheduled, started, handler=name)
+        try:
+            result = yield from coro
+        finally:
+            self.span(trace, 'handler', started, perf_counter(), handler=name)
+        return result
+
+
+    def traced(self, name, coro):
+        """
+        Carry the running task's trace context into a handler coroutine.
+
+        @type name: str
+        @param name: handler name
+
+        @return: coroutine, unchanged when there is no trace context
+        """
+        trace = self.current()
+        if trace is None:
+            return coro
+        return self._traced(trace, name, perf_counter(), coro)
+
+
+    def sent(self, command, started):
+        """
+        Record a command sent while handling a traced frame.
+
+        @type command: str
+        @param command: the sent command
+        @type started: float
+        @param started: perf_counter() before the write
+        """
+        trace = self.current()
+        if trace is None:
+            return
+
+        now = perf_counter()
+        self.span(trace, 'send', started, now, sent=command)
+        self.span(trace, 'reply', trace.received, now, sent=command)
+
+
+    def flush(self):
+        if not self._events:
+            return
+
+        try:
+            if self._file is None:
+                self._open()
+
+            for event in self._events:
+                self._file.write(json.dumps(event, separators=(',', ':')))
+                self._file.write(',\n')
+            self._file.flush()
+        except OSError:
+            self._log.exception('Failed to write trace to %s', self.path)
+        finally:
+            self._events = []
+
+
+    def _open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= 2:
+            with open(self.path, 'rb+') as f:
+                f.seek(-2, os.SEEK_END)
+                if f.read() == b']\n':
+                    # terminated by close, the array goes on
+                    f.seek(-2, os.SEEK_END)
+                    f.write(b',\n')
+
+        self._file = open(self.path, 'a')
+        if self._file.tell() == 0:
+            self._file.write('[\n')
+
+
+    def close(self):
+        """Flush, and terminate the array with a metadata event."""
+        self.flush()
+        if self._file is None:
+            return
+
+        try:
+            self._file.write(json.dumps({
+                'name': 'process_name',
+                'ph': 'M',
+                'pid': self._pid,
+                'args': {'name': 'chatangobot'},
+            }, separators=(',', ':')))
+            self._file.write(']\n')
+        except OSError:
+            self._log.exception('Failed to write trace to %s', self.path)
+        finally:
+            self._file.close()
+            self._file = None
@@ -1,5 +1,10 @@
 """Chat room users."""
 
+from collections import namedtuple
+
+UserSnapshot = namedtuple('UserSnapshot', ['name', 'puid', 'nameColor',
+        'fontColor', 'fontFace', 'fontSize'])
+
 _users = {}
 
 class User(object):
@@ -81,6 +86,17 @@ class User(object):
             return set.union(*self._sids.values())
 
 
+    def snapshot(self):
+        """
+        Picklable copy of the User, for use in other processes.
+
+        @rtype: UserSnapshot
+        """
+        return UserSnapshot(name=self.name, puid=self.puid,
+                nameColor=self.nameColor, fontColor=self.fontColor,
+                fontFace=self.fontFace, fontSize=self.fontSize)
+
+
     def __repr__(self):
         return "<User: %s>" % self.name
 
@@ -0,0 +1,269 @@
+"""Matching of messages against a list of words, all at once.
+
+utils.create_word_regex needs a regex per word, tried one after the other.
+WordFilter compiles the whole list into an Aho-Corasick automaton: a message
+is read once, whatever the number of words. Matches need the boundaries of
+create_word_regex, the start or end of the text, a whitespace or one of
+"?!.,;", around them.
+
+Texts and words are normalised before matching, so that evasions match too:
+
+    - format characters, zero width ones included, and combining marks
+      are removed; U+200A, the hair space of room.UNICODE_WHITESPACES, is
+      a whitespace, as for create_word_regex
+    - NFKC, full width and stylised letters become plain ones
+    - letters are lowercased, homoglyphs of latin letters are replaced
+    - whitespace runs become a single space
+
+Words are plain text, one per line in a word list file, "#" starts a
+comment. The file is reloaded when modified, see WordFilter.watch.
+"""
+
+import asyncio
+from collections import deque, namedtuple
+from logging import getLogger
+import os
+import unicodedata
+
+Match = namedtuple('Match', ['pattern', 'start', 'end'])
+Match.__doc__ = """A word found in a text, start and end index the original
+text."""
+
+BOUNDARIES = '?!.,;'
+
+# cyrillic and greek letters drawn like latin ones, after lowercasing
+HOMOGLYPHS = {
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e',
+    'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o',
+    'р': 'p', 'с': 'c', 'т': 't', 'у': 'y',
+    'х': 'x', 'ѕ': 's', 'і': 'i', 'ї': 'i',
+    'ј': 'j', 'ԁ': 'd', 'һ': 'h', 'ɡ': 'g',
+    'α': 'a', 'ε': 'e', 'ι': 'i', 'κ': 'k',
+    'ν': 'v', 'ο': 'o', 'ρ': 'p', 'τ': 't',
+    'υ': 'u', 'χ': 'x',
+}
+
+_fold_cache = {}
+
+
+def _fold(char):
+    """Normal form of a character, empty if removed, ' ' for whitespace."""
+    folded = _fold_cache.get(char)
+    if folded is None:
+        if unicodedata.category(char) in ('Cf', 'Mn', 'Me'):
+            folded = ''
+        elif char.isspace():
+            folded = ' '
+        else:
+            folded = ''.join(HOMOGLYPHS.get(c, c) for c in\
+                    unicodedata.normalize('NFKC', char).lower()\
+                    if unicodedata.category(c) not in ('Cf', 'Mn', 'Me'))
+        if len(_fold_cache) < 65536:
+            _fold_cache[char] = folded
+    return folded
+
+
+def normalize(text):
+    """
+    Normalise a text for matching.
+
+    @rtype: (str, list of int)
+    @return: the normalised text, and the index in the original text of each
+    of its characters
+    """
+    chars = []
+    offsets = []
+    for index, char in enumerate(text):
+        folded = _fold(char)
+        for c in folded:
+            if c == ' ' and chars and chars[-1] == ' ':
+                continue
+            chars.append(c)
+            offsets.append(index)
+    return ''.join(chars), offsets
+
+
+def _is_boundary(char):
+    return char.isspace() or char in BOUNDARIES
+
+
+class _Automaton(object):
+    """Aho-Corasick automaton of normalised words."""
+
+    patterns = None
+    goto = None
+    fail = None
+    output = None
+
+    def __init__(self, words):
+        self.patterns = []
+        self.goto = [{}]
+        self.fail = [0]
+        # per state, (pattern number, length) of the words ending there
+        self.output = [()]
+
+        seen = set()
+        for word in words:
+            key = normalize(word)[0].strip()
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            self._add(key, len(self.patterns))
+            self.patterns.append(word)
+
+        self._link()
+
+
+    def _add(self, key, number):
+        state = 0
+        for char in key:
+            following = self.goto[state].get(char)
+            if following is None:
+                following = self.goto[state][char] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            state = following
+        self.output[state] += ((number, len(key)),)
+
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                link = self.goto[fallback].get(char, 0)
+                self.fail[following] = link
+                # words ending at the fail state end here as well
+                self.output[following] += self.output[link]
+
+
+    def scan(self, text):
+        """
+        Words found in a normalised text, with the boundaries of
+        utils.create_word_regex.
+
+        @rtype: generator of (int, int, int)
+        @return: pattern number, start and end in the normalised text
+        """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        last = len(text) - 1
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if not output[state]:
+                continue
+            if index < last and not _is_boundary(text[index + 1]):
+                continue
+            for number, size in output[state]:
+                start = index - size + 1
+                if start == 0 or _is_boundary(text[start - 1]):
+                    yield number, start, index + 1
+
+
+class WordFilter(object):
+    """Finds the words of a list in texts."""
+
+    path = None
+
+    _log = None
+    _automaton = None
+    _mtime = None
+
+    @property
+    def patterns(self):
+        """The words, as given, without duplicates."""
+        return tuple(self._automaton.patterns)
+
+
+    def __init__(self, words=(), path=None):
+        """
+        @type words: iterable of str
+        @param words: words to find
+        @type path: str
+        @param path: word list file, loaded instead of words
+        """
+        self.path = path
+        self._log = getLogger(type(self).__name__)
+        self._automaton = _Automaton(words)
+        if path is not None:
+            self.reload()
+
+
+    def load(self, words):
+        """
+        Replace the words, the new automaton is swapped in once complete.
+
+        @type words: iterable of str
+        """
+        self._automaton = _Automaton(words)
+
+
+    def reload(self):
+        """
+        Load the word list file, if modified since the last load.
+
+        @rtype: bool
+        @return: whether the words were replaced
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return False
+            with open(self.path, encoding='utf-8') as f:
+                words = [line.partition('#')[0].strip() for line in f]
+        except OSError:
+            self._log.exception('Cannot read the word list %s', self.path)
+            return False
+
+        self.load(word for word in words if word)
+        self._mtime = mtime
+        self._log.info('Loaded %i words from %s',
+                len(self._automaton.patterns), self.path)
+        return True
+
+
+    @asyncio.coroutine
+    def watch(self, interval=5.0):
+        """Reload the word list file whenever modified, until cancelled."""
+        while True:
+            yield from asyncio.sleep(interval)
+            self.reload()
+
+
+    def finditer(self, text):
+        """
+        Words found in a text, in the order they end.
+
+        @type text: str
+        @rtype: generator of Match
+        """
+        automaton = self._automaton
+        normalized, offsets = normalize(text)
+        for number, start, end in automaton.scan(normalized):
+            yield Match(automaton.patterns[number], offsets[start],
+                    offsets[end - 1] + 1)
+
+
+    def search(self, text):
+        """
+        First word found in a text.
+
+        @type text: str
+        @rtype: Match or None
+        """
+        for match in self.finditer(text):
+            return match
+        return None
+
+
+    def __contains__(self, text):
+        return self.search(text) is not None
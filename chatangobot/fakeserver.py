@@ -0,0 +1,531 @@
+"""Local stand-in for Chatango servers, for load and integration testing.
+
+One port speaks both the room and the PM protocol, told apart by the first
+command (bauth, tlogin or mhs). Point a bot at it with these settings:
+
+    "servers": {
+        "chatroom_host": "127.0.0.1", "chatroom_port": 8443,
+        "pm_host": "127.0.0.1", "pm_port": 8443,
+        "anonymous_pm_host": "127.0.0.1", "anonymous_pm_port": 8443,
+        "login_url": "http://127.0.0.1:8080/login"
+    }
+
+Usage:
+
+    python -m chatangobot.fakeserver --port 8443 --login-port 8080 \\
+            --rooms 100 --rate 5
+"""
+
+import argparse
+import asyncio
+import random
+from collections import deque
+from itertools import count
+from logging import basicConfig, getLogger, INFO
+
+from .core.clock import time
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing',
+        'elit', 'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore',
+        'et', 'dolore', 'magna', 'aliqua', 'http://example.com/image.png')
+
+HISTORY_SIZE = 50
+TERMINATOR = b'\r\n\x00'
+
+
+class FakeRoom(object):
+    """State of a room on the fake server."""
+
+    name = None
+    owner = 'owner'
+    mods = None
+    sessions = None
+    history = None
+    banlist = None
+    unbanlist = None
+    participants = None
+
+    def __init__(self, name):
+        self.name = name
+        self.mods = ['mod1', 'mod2']
+        self.sessions = set()
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.banlist = {}
+        self.unbanlist = {}
+        # session id to (name, puid)
+        self.participants = {}
+
+
+class FakeSession(asyncio.Protocol):
+    """A client connection."""
+
+    server = None
+    kind = None
+    name = None
+    room = None
+    sid = None
+    puid = None
+    ip = None
+
+    _buf = None
+    _log = None
+    _transport = None
+
+    def __init__(self, server):
+        self.server = server
+        self._buf = bytearray()
+        self._log = getLogger(type(self).__name__)
+
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self.sid = '%016i' % random.randrange(10 ** 15, 10 ** 16)
+        self.puid = str(random.randrange(10 ** 7, 10 ** 8))
+        self.ip = '127.0.0.%i' % random.randrange(1, 255)
+
+
+    def connection_lost(self, exc):
+        self._transport = None
+        self.server.session_closed(self)
+
+
+    def data_received(self, data):
+        self._buf.extend(data)
+        while True:
+            pos = self._buf.find(b'\x00')
+            if pos < 0:
+                break
+
+            frame = bytes(self._buf[:pos]).decode('utf-8', errors='replace')
+            del self._buf[:pos + 1]
+
+            frame = frame.rstrip('\r\n')
+            if not frame:
+                continue
+
+            cmd, _, args = frame.partition(':')
+            handler = getattr(self, '_cmd_' + cmd, None)
+            if handler is None:
+                self._log.debug('Unhandled %r', frame)
+            else:
+                handler(args.split(':') if args else [])
+
+
+    def send(self, *args):
+        if self._transport is not None and not self._transport.is_closing():
+            self._transport.write(':'.join(args).encode('utf-8') + TERMINATOR)
+            self.server.frames_sent += 1
+
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+
+    ## Room protocol
+
+
+    def _cmd_bauth(self, args):
+        self.kind = 'room'
+        self.room = self.server.get_room(args[0])
+        self.name = args[2] if len(args) > 2 and args[2] else None
+        logged_in = len(args) > 3 and args[3] not in ('', 'None')
+
+        self.send('ok', self.room.owner, self.sid, 'M' if logged_in else 'N',
+                self.name or '', '%.2f' % time(), self.ip,
+                ';'.join(mod + ',0' for mod in self.room.mods))
+
+        # i frames carry the msgid instead of the temporary id
+        for frame in reversed(self.room.history):
+            self.send('i', *(frame[1:6] + (frame[0],) + frame[7:]))
+        self.send('inited')
+
+        self.room.sessions.add(self)
+        if self.name:
+            self.room.participants[self.sid] = (self.name, self.puid)
+            self.server.broadcast(self.room, 'participant', '1', self.sid,
+                    self.puid, self.name, 'None', '%.2f' % time())
+        self.server.broadcast(self.room, 'n',
+                '%x' % len(self.room.participants))
+
+
+    def _cmd_blogin(self, args):
+        self.name = args[0]
+
+
+    def _cmd_g_participants(self, args):
+        now = '%.2f' % time()
+        self.send('g_participants', ';'.join('%s:%s:%s:%s:None' % (sid, now,
+                puid, name) for sid, (name, puid) in\
+                self.room.participants.items()))
+
+
+    def _cmd_getpremium(self, args):
+        self.send('premium', '0', '0')
+
+
+    def _cmd_blocklist(self, args):
+        if args[0] == 'block':
+            records = self.room.banlist
+            cmd = 'blocklist'
+        else:
+            records = self.room.unbanlist
+            cmd = 'unblocklist'
+
+        # newest first, paged by time like the real server
+        entries = sorted(records.values(), key=lambda rec: -rec[3])
+        if len(args) > 1 and args[1]:
+            before = float(args[1])
+            entries = [rec for rec in entries if rec[3] < before]
+        size = int(args[3]) if len(args) > 3 else 500
+
+        self.send(cmd, ';'.join('%s:%s:%s:%.2f:%s' % rec for rec in\
+                entries[:size]))
+
+
+    def _cmd_bmsg(self, args):
+        # bmsg:tl2r:<body>
+        self.server.post_message(self.room, self.name or '',
+                ':'.join(args[1:]), puid=self.puid, ip=self.ip)
+
+
+    def _cmd_delmsg(self, args):
+        self.server.delete_message(self.room, args[0])
+
+
+    def _cmd_delallmsg(self, args):
+        unid, ip = args[0], args[1]
+        msgids = [frame[0] for frame in self.room.history\
+                if frame[5] == unid or frame[7] == ip]
+        if msgids:
+            self.server.broadcast(self.room, 'deleteall', *msgids)
+
+
+    def _cmd_block(self, args):
+        if len(args) < 3 or self.kind != 'room':
+            # pm block:name:name:S
+            self.send('blocked', args[0])
+            return
+
+        unid, ip, name = args[0], args[1], args[2]
+        record = (unid, ip, name, time(), self.name or '')
+        self.room.banlist[name] = record
+        self.server.broadcast(self.room, 'blocked', unid, ip, name,
+                self.name or '', '%.2f' % record[3])
+
+
+    def _cmd_removeblock(self, args):
+        unid, ip, name = args[0], args[1], args[2]
+        if self.room.banlist.pop(name, None) is None:
+            return
+        record = (unid, ip, name, time(), self.name or '')
+        self.room.unbanlist[name] = record
+        self.server.broadcast(self.room, 'unblocked', unid, ip, name,
+                self.name or '', '%.2f' % record[3])
+
+
+    ## PM protocol
+
+
+    def _cmd_tlogin(self, args):
+        self.kind = 'pm'
+        self.name = self.server.tokens.get(args[0])
+        if self.name is None:
+            self.send('DENIED')
+            self.close()
+            return
+
+        self.server.pm_sessions[self.name] = self
+        self.send('OK')
+
+
+    def _cmd_mhs(self, args):
+        self.kind = 'anonpm'
+        self.name = args[2]
+        status = 'online' if args[2] in self.server.pm_sessions else 'offline'
+        self.send('mhs', args[2], status)
+
+
+    def _cmd_wl(self, args):
+        now = '%i' % time()
+        self.send('wl', *[field for name in self.server.pm_sessions\
+                if name != self.name for field in (name, now, 'on', '0')])
+
+
+    def _cmd_getblock(self, args):
+        self.send('block_list')
+
+
+    def _cmd_wladd(self, args):
+        pass
+
+
+    def _cmd_wldelete(self, args):
+        pass
+
+
+    def _cmd_msg(self, args):
+        target = self.server.pm_sessions.get(args[0].lower())
+        if target is not None:
+            target.send('msg', self.name or 'anon', self.name or 'anon',
+                    'unknown', '%.2f' % time(), '0', ':'.join(args[1:]))
+            self.server.messages_posted += 1
+
+
+class FakeChatangoServer(object):
+    """
+    Room and PM server with synthetic traffic.
+
+    Rooms are created when first joined, `rooms` more are created upfront.
+    Every room with connected clients receives `rate` messages per second
+    from `users` synthetic users, who also join and leave from time to time.
+    A fraction `orphan_rate` of synthetic messages gets a b frame but never
+    the confirming u frame.
+    """
+
+    rooms = None
+    pm_sessions = None
+    tokens = None
+
+    rate = 0.0
+    users = 50
+    orphan_rate = 0.0
+    frames_sent = 0
+    messages_posted = 0
+
+    _log = None
+    _msgids = None
+    _server = None
+    _traffic = None
+
+    def __init__(self, rooms=0, rate=0.0, users=50, orphan_rate=0.0):
+        self.rooms = {}
+        self.pm_sessions = {}
+        self.tokens = {}
+        self.rate = rate
+        self.users = users
+        self.orphan_rate = orphan_rate
+
+        self._log = getLogger(type(self).__name__)
+        self._msgids = count(1)
+
+        for index in range(rooms):
+            self.get_room('room%i' % index)
+
+
+    def get_room(self, name):
+        name = name.lower()
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = FakeRoom(name)
+        return room
+
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=8443):
+        self._server = yield from asyncio.get_event_loop().create_server(
+                lambda: FakeSession(self), host, port)
+
+        if self.rate > 0:
+            self._traffic = asyncio.ensure_future(self._generate_traffic())
+
+        self._log.info('Fake Chatango server on %s:%i', host, port)
+
+
+    def stop(self):
+        if self._traffic is not None:
+            self._traffic.cancel()
+            self._traffic = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+
+    def session_closed(self, session):
+        if session.kind == 'room':
+            session.room.sessions.discard(session)
+            if session.room.participants.pop(session.sid, None):
+                self.broadcast(session.room, 'participant', '0', session.sid,
+                        session.puid, session.name, 'None',
+                        '%.2f' % time())
+        elif session.kind == 'pm':
+            if self.pm_sessions.get(session.name) is session:
+                del self.pm_sessions[session.name]
+
+
+    def broadcast(self, room, *args):
+        for session in list(room.sessions):
+            session.send(*args)
+
+
+    def post_message(self, room, name, body, puid='', ip='127.0.0.1',
+            unid=None, confirm=True):
+        """
+        Send a b and u frame pair to every client of the room.
+
+        @type confirm: bool
+        @param confirm: False leaves out the u frame
+        """
+        msgid = '%i' % next(self._msgids)
+        tempid = str(random.randrange(10 ** 5, 10 ** 6))
+        if unid is None:
+            unid = '%032x' % (hash(name) & (2 ** 128 - 1))
+        anon_id = '' if name else str(random.randrange(1000, 9999))
+
+        frame = (msgid, '%.2f' % time(), name, anon_id, puid, unid, tempid,
+                ip, '', '', '<n000/><f x11000="0">' + body)
+
+        self.broadcast(room, 'b', *frame[1:])
+        if confirm:
+            room.history.append(frame)
+            self.broadcast(room, 'u', tempid, msgid)
+        self.messages_posted += 1
+        return msgid
+
+
+    def delete_message(self, room, msgid):
+        for frame in room.history:
+            if frame[0] == msgid:
+                room.history.remove(frame)
+                self.broadcast(room, 'delete', msgid)
+                return
+
+
+    def _synthetic_event(self, room):
+        index = random.randrange(self.users)
+        name = 'user%i' % index
+        roll = random.random()
+        if roll < 0.02:
+            sid = 'synthetic%i' % index
+            if sid in room.participants:
+                del room.participants[sid]
+                self.broadcast(room, 'participant', '0', sid, str(index),
+                        name, 'None', '%.2f' % time())
+            else:
+                room.participants[sid] = (name, str(index))
+                self.broadcast(room, 'participant', '1', sid, str(index),
+                        name, 'None', '%.2f' % time())
+            self.broadcast(room, 'n', '%x' % len(room.participants))
+        else:
+            body = ' '.join(random.choice(WORDS)\
+                    for _ in range(random.randrange(1, 12)))
+            self.post_message(room, name, body, puid=str(index),
+                    ip='10.0.%i.%i' % (index // 250, index % 250 + 1),
+                    confirm=random.random() >= self.orphan_rate)
+
+
+    @asyncio.coroutine
+    def _generate_traffic(self, tick=0.05):
+        pending = {}
+        while True:
+            yield from asyncio.sleep(tick)
+            for room in list(self.rooms.values()):
+                if not room.sessions:
+                    continue
+                due = pending.get(room.name, 0.0) + self.rate * tick
+                while due >= 1.0:
+                    due -= 1.0
+                    self._synthetic_event(room)
+                pending[room.name] = due
+
+
+class FakeLoginServer(object):
+    """Answers the PM login form with an auth.chatango.com cookie."""
+
+    chatango = None
+
+    _server = None
+
+    def __init__(self, chatango):
+        self.chatango = chatango
+
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=8080):
+        self._server = yield from asyncio.start_server(self._handle, host,
+                port)
+
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        try:
+            yield from reader.readline()
+            length = 0
+            while True:
+                line = yield from reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                if key.strip().lower() == 'content-length':
+                    length = int(value.strip())
+
+            body = yield from reader.readexactly(length)
+            form = dict(pair.split('=', 1) for pair in\
+                    body.decode('utf-8').split('&') if '=' in pair)
+
+            token = '%032x' % random.getrandbits(128)
+            self.chatango.tokens[token] = form.get('user_id', '').lower()
+
+            writer.write(('HTTP/1.0 200 OK\r\n'
+                    'Set-Cookie: auth.chatango.com=%s; Path=/\r\n'
+                    'Content-Length: 0\r\n\r\n' % token).encode('ascii'))
+            yield from writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Chatango server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--login-port', type=int, default=8080)
+    parser.add_argument('--rooms', type=int, default=0,
+            help='rooms created upfront, named room0, room1, ...')
+    parser.add_argument('--rate', type=float, default=0.0,
+            help='synthetic messages per second per joined room')
+    parser.add_argument('--users', type=int, default=50,
+            help='synthetic users per room')
+    args = parser.parse_args()
+
+    basicConfig(level=INFO)
+    log = getLogger('fakeserver')
+
+    loop = asyncio.get_event_loop()
+    server = FakeChatangoServer(rooms=args.rooms, rate=args.rate,
+            users=args.users)
+    login = FakeLoginServer(server)
+    try:
+        loop.run_until_complete(server.start(args.host, args.port))
+        loop.run_until_complete(login.start(args.host, args.login_port))
+
+        @asyncio.coroutine
+        def report():
+            last = 0
+            while True:
+                yield from asyncio.sleep(10)
+                log.info('%i clients, %.1f messages/s, %i frames sent',
+                        sum(len(room.sessions) for room in\
+                        server.rooms.values()) + len(server.pm_sessions),
+                        (server.messages_posted - last) / 10.0,
+                        server.frames_sent)
+                last = server.messages_posted
+
+        loop.run_until_complete(report())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        login.stop()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Replay a capture file, recorded with recorder.enabled, into a bot.
+
+Usage:
+
+    SETTINGS_FILE=settings.json python -m chatangobot.replay \\
+            captures/room-myroom.rec [--speed 1.0] [--manager mybot:Bot] \\
+            [--profile]
+"""
+
+import argparse
+import asyncio
+import cProfile
+import os
+import pstats
+
+from .core.anonpm import AnonPM
+from .core.manager import Manager
+from .core.recorder import Replayer
+from .utils import load_class
+
+
+def create_channel(mgr, loop, path):
+    """Create the channel a capture file was recorded from."""
+    name = os.path.basename(path)
+    if name.endswith('.rec'):
+        name = name[:-4]
+    kind, _, channel_name = name.partition('-')
+
+    if kind == 'pm':
+        return mgr.pm_class(loop=loop, mgr=mgr)
+    if kind == 'anonpm':
+        return AnonPM(name=channel_name, loop=loop, mgr=mgr)
+
+    room = mgr.room_class(name=channel_name, loop=loop, mgr=mgr)
+    mgr.rooms[channel_name] = room
+    return room
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Chatango traffic.')
+    parser.add_argument('capture', help='capture file')
+    parser.add_argument('--speed', type=float, default=None,
+            help='reproduce original timing, 2.0 is twice as fast')
+    parser.add_argument('--manager', default=None,
+            help='Manager subclass to use, package.module:ClassName')
+    parser.add_argument('--profile', action='store_true',
+            help='print cProfile statistics')
+    args = parser.parse_args()
+
+    manager_class = Manager
+    if args.manager:
+        manager_class = load_class(args.manager)
+
+    loop = asyncio.get_event_loop()
+    try:
+        bot = manager_class(loop=loop, pm=False)
+        channel = create_channel(bot, loop, args.capture)
+        replayer = Replayer(channel, args.capture, speed=args.speed)
+
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler is not None:
+            profiler.enable()
+
+        loop.run_until_complete(replayer.run())
+
+        if profiler is not None:
+            profiler.disable()
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
+        print('%i records, %i bytes in %.3fs (%.0f records/s), %i sent' % (
+                replayer.records, replayer.size, replayer.elapsed,
+                replayer.records / replayer.elapsed if replayer.elapsed\
+                        else 0, len(replayer.transport.written)))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,493 @@
+"""Spread rooms over a few supervised worker processes.
+
+Rooms are assigned to workers by consistent hashing, so adding or removing
+rooms, or workers, only moves the rooms that have to move. Crashed workers
+are restarted with exponential backoff, SIGTERM and SIGINT stop every
+worker gracefully, SIGHUP reloads the rooms file. With bus.enabled the
+supervisor also runs the broker workers talk to each other through, see
+core.bus, and rooms moved by a rebalance are migrated live: the new worker
+connects and takes the state over before the old one leaves.
+
+Usage:
+
+    SETTINGS_FILE=settings.json python -m chatangobot.supervisor \\
+            [--manager mybot:Bot] [--workers 4] [--rooms-file rooms.txt] \\
+            [--no-pm] [room ...]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+from bisect import bisect
+from hashlib import md5
+from logging import getLogger
+from signal import SIGHUP, SIGINT, SIGTERM, SIG_IGN, signal
+
+from .core.bus import Broker
+from .core.settings import conf
+from .utils import load_class
+
+DEFAULT_MANAGER = 'chatangobot.core.manager:Manager'
+
+CMD_JOIN = 'join'
+CMD_LEAVE = 'leave'
+CMD_MIGRATE = 'migrate'
+CMD_STOP = 'stop'
+
+
+def _hash(key):
+    return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring with virtual nodes."""
+
+    replicas = 100
+
+    _keys = None
+    _nodes = None
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._keys = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            key = _hash('%s#%i' % (node, replica))
+            pos = bisect(self._keys, key)
+            self._keys.insert(pos, key)
+            self._nodes.insert(pos, node)
+
+
+    def remove(self, node):
+        pairs = [(key, owner) for key, owner in zip(self._keys, self._nodes)\
+                if owner != node]
+        self._keys = [key for key, _ in pairs]
+        self._nodes = [owner for _, owner in pairs]
+
+
+    def get(self, key):
+        """The node owning `key`, or None if the ring is empty."""
+        if not self._keys:
+            return None
+        pos = bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[pos]
+
+
+class Worker(object):
+    """Runs inside a worker process, applies the supervisor's commands."""
+
+    mgr = None
+    done = None
+
+    _conn = None
+    _loop = None
+    _log = None
+    _stopping = False
+
+    def __init__(self, mgr, conn, loop):
+        self.mgr = mgr
+        self._conn = conn
+        self._loop = loop
+        self._log = getLogger('Worker(%i)' % os.getpid())
+        self.done = asyncio.Future(loop=loop)
+
+
+    def on_readable(self):
+        try:
+            while self._conn.poll():
+                command = self._conn.recv()
+                self.execute(*command)
+        except (EOFError, OSError):
+            # the supervisor is gone
+            self.stop()
+
+
+    def execute(self, command, *args):
+        if command == CMD_JOIN:
+            asyncio.ensure_future(self.mgr.joinRoom(args[0]))
+        elif command == CMD_LEAVE:
+            asyncio.ensure_future(self.mgr.leaveRoom(args[0]))
+        elif command == CMD_MIGRATE:
+            asyncio.ensure_future(self.mgr.migrateRoom(args[0]))
+        elif command == CMD_STOP:
+            self.stop()
+        else:
+            self._log.warning('Unknown command %r', command)
+
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        self._loop.remove_reader(self._conn.fileno())
+        asyncio.ensure_future(self._shutdown())
+
+
+    @asyncio.coroutine
+    def _shutdown(self):
+        yield from self.mgr.disconnect()
+        self.done.set_result(None)
+
+
+def worker_main(manager_spec, pm, conn):
+    """Entry point of worker processes."""
+    signal(SIGINT, SIG_IGN)
+    signal(SIGHUP, SIG_IGN)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        mgr = load_class(manager_spec)(loop=loop, pm=pm)
+        worker = Worker(mgr, conn, loop)
+
+        loop.add_signal_handler(SIGTERM, worker.stop)
+        loop.add_reader(conn.fileno(), worker.on_readable)
+        mgr.connect()
+
+        loop.run_until_complete(worker.done)
+    finally:
+        loop.close()
+
+
+class WorkerHandle(object):
+    """Supervisor side of a worker process."""
+
+    index = None
+    process = None
+    conn = None
+    rooms = None
+
+    failures = 0
+    started_at = None
+    restart_at = None
+    # once removed, when to send CMD_STOP and to terminate the process
+    stop_at = None
+    kill_at = None
+
+    def __init__(self, index):
+        self.index = index
+        self.rooms = set()
+
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+    def send(self, *command):
+        try:
+            self.conn.send(command)
+        except (OSError, AttributeError):
+            # dead, rooms are sent again on restart
+            pass
+
+
+class Supervisor(object):
+    """
+    Spawns `workers` processes and keeps `rooms` spread over them.
+
+    The first worker also connects to the pm, unless `pm` is False.
+    """
+
+    manager_spec = None
+    pm = True
+    rooms = None
+    workers = None
+    broker = None
+
+    backoff = 1.0 # seconds, doubled on every quick crash
+    max_backoff = 60.0
+    stable_after = 30.0 # seconds alive to reset the backoff
+    stop_timeout = 15.0
+    migrate_timeout = 60.0 # seconds before a removed worker is stopped
+    stopping = False
+
+    _loop = None
+    _log = None
+    _ring = None
+    _watch = None
+    _retired = None
+
+    def __init__(self, loop, manager_spec=DEFAULT_MANAGER, workers=None,
+            pm=True):
+        self.manager_spec = manager_spec
+        self.pm = pm
+        self.rooms = set()
+        self.workers = []
+
+        self._retired = []
+        self._loop = loop
+        self._log = getLogger(type(self).__name__)
+        self._ring = HashRing()
+
+        if conf['bus']['enabled']:
+            self.broker = Broker(conf['bus']['path'])
+
+        for index in range(workers or os.cpu_count() or 1):
+            self._add_worker()
+
+
+    def _add_worker(self):
+        handle = WorkerHandle(len(self.workers))
+        self.workers.append(handle)
+        self._ring.add(handle.index)
+        return handle
+
+
+    def owner(self, room_name):
+        """The WorkerHandle a room is assigned to."""
+        return self.workers[self._ring.get(room_name)]
+
+
+    def start(self):
+        if self.broker is not None:
+            # workers retry until it is listening
+            asyncio.ensure_future(self.broker.start())
+        for handle in self.workers:
+            self._spawn(handle)
+        self._watch = asyncio.ensure_future(self._watch_workers())
+
+
+    def _spawn(self, handle):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        handle.conn = parent_conn
+        handle.process = multiprocessing.Process(target=worker_main,
+                args=(self.manager_spec, self.pm and handle.index == 0,
+                child_conn), name='chatangobot-worker-%i' % handle.index)
+
+        handle.process.start()
+        child_conn.close()
+        handle.started_at = self._loop.time()
+        handle.restart_at = None
+
+        for room_name in handle.rooms:
+            handle.send(CMD_JOIN, room_name)
+
+        self._log.info('Worker %i started, pid %i, %i rooms', handle.index,
+                handle.process.pid, len(handle.rooms))
+
+
+    @asyncio.coroutine
+    def _watch_workers(self, interval=1.0):
+        while not self.stopping:
+            yield from asyncio.sleep(interval)
+            now = self._loop.time()
+            for handle in self.workers:
+                if handle.alive or self.stopping:
+                    continue
+
+                if handle.restart_at is None:
+                    if now - handle.started_at >= self.stable_after:
+                        handle.failures = 0
+                    delay = min(self.backoff * 2 ** handle.failures,
+                            self.max_backoff)
+                    handle.failures += 1
+                    handle.restart_at = now + delay
+
+                    self._log.warning('Worker %i exited with %s, restarting '
+                            'in %.0fs', handle.index,
+                            handle.process.exitcode, delay)
+
+                elif now >= handle.restart_at:
+                    self._spawn(handle)
+
+            self._reap(now)
+
+
+    def _retire(self, handle):
+        """Stop a removed worker, once its rooms were taken over."""
+        handle.stop_at = self._loop.time()
+        if self.broker is not None:
+            handle.stop_at += self.migrate_timeout
+        self._retired.append(handle)
+        self._reap(self._loop.time())
+
+
+    def _reap(self, now):
+        """Stop retired workers when due, join them or terminate them."""
+        for handle in list(self._retired):
+            if not handle.alive:
+                if handle.process is not None:
+                    handle.process.join()
+                self._retired.remove(handle)
+
+            elif handle.kill_at is not None:
+                if now >= handle.kill_at:
+                    self._log.warning('Worker %i did not stop, terminating',
+                            handle.index)
+                    handle.process.terminate()
+                    handle.kill_at = now + self.stop_timeout
+
+            elif now >= handle.stop_at:
+                handle.send(CMD_STOP)
+                handle.kill_at = now + self.stop_timeout
+
+
+    def add_room(self, room_name):
+        room_name = room_name.lower()
+        if room_name in self.rooms:
+            return
+        self.rooms.add(room_name)
+
+        handle = self.owner(room_name)
+        handle.rooms.add(room_name)
+        handle.send(CMD_JOIN, room_name)
+
+
+    def remove_room(self, room_name):
+        room_name = room_name.lower()
+        if room_name not in self.rooms:
+            return
+        self.rooms.remove(room_name)
+
+        handle = self.owner(room_name)
+        handle.rooms.discard(room_name)
+        handle.send(CMD_LEAVE, room_name)
+
+
+    def set_rooms(self, room_names):
+        """Join and leave rooms to match `room_names`."""
+        room_names = set(name.lower() for name in room_names)
+        for room_name in self.rooms - room_names:
+            self.remove_room(room_name)
+        for room_name in room_names - self.rooms:
+            self.add_room(room_name)
+
+
+    def set_worker_count(self, count):
+        """Grow or shrink the number of workers, moving only needed rooms."""
+        while len(self.workers) < count:
+            self._spawn(self._add_worker())
+
+        removed = self.workers[max(count, 1):]
+        del self.workers[max(count, 1):]
+        for handle in removed:
+            self._ring.remove(handle.index)
+
+        # once the ring is final, so each room moves only once
+        for handle in removed:
+            for room_name in list(handle.rooms):
+                self._move(room_name, handle, self.owner(room_name))
+            self._retire(handle)
+
+        self._rebalance()
+
+
+    def _move(self, room_name, source, target):
+        source.rooms.discard(room_name)
+        target.rooms.add(room_name)
+        if self.broker is not None and source.alive:
+            # the source leaves once the target took the room over
+            target.send(CMD_MIGRATE, room_name)
+        else:
+            source.send(CMD_LEAVE, room_name)
+            target.send(CMD_JOIN, room_name)
+
+
+    def _rebalance(self):
+        for handle in self.workers:
+            for room_name in list(handle.rooms):
+                owner = self.owner(room_name)
+                if owner is not handle:
+                    self._move(room_name, handle, owner)
+
+        for room_name in self.rooms:
+            owner = self.owner(room_name)
+            if room_name not in owner.rooms:
+                owner.rooms.add(room_name)
+                owner.send(CMD_JOIN, room_name)
+
+
+    @asyncio.coroutine
+    def stop(self):
+        """Ask every worker to disconnect, terminate the ones that hang."""
+        self.stopping = True
+        if self._watch is not None:
+            self._watch.cancel()
+
+        handles = self.workers + self._retired
+        for handle in handles:
+            handle.send(CMD_STOP)
+
+        deadline = self._loop.time() + self.stop_timeout
+        while any(handle.alive for handle in handles) and\
+                self._loop.time() < deadline:
+            yield from asyncio.sleep(0.1)
+
+        for handle in handles:
+            if handle.alive:
+                self._log.warning('Worker %i did not stop, terminating',
+                        handle.index)
+                handle.process.terminate()
+            if handle.process is not None:
+                handle.process.join()
+
+        if self.broker is not None:
+            self.broker.close()
+
+
+def read_rooms_file(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f\
+                if line.strip() and not line.startswith('#')]
+
+
+def run(loop, supervisor, wanted_rooms):
+    """
+    Start `supervisor` and block until SIGINT or SIGTERM stopped it.
+
+    @type wanted_rooms: callable
+    @param wanted_rooms: returns the room names, called again on SIGHUP
+    """
+    stopped = asyncio.Future(loop=loop)
+
+    def on_stop():
+        if supervisor.stopping:
+            return
+        task = asyncio.ensure_future(supervisor.stop())
+        task.add_done_callback(lambda _: stopped.set_result(None))
+
+    loop.add_signal_handler(SIGINT, on_stop)
+    loop.add_signal_handler(SIGTERM, on_stop)
+    loop.add_signal_handler(SIGHUP, lambda: supervisor.set_rooms(
+            wanted_rooms()))
+    try:
+        supervisor.start()
+        supervisor.set_rooms(wanted_rooms())
+        loop.run_until_complete(stopped)
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run rooms in workers.')
+    parser.add_argument('rooms', nargs='*', help='room names')
+    parser.add_argument('--manager', default=DEFAULT_MANAGER,
+            help='Manager subclass, package.module:ClassName')
+    parser.add_argument('--workers', type=int, default=None,
+            help='worker processes, default is one per core')
+    parser.add_argument('--rooms-file', default=None,
+            help='one room name per line, reloaded on SIGHUP')
+    parser.add_argument('--no-pm', dest='pm', action='store_false',
+            help='do not connect to the pm')
+    args = parser.parse_args()
+
+    def wanted_rooms():
+        rooms = list(args.rooms)
+        if args.rooms_file:
+            rooms.extend(read_rooms_file(args.rooms_file))
+        return rooms
+
+    loop = asyncio.get_event_loop()
+    run(loop, Supervisor(loop, manager_spec=args.manager, workers=args.workers,
+            pm=args.pm), wanted_rooms)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,23 @@ import os
 import re
 from datetime import datetime
 from email.utils import parsedate_tz, mktime_tz
+from importlib import import_module
 from pytz import utc
 
 
 def coro_later(loop, delay, coroutine):
-    loop.call_later(delay, lambda: asyncio.ensure_future(coroutine))
+    loop.call_later(delay, lambda: asyncio.ensure_future(coroutine, loop=loop))
+
+
+def current_task(loop=None):
+    """The running asyncio.Task, or None."""
+    try:
+        return asyncio.current_task(loop)
+    except AttributeError:
+        # python < 3.7
+        return asyncio.Task.current_task(loop)
+    except RuntimeError:
+        return None
 
 
 def load_module(basedir, package, module_name):
@@ -37,6 +49,12 @@ def load_module(basedir, package, module_name):
     return module
 
 
+def load_class(spec):
+    """Load a class by "package.module:ClassName"."""
+    module_name, class_name = spec.split(':', 1)
+    return getattr(import_module(module_name), class_name)
+
+
 def create_word_regex(word):
     return re.compile(r'(^|[\s?!.,;])' + word + r'($|[\s?!.,;])')
 
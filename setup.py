@@ -12,7 +12,7 @@ setup(
     author='Fahri Reza',
     author_email='dozymoe@gmail.com',
     description='asyncio implementation of Chatango bot (ch.py).',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     include_package_data=True,
     platforms='any',
     license='MIT',
@@ -0,0 +1,38 @@
+import asyncio
+import os
+import socket
+
+import pytest
+
+os.environ['SETTINGS_FILE'] = os.path.join(os.path.dirname(__file__),
+        'settings.json')
+
+from chatangobot.core.clock import Clock, set_clock, use_virtual_time
+from chatangobot.core.settings import conf
+from chatangobot.fakeserver import FakeChatangoServer
+
+
+@pytest.fixture
+def loop():
+    """A VirtualTimeLoop, the current loop and clock during the test."""
+    loop = use_virtual_time()
+    yield loop
+    # lets pings of disconnected channels, sleeping 10 seconds, end
+    loop.run_until_complete(asyncio.sleep(10))
+    loop.close()
+    asyncio.set_event_loop(None)
+    set_clock(Clock())
+
+
+@pytest.fixture
+def server(loop, monkeypatch):
+    """A FakeChatangoServer rooms connect to."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setitem(conf['servers'], 'chatroom_port', port)
+
+    server = FakeChatangoServer()
+    loop.run_until_complete(server.start(port=port))
+    yield server
+    server.stop()
@@ -0,0 +1,81 @@
+import glob
+import os
+import types
+
+from chatangobot.core.archive import Archive
+
+ROOM = types.SimpleNamespace(name='r', _export_message=lambda msg: msg)
+
+
+def _record(index):
+    return [str(index), 1000.0 + index, 'user%i' % (index % 7), '',
+            'message number %i' % index, '', '', '', '', '', '', '']
+
+
+def _archive(loop, directory):
+    return Archive(loop, directory, block_size=32, segment_size=2048)
+
+
+def _fill(loop, archive, count=1000):
+    for index in range(count):
+        archive.append(ROOM, _record(index))
+        # delivered twice, by a reconnection
+        if index % 10 == 0:
+            archive.append(ROOM, _record(index))
+    loop.run_until_complete(archive.flush())
+    # compactions of rolled segments are queued on the archive thread
+    archive._executor.submit(lambda: None).result()
+
+
+def _ids(messages):
+    return [msg.msgid for msg in messages]
+
+
+def test_query(loop, tmp_path):
+    archive = _archive(loop, str(tmp_path))
+    _fill(loop, archive)
+
+    found = loop.run_until_complete(archive.query('r', start=1100.0,
+            end=1200.0))
+    assert _ids(found) == [str(index) for index in range(100, 200)]
+    found = loop.run_until_complete(archive.query('r', start=1991.0,
+            limit=3))
+    assert _ids(found) == ['991', '992', '993']
+    assert loop.run_until_complete(archive.query('other')) == []
+    archive.close()
+
+
+def test_find(loop, tmp_path):
+    archive = _archive(loop, str(tmp_path))
+    _fill(loop, archive)
+
+    for index in (0, 10, 517, 999):
+        assert tuple(loop.run_until_complete(archive.find('r',
+                str(index)))) == tuple(_record(index))
+    assert loop.run_until_complete(archive.find('r', 'missing')) is None
+    archive.close()
+
+
+def test_compaction(loop, tmp_path):
+    archive = _archive(loop, str(tmp_path))
+    _fill(loop, archive)
+    directory = os.path.join(str(tmp_path), 'r')
+    compacted = glob.glob(os.path.join(directory, '*-c.idx'))
+    assert compacted
+    # the sources are gone
+    for path in compacted:
+        assert not os.path.exists(path.replace('-c.idx', '.idx'))
+        assert not os.path.exists(path.replace('-c.idx', '.seg'))
+
+    archive.close()
+    archive._executor.shutdown(wait=True)
+
+    # the active segment is compacted on reopening, no duplicates are left
+    archive = _archive(loop, str(tmp_path))
+    loop.run_until_complete(archive.query('r'))
+    archive._executor.submit(lambda: None).result()
+    assert not [path for path in glob.glob(os.path.join(directory, '*.idx'))\
+            if not path.endswith('-c.idx')]
+    found = _ids(loop.run_until_complete(archive.query('r')))
+    assert found == [str(index) for index in range(1000)]
+    archive.close()
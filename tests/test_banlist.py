@@ -0,0 +1,83 @@
+import asyncio
+
+from chatangobot.core.banlist import Banlist, BanRecord
+from chatangobot.core.manager import Manager
+from chatangobot.core.settings import conf
+from chatangobot.core.user import User
+
+
+def _ban(room, name, mtime):
+    room.banlist[name] = ('unid' + name, '10.0.0.1', name, mtime, 'mod1')
+
+
+def _listed(loop, server, monkeypatch, times, page_size=3):
+    monkeypatch.setitem(conf['banlist'], 'page_size', page_size)
+    fake = server.get_room('bans')
+    for index, mtime in enumerate(times):
+        _ban(fake, 'u%i' % index, mtime)
+
+    mgr = Manager(loop, pm=False)
+    mgr.connect('bans')
+    loop.run_until_complete(asyncio.sleep(60))
+    room = mgr.getRoom('bans')
+    names = set(target.name for target in room.banlist)
+    loop.run_until_complete(mgr.disconnect())
+    return names
+
+
+def test_paging_lists_every_ban(loop, server, monkeypatch):
+    times = [5.0, 4.0, 3.0, 3.0, 1.0]
+    names = _listed(loop, server, monkeypatch, times)
+    assert names == set('u%i' % index for index in range(len(times)))
+
+
+def test_paging_past_many_bans_sharing_a_time(loop, server, monkeypatch):
+    times = [9.0, 9.0, 9.0, 9.0, 2.0, 1.0]
+    names = _listed(loop, server, monkeypatch, times)
+    # ties beyond a page cannot be listed, those past them are
+    assert {'u0', 'u4', 'u5'} <= names
+
+
+def test_relisting_prunes_stale_bans(loop, server, monkeypatch):
+    monkeypatch.setitem(conf['banlist'], 'page_size', 2)
+    fake = server.get_room('bans')
+    for index in range(5):
+        _ban(fake, 'u%i' % index, 10.0 - index)
+
+    mgr = Manager(loop, pm=False)
+    mgr.connect('bans')
+    loop.run_until_complete(asyncio.sleep(60))
+    room = mgr.getRoom('bans')
+    assert len(room.banlist) == 5
+
+    del fake.banlist['u2']
+    room.requestBanlist()
+    loop.run_until_complete(asyncio.sleep(60))
+    assert set(target.name for target in room.banlist) ==\
+            {'u0', 'u1', 'u3', 'u4'}
+    loop.run_until_complete(mgr.disconnect())
+
+
+def test_banlist_indexes():
+    mod = User.create('mod1')
+    records = Banlist()
+    records.add(BanRecord('a', '1.1.1.1', User.create('x'), 1.0, mod))
+    records.add(BanRecord('b', '1.1.1.1', User.create('y'), 2.0, mod))
+    assert len(records.find(ip='1.1.1.1')) == 2
+    assert [r.target.name for r in records.find(unid='b')] == ['y']
+
+    records.remove(User.create('y'))
+    assert [r.target.name for r in records.find(ip='1.1.1.1')] == ['x']
+    assert records.find(unid='b') == []
+    assert records.get(User.create('x'))['unid'] == 'a'
+
+
+def test_banlist_trims_oldest():
+    mod = User.create('mod1')
+    records = Banlist(maxlen=10)
+    for index in range(20):
+        records.add(BanRecord(str(index), None, User.create('u%i' % index),
+                float(index), mod))
+    assert len(records) <= 11
+    assert User.create('u19') in records
+    assert User.create('u0') not in records
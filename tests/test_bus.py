@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from chatangobot.core.bus import Broker, decode, encode, pack_frame,\
+        read_frame, FRAME_HELLO, FRAME_JOIN, FRAME_LEAVE, FRAME_PUBLISH,\
+        FRAME_REQUEST, FRAME_RESPONSE
+
+
+def test_encode_round_trip():
+    value = {'none': None, 'flags': [True, False], 'int': -2 ** 40,
+            'float': 0.25, 'text': 'héllo', 'data': b'\x00\xff',
+            7: ('tuple', ['nested', {}])}
+    expected = dict(value)
+    # tuples come back as lists
+    expected[7] = ['tuple', ['nested', {}]]
+    assert decode(encode(value)) == expected
+
+
+def test_encode_rejects_other_types():
+    with pytest.raises(TypeError):
+        encode({'set': {1}})
+    with pytest.raises(ValueError):
+        decode(b'?\x00\x00\x00\x00')
+
+
+class Worker(object):
+    """A raw connection to the broker."""
+
+    def __init__(self, loop, path, pid, rooms):
+        self.loop = loop
+        self.reader, self.writer = loop.run_until_complete(
+                asyncio.open_unix_connection(path))
+        self.send(FRAME_HELLO, 0, [pid, rooms])
+
+
+    def send(self, frame_type, request_id, value):
+        self.writer.write(pack_frame(frame_type, request_id, value))
+        # lets the broker read it
+        self.loop.run_until_complete(asyncio.sleep(1))
+
+
+    def read(self):
+        return self.loop.run_until_complete(read_frame(self.reader))
+
+
+@pytest.fixture
+def broker(loop, tmp_path):
+    broker = Broker(str(tmp_path / 'bus.sock'))
+    loop.run_until_complete(broker.start())
+    yield broker
+    broker.close()
+
+
+def test_requests_are_routed_to_the_owner(loop, broker):
+    owner = Worker(loop, broker.path, 1, ['a'])
+    other = Worker(loop, broker.path, 2, [])
+
+    other.send(FRAME_REQUEST, 7, ['a', 'message', ['hi']])
+    frame_type, request_id, value = owner.read()
+    assert (frame_type, value) == (FRAME_REQUEST, ['a', 'message', ['hi']])
+
+    owner.send(FRAME_RESPONSE, request_id, [True, 'sent'])
+    assert other.read() == (FRAME_RESPONSE, 7, [True, 'sent'])
+    assert broker.routed == 1
+
+    other.send(FRAME_REQUEST, 8, ['b', 'message', ['hi']])
+    frame_type, request_id, (ok, _) = other.read()
+    assert (frame_type, request_id, ok) == (FRAME_RESPONSE, 8, False)
+
+
+def test_publish_and_take_over(loop, broker):
+    first = Worker(loop, broker.path, 1, ['a'])
+    second = Worker(loop, broker.path, 2, [])
+
+    first.send(FRAME_PUBLISH, 0, ['topic', {'x': 1}])
+    assert second.read() == (FRAME_PUBLISH, 0, ['topic', {'x': 1}])
+
+    # the previous owner is told to leave
+    second.send(FRAME_JOIN, 0, 'a')
+    assert first.read() == (FRAME_LEAVE, 0, 'a')
+    assert broker.owner('a').pid == 2
+
+
+def test_owner_exiting_fails_its_requests(loop, broker):
+    owner = Worker(loop, broker.path, 1, ['a'])
+    other = Worker(loop, broker.path, 2, [])
+
+    other.send(FRAME_REQUEST, 3, ['a', 'ban', ['someone']])
+    owner.read()
+    owner.writer.close()
+    frame_type, request_id, (ok, _) = other.read()
+    assert (frame_type, request_id, ok) == (FRAME_RESPONSE, 3, False)
+    assert broker.owner('a') is None
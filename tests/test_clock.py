@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from chatangobot.core import clock
+from chatangobot.core.manager import Manager
+from chatangobot.core.settings import conf
+
+
+class Pinged(Manager):
+    """Counts the pings sent."""
+
+    def __init__(self, loop):
+        super(Pinged, self).__init__(loop, pm=False)
+        self.pings = 0
+
+
+    @asyncio.coroutine
+    def onPing(self, room):
+        self.pings += 1
+
+
+def test_hours_of_pings(loop, server, monkeypatch):
+    monkeypatch.setitem(conf['connection'], 'ping_interval', 20)
+    mgr = Pinged(loop)
+    mgr.connect('a')
+    started = time.time()
+    loop.run_until_complete(asyncio.sleep(3 * 3600))
+    assert time.time() - started < 60
+    # 3 hours, a ping every 20 seconds
+    assert abs(mgr.pings - 3 * 3600 / 20) <= 1
+    assert mgr.getRoom('a').connected
+    loop.run_until_complete(mgr.disconnect())
+
+
+def test_clock_follows_the_loop(loop):
+    start = clock.time()
+    loop.run_until_complete(asyncio.sleep(86400))
+    assert abs(clock.time() - start - 86400) < 1
+
+
+def test_waits_for_executor_jobs(loop):
+    def job():
+        time.sleep(0.2)
+        return loop.time()
+
+    @asyncio.coroutine
+    def run():
+        timer = loop.call_later(1000, lambda: None)
+        finished = yield from loop.run_in_executor(None, job)
+        timer.cancel()
+        return finished
+
+    assert loop.run_until_complete(run()) < 1000
+    assert loop.executor_jobs == 0
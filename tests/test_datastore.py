@@ -0,0 +1,127 @@
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from chatangobot.core.bus import decode
+from chatangobot.core.datastore import create_datastore
+
+
+def _config(backend, **connect_args):
+    return {'backend': backend, 'connect_args': connect_args, 'prefix': 't:',
+            'flush_interval': 1.0, 'batch_size': 500, 'cache_size': 100}
+
+
+def test_backend_opened_on_use(loop, tmp_path):
+    store = create_datastore(loop, _config('log',
+            path=str(tmp_path / 'store.log')))
+    assert store.backend is None
+
+    store.set('key', {'value': [1, 2]})
+    assert loop.run_until_complete(store.flush()) == 1
+    assert store.backend is not None
+    store.close()
+
+    store = create_datastore(loop, _config('log',
+            path=str(tmp_path / 'store.log')))
+    assert loop.run_until_complete(store.get('key')) == {'value': [1, 2]}
+    assert loop.run_until_complete(store.incr('count', 2)) == 2
+    store.close()
+
+
+def test_unreachable_backend_does_not_block(loop):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    store = create_datastore(loop, _config('redis', host='127.0.0.1',
+            port=port))
+    assert store.backend is None
+    with pytest.raises(OSError):
+        loop.run_until_complete(store.get('key'))
+
+    store.set('key', 1)
+    with pytest.raises(OSError):
+        loop.run_until_complete(store.flush())
+    # kept for the next flush
+    assert store.dirty == 1
+    store.close()
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    """Answers SET, DEL and MGET, the first pipeline too late."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                FakeRedisHandler)
+        self.data = {}
+        self.connections = 0
+        self.late = True
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+
+    def _command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            args = self._command()
+            if args is None:
+                return
+            if self.server.late:
+                self.server.late = False
+                time.sleep(0.5)
+            name = args[0].decode()
+            if name == 'SET':
+                self.server.data[args[1]] = args[2]
+                self.wfile.write(b'+OK\r\n')
+            elif name == 'DEL':
+                self.wfile.write(b':%i\r\n' % (self.server.data.pop(args[1],
+                        None) is not None))
+            elif name == 'MGET':
+                self.wfile.write(b'*%i\r\n' % (len(args) - 1))
+                for key in args[1:]:
+                    value = self.server.data.get(key)
+                    if value is None:
+                        self.wfile.write(b'$-1\r\n')
+                    else:
+                        self.wfile.write(b'$%i\r\n%s\r\n' % (len(value),
+                                value))
+
+
+def test_backend_reopened_after_a_timeout(loop):
+    server = FakeRedis()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    store = create_datastore(loop, _config('redis', host='127.0.0.1',
+            port=server.server_address[1], timeout=0.2))
+
+    store.set('a', 1)
+    store.set('b', 2)
+    with pytest.raises(socket.timeout):
+        loop.run_until_complete(store.flush())
+    assert store.backend is None
+    # the late replies of the pipeline are not read as the ones of MGET
+    assert loop.run_until_complete(store.get_many(['c', 'd'], 0)) ==\
+            {'c': 0, 'd': 0}
+    assert loop.run_until_complete(store.flush()) == 2
+    assert dict((key, decode(value)) for key, value in server.data.items())\
+            == {b't:a': 1, b't:b': 2}
+    assert server.connections == 2
+    store.close()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import os
+
+import pytest
+
+from chatangobot.core.executor import LoopProxy, QueueFull, ThreadBridge,\
+        QUEUE_FULL_DROP, QUEUE_FULL_DROP_OLDEST, blocking, cpu_bound
+from chatangobot.core.manager import Manager
+from chatangobot.core.message import MessageSnapshot
+from chatangobot.core.user import UserSnapshot
+
+
+class Classifier(Manager):
+    """Counts the words of messages in the process pool."""
+
+    def __init__(self, loop):
+        super(Classifier, self).__init__(loop, pm=False)
+        self.results = []
+
+
+    @staticmethod
+    @cpu_bound
+    def onMessage(room, user, message):
+        return (os.getpid(), type(message).__name__, room.name, user.name,
+                len(message.body.split()))
+
+
+    @asyncio.coroutine
+    def onMessageResult(self, room, user, message, result):
+        self.results.append(result)
+
+
+def _run(loop, bridge, count, delay=0.05):
+    jobs = [bridge.submit(str(index), time.sleep, delay)\
+            for index in range(count)]
+    return loop.run_until_complete(asyncio.gather(*jobs,
+            return_exceptions=True))
+
+
+def test_wait_without_queue(loop):
+    bridge = ThreadBridge(loop, max_workers=1, queue_size=0)
+    assert _run(loop, bridge, 3) == [None, None, None]
+    assert bridge.stats['1'].dropped == 0
+    bridge.shutdown()
+
+
+def test_wait_with_queue(loop):
+    bridge = ThreadBridge(loop, max_workers=2, queue_size=1)
+    assert _run(loop, bridge, 6) == [None] * 6
+    assert bridge.pending == 0
+    bridge.shutdown()
+
+
+def test_drop(loop):
+    bridge = ThreadBridge(loop, max_workers=1, queue_size=1,
+            when_full=QUEUE_FULL_DROP)
+    results = _run(loop, bridge, 3)
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], QueueFull)
+    bridge.shutdown()
+
+
+def test_drop_oldest(loop):
+    bridge = ThreadBridge(loop, max_workers=1, queue_size=1,
+            when_full=QUEUE_FULL_DROP_OLDEST)
+    results = _run(loop, bridge, 3)
+    assert results[0] is None
+    assert isinstance(results[1], QueueFull)
+    assert results[2] is None
+    bridge.shutdown()
+
+
+def test_errors_are_raised(loop):
+    bridge = ThreadBridge(loop, max_workers=1, queue_size=0)
+    with pytest.raises(ZeroDivisionError):
+        loop.run_until_complete(bridge.submit('div', lambda: 1 / 0))
+    assert bridge.stats['div'].errors == 1
+    bridge.shutdown()
+
+
+def test_cpu_bound_staticmethod_runs_in_a_process(loop, server):
+    mgr = Classifier(loop)
+    mgr.connect('a')
+    loop.run_until_complete(asyncio.sleep(5))
+    server.post_message(server.get_room('a'), 'someone', 'one two three')
+    loop.run_until_complete(asyncio.sleep(5))
+
+    assert len(mgr.results) == 1
+    pid, kind, room_name, name, words = mgr.results[0]
+    assert pid != os.getpid()
+    assert (kind, room_name, name, words) ==\
+            (MessageSnapshot.__name__, 'a', 'someone', 3)
+    loop.run_until_complete(mgr.disconnect())
+
+
+class Echo(Manager):
+    """Answers messages from the thread pool."""
+
+    def __init__(self, loop):
+        super(Echo, self).__init__(loop, pm=False)
+        self.received = []
+
+
+    @blocking
+    def onMessage(self, room, user, message):
+        self.received.append((type(room), type(user), type(message)))
+        if message.body == 'ping':
+            room.message('pong').result()
+
+
+def test_blocking_handlers_get_snapshots(loop, server):
+    mgr = Echo(loop)
+    mgr.connect('a')
+    loop.run_until_complete(asyncio.sleep(5))
+    fake = server.get_room('a')
+    server.post_message(fake, 'someone', 'ping')
+    loop.run_until_complete(asyncio.sleep(5))
+
+    assert mgr.received[0] == (LoopProxy, UserSnapshot, MessageSnapshot)
+    assert [frame[-1].endswith('pong') for frame in fake.history] ==\
+            [False, True]
+    loop.run_until_complete(mgr.disconnect())
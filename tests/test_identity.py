@@ -0,0 +1,84 @@
+import asyncio
+
+from chatangobot.core.clock import time
+from chatangobot.core.identity import IdentityGraph
+from chatangobot.core.manager import Manager
+from chatangobot.core.settings import conf
+
+
+def test_linked_through_unid_and_puid():
+    graph = IdentityGraph()
+    graph.ban('r', 'evil', unid='u1')
+    assert graph.observe('r', 'evil2', unid='u1') == {'evil'}
+    graph.observe('r', 'evil3', puid='p1')
+    assert graph.observe('r', 'evil3', unid='u1', puid='p1') == {'evil'}
+    assert graph.observe('r', 'evil4', puid='p1') == {'evil'}
+    # banned from another room only
+    assert graph.observe('other', 'evil2', unid='u1') == set()
+
+    graph.unban('r', 'evil')
+    assert graph.observe('r', 'evil2', unid='u1') == set()
+
+
+def test_anon_names_and_ips_are_not_linked():
+    graph = IdentityGraph()
+    graph.ban('r', 'evil', unid='u1', ip='10.0.0.1')
+    graph.observe('r', '!anon1234', unid='u1')
+    # same anon id, another user
+    assert graph.observe('r', '!anon1234', unid='u2') == set()
+    # same ip, behind the same NAT
+    assert graph.observe('r', 'innocent', unid='u3', ip='10.0.0.1') == set()
+
+    graph = IdentityGraph(link_ip=True)
+    graph.ban('r', 'evil', unid='u1', ip='10.0.0.1')
+    assert graph.observe('r', 'evil2', ip='10.0.0.1') == {'evil'}
+
+
+def test_generations_expire_links_but_not_bans():
+    graph = IdentityGraph(ttl=100.0)
+    start = time()
+    graph.ban('r', 'evil', unid='u1')
+    graph.observe('r', 'alt', unid='u1', puid='p1', now=start)
+    assert graph.observe('r', 'alt2', puid='p1', now=start + 1.0) == {'evil'}
+    # two rotations later, the link to p1 expired
+    graph.observe('r', 'other', now=start + 150.0)
+    graph.observe('r', 'other', now=start + 300.0)
+    assert graph.observe('r', 'alt3', puid='p1', now=start + 301.0) == set()
+    assert graph.observe('r', 'evil2', unid='u1', now=start + 301.0) ==\
+            {'evil'}
+
+
+def test_links_of_the_previous_generation():
+    graph = IdentityGraph(ttl=100.0)
+    start = time()
+    graph.ban('r', 'bad')
+    graph.observe('r', 'bad', puid='P1', now=start + 50.0)
+    # one rotation, the link is in the previous generation only
+    assert graph.observe('r', 'alt', puid='P1', now=start + 120.0) ==\
+            {'bad'}
+
+
+def test_evader_banned_once(loop, server, monkeypatch):
+    monkeypatch.setitem(conf['identity'], 'enabled', True)
+    monkeypatch.setitem(conf['identity'], 'action', 'ban')
+    fake = server.get_room('guarded')
+    fake.banlist['evil'] = ('u1', '10.0.0.1', 'evil', 1.0, 'mod1')
+
+    mgr = Manager(loop, pm=False)
+    mgr.connect('guarded')
+    loop.run_until_complete(asyncio.sleep(5))
+    room = mgr.getRoom('guarded')
+    sent = []
+    send_commands = room._send_commands
+
+    def recording(commands):
+        sent.extend(command[0] for command in commands)
+        send_commands(commands)
+    room._send_commands = recording
+
+    for index in range(3):
+        server.post_message(fake, 'evil2', 'hi %i' % index, unid='u1')
+    loop.run_until_complete(asyncio.sleep(5))
+    assert sent.count('block') == 1
+    assert 'evil2' in fake.banlist
+    loop.run_until_complete(mgr.disconnect())
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from chatangobot.core.manager import Manager
+from chatangobot.core.settings import conf
+
+
+class Recorder(Manager):
+    """Records the coalesced events it gets."""
+
+    def __init__(self, loop):
+        super(Recorder, self).__init__(loop, pm=False)
+        self.events = []
+
+
+    @asyncio.coroutine
+    def onJoinBatch(self, room, users):
+        self.events.append(('join', room.name, users, self._loop.time()))
+
+
+    @asyncio.coroutine
+    def onUserCountChange(self, room):
+        self.events.append(('count', room.name, None, self._loop.time()))
+
+
+def _joined(loop, monkeypatch, *room_names):
+    monkeypatch.setitem(conf['coalesce'], 'onJoin', 30.0)
+    monkeypatch.setitem(conf['coalesce'], 'onUserCountChange', 30.0)
+    mgr = Recorder(loop)
+    mgr.connect(*room_names)
+    # past the window of the join of the bot
+    loop.run_until_complete(asyncio.sleep(35))
+    del mgr.events[:]
+    return mgr
+
+
+def test_coalesced_once_per_window(loop, server, monkeypatch):
+    mgr = _joined(loop, monkeypatch, 'a')
+    room = mgr.getRoom('a')
+    start = loop.time()
+    for name in ('x', 'y', 'z'):
+        mgr.dispatch_event(room, 'onJoin', name)
+        mgr.dispatch_event(room, 'onUserCountChange')
+    loop.run_until_complete(asyncio.sleep(60))
+    assert sorted(event[:3] for event in mgr.events) ==\
+            [('count', 'a', None), ('join', 'a', ['x', 'y', 'z'])]
+    assert all(event[3] == start + 30.0 for event in mgr.events)
+    loop.run_until_complete(mgr.disconnect())
+
+
+def test_leaving_flushes_the_room(loop, server, monkeypatch):
+    mgr = _joined(loop, monkeypatch, 'a', 'b')
+    for name in ('a', 'b'):
+        mgr.dispatch_event(mgr.getRoom(name), 'onJoin', 'x')
+    loop.run_until_complete(mgr.leaveRoom('a'))
+    loop.run_until_complete(asyncio.sleep(0))
+    assert [event[1] for event in mgr.events] == ['a']
+
+    loop.run_until_complete(asyncio.sleep(60))
+    # nothing more for the room left
+    assert [event[1] for event in mgr.events] == ['a', 'b']
+    loop.run_until_complete(mgr.disconnect())
+
+
+def test_coalesced_events_take_no_keywords(loop, server, monkeypatch):
+    mgr = _joined(loop, monkeypatch, 'a')
+    with pytest.raises(TypeError):
+        mgr.dispatch_event(mgr.getRoom('a'), 'onJoin', 'x', extra=1)
+    loop.run_until_complete(mgr.disconnect())
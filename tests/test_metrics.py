@@ -0,0 +1,51 @@
+import asyncio
+import types
+
+from chatangobot.core.metrics import MAX_HEADERS, MetricsServer
+from chatangobot.core.settings import conf
+
+
+def _server(loop):
+    metrics = types.SimpleNamespace(render=lambda: 'chat_up 1\n')
+    server = MetricsServer(metrics, '127.0.0.1', 0)
+    loop.run_until_complete(server.start())
+    return server, server._server.sockets[0].getsockname()[1]
+
+
+@asyncio.coroutine
+def _request(port, data, wait=0.0):
+    reader, writer = yield from asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    if wait:
+        yield from asyncio.sleep(wait)
+    response = yield from reader.read()
+    writer.close()
+    return response
+
+
+def test_scrape(loop):
+    server, port = _server(loop)
+    response = loop.run_until_complete(_request(port,
+            b'GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n'))
+    assert response.startswith(b'HTTP/1.0 200 OK')
+    assert response.endswith(b'chat_up 1\n')
+    server.stop()
+
+
+def test_silent_client_is_dropped(loop):
+    server, port = _server(loop)
+    started = loop.time()
+    response = loop.run_until_complete(_request(port, b'GET / HTTP/1.1\r\n'))
+    assert response == b''
+    assert loop.time() - started >= conf['connection']['timeout']
+    server.stop()
+
+
+def test_too_many_headers(loop):
+    server, port = _server(loop)
+    headers = b''.join(b'X-%i: y\r\n' % index\
+            for index in range(MAX_HEADERS + 1))
+    response = loop.run_until_complete(_request(port,
+            b'GET / HTTP/1.1\r\n' + headers + b'\r\n'))
+    assert response.startswith(b'HTTP/1.0 431')
+    server.stop()
@@ -0,0 +1,62 @@
+import asyncio
+
+from chatangobot.core.bus import Broker
+from chatangobot.core.manager import Manager
+from chatangobot.core.settings import conf
+
+
+class Recorder(Manager):
+    """Records the messages it handles."""
+
+    def __init__(self, loop):
+        super(Recorder, self).__init__(loop, pm=False)
+        self.messages = []
+
+
+    @asyncio.coroutine
+    def onMessage(self, room, user, message):
+        self.messages.append(message.body)
+
+
+def test_migrated_messages_are_handled_once(loop, server, tmp_path,
+        monkeypatch):
+    path = str(tmp_path / 'bus.sock')
+    monkeypatch.setitem(conf['bus'], 'enabled', True)
+    monkeypatch.setitem(conf['bus'], 'path', path)
+    broker = Broker(path)
+    loop.run_until_complete(broker.start())
+    fake = server.get_room('a')
+
+    first = Recorder(loop)
+    first.connect('a')
+    loop.run_until_complete(asyncio.sleep(5))
+    server.post_message(fake, 'someone', 'before')
+    loop.run_until_complete(asyncio.sleep(5))
+
+    second = Recorder(loop)
+    second.connect()
+    loop.run_until_complete(asyncio.sleep(5))
+    room = loop.run_until_complete(second.joinRoom('a', shadow=True))
+    loop.run_until_complete(asyncio.sleep(5))
+    # seen by both, handled by the first worker only
+    server.post_message(fake, 'someone', 'during')
+    loop.run_until_complete(asyncio.sleep(5))
+    assert [msg.body for msg in room._shadow_msgs] == ['during']
+
+    assert loop.run_until_complete(second.migrateRoom('a')) is room
+    assert not room.shadow
+    loop.run_until_complete(asyncio.sleep(5))
+    assert first.getRoom('a') is None
+    assert broker.owner('a').pid is not None
+
+    server.post_message(fake, 'someone', 'after')
+    loop.run_until_complete(asyncio.sleep(5))
+    assert first.messages + second.messages == ['before', 'during', 'after']
+    assert second.messages == ['after']
+    # the history came along, without duplicates
+    assert [msg.body for msg in room._history] ==\
+            ['before', 'during', 'after']
+
+    loop.run_until_complete(first.disconnect())
+    loop.run_until_complete(second.disconnect())
+    broker.close()
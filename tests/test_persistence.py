@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+from chatangobot.core.manager import Manager
+from chatangobot.core.persistence import StateStore
+from chatangobot.core.settings import conf
+
+
+def _joined(loop, room_name):
+    mgr = Manager(loop, pm=False)
+    mgr.connect(room_name)
+    loop.run_until_complete(asyncio.sleep(60))
+    return mgr
+
+
+def test_export_import_round_trip(loop, server, tmp_path):
+    fake = server.get_room('a')
+    fake.banlist['bad'] = ('unid', '10.0.0.1', 'bad', 100.0, 'mod1')
+    mgr = _joined(loop, 'a')
+    for index in range(3):
+        server.post_message(fake, 'someone', 'hello %i' % index)
+    loop.run_until_complete(asyncio.sleep(5))
+    room = mgr.getRoom('a')
+
+    store = StateStore(loop, str(tmp_path))
+    assert loop.run_until_complete(store.save(room))
+    # unchanged
+    assert not loop.run_until_complete(store.save(room))
+    state = StateStore(loop, str(tmp_path)).load('a')
+    assert state['history'] == [list(values) for values in\
+            room.export_state()['history']]
+
+    other = _joined(loop, 'b')
+    copy = other.getRoom('b')
+    handled = copy.import_state(state)
+    assert handled == set(msg.msgid for msg in room._history)
+    assert [msg.body for msg in copy._history] ==\
+            ['hello 0', 'hello 1', 'hello 2']
+    assert [target.name for target in copy.banlist] == ['bad']
+    assert copy._getBanRecord(copy.user_class.create('bad')).src.name ==\
+            'mod1'
+
+    # merged by msgid
+    copy.import_state(state)
+    assert len(copy._history) == 3
+
+    server.post_message(fake, 'someone', 'changed')
+    loop.run_until_complete(asyncio.sleep(5))
+    assert loop.run_until_complete(store.save(room))
+    store.close()
+
+    loop.run_until_complete(mgr.disconnect())
+    loop.run_until_complete(other.disconnect())
+
+
+def test_history_survives_a_restart(loop, server, tmp_path, monkeypatch):
+    monkeypatch.setitem(conf['persistence'], 'enabled', True)
+    monkeypatch.setitem(conf['persistence'], 'directory', str(tmp_path))
+    fake = server.get_room('a')
+    mgr = _joined(loop, 'a')
+    server.post_message(fake, 'someone', 'before the restart')
+    loop.run_until_complete(asyncio.sleep(5))
+    loop.run_until_complete(mgr.leaveRoom('a'))
+    loop.run_until_complete(mgr.disconnect())
+
+    # the server forgot it
+    fake.history.clear()
+    mgr = _joined(loop, 'a')
+    assert [msg.body for msg in mgr.getRoom('a')._history] ==\
+            ['before the restart']
+    loop.run_until_complete(mgr.disconnect())
+
+
+def test_unreadable_state_is_ignored(loop, tmp_path):
+    store = StateStore(loop, str(tmp_path))
+    with open(store.path('a'), 'wb') as f:
+        f.write(b'garbage')
+    assert store.load('a') is None
+    assert store.load('missing') is None
+    store.close()
+
+
+def test_saved_in_the_thread_of_the_store(loop, server, tmp_path,
+        monkeypatch):
+    mgr = _joined(loop, 'a')
+    room = mgr.getRoom('a')
+    store = StateStore(loop, str(tmp_path))
+    threads = []
+    write = store._write
+
+    def recording(room_name, state):
+        threads.append(threading.current_thread())
+        return write(room_name, state)
+    monkeypatch.setattr(store, '_write', recording)
+
+    assert loop.run_until_complete(store.save_all([room])) == 1
+    assert threads and threading.current_thread() not in threads
+    store.close()
+    loop.run_until_complete(mgr.disconnect())
@@ -0,0 +1,36 @@
+import asyncio
+import os
+
+from chatangobot.core.manager import Manager
+from chatangobot.core.recorder import HEADER, RECORD_IN, read_records
+from chatangobot.core.settings import conf
+
+
+def test_rejoined_room_appends_whole_records(loop, server, tmp_path,
+        monkeypatch):
+    monkeypatch.setitem(conf['recorder'], 'enabled', True)
+    monkeypatch.setitem(conf['recorder'], 'directory', str(tmp_path))
+    fake = server.get_room('a')
+    mgr = Manager(loop, pm=False)
+    mgr.connect()
+
+    for visit in range(3):
+        room = loop.run_until_complete(mgr.joinRoom('a'))
+        loop.run_until_complete(asyncio.sleep(5))
+        server.post_message(fake, 'someone', 'visit %i' % visit)
+        loop.run_until_complete(asyncio.sleep(5))
+        loop.run_until_complete(mgr.leaveRoom('a'))
+        assert room not in mgr.recorder._files
+    loop.run_until_complete(mgr.disconnect())
+
+    path = os.path.join(str(tmp_path), 'room-a.rec')
+    records = list(read_records(path))
+    # every byte belongs to a record, in order
+    assert sum(HEADER.size + len(data) for _, _, data in records) ==\
+            os.path.getsize(path)
+    times = [timestamp for timestamp, _, _ in records]
+    assert times == sorted(times)
+    inbound = b''.join(data for _, direction, data in records\
+            if direction == RECORD_IN)
+    for visit in range(3):
+        assert ('visit %i' % visit).encode() in inbound
@@ -0,0 +1,130 @@
+import asyncio
+
+from chatangobot.core.manager import Manager
+from chatangobot.core.room import BULK_BAN, BULK_DELETE, BULK_DUPLICATE,\
+        BULK_NOT_FOUND, BULK_SENT
+from chatangobot.core.settings import conf
+
+
+class Recorder(Manager):
+    """Records the messages it gets."""
+
+    def __init__(self, loop):
+        super(Recorder, self).__init__(loop, pm=False)
+        self.messages = []
+        self.batches = []
+
+
+    @asyncio.coroutine
+    def onMessage(self, room, user, message):
+        self.messages.append(message.body)
+
+
+    @asyncio.coroutine
+    def onMessageBatch(self, room, messages):
+        self.batches.append([message.body for message in messages])
+
+
+def test_activate_batches_missed_messages(loop, server, monkeypatch):
+    monkeypatch.setitem(conf['message_batch'], 'enabled', True)
+    monkeypatch.setitem(conf['stats'], 'enabled', True)
+    mgr = Recorder(loop)
+    mgr.connect()
+    room = loop.run_until_complete(mgr.joinRoom('shadowed', shadow=True))
+    loop.run_until_complete(asyncio.sleep(5))
+
+    fake = server.get_room('shadowed')
+    for index in range(3):
+        server.post_message(fake, 'someone', 'missed %i' % index)
+    loop.run_until_complete(asyncio.sleep(5))
+    assert mgr.batches == []
+
+    room.activate()
+    loop.run_until_complete(asyncio.sleep(5))
+    assert mgr.messages == []
+    assert mgr.batches == [['missed 0', 'missed 1', 'missed 2']]
+    assert mgr.stats.room('shadowed').messages() == 3
+    loop.run_until_complete(mgr.disconnect())
+
+
+def test_leaving_flushes_the_batch_of_the_room(loop, server, monkeypatch):
+    monkeypatch.setitem(conf['message_batch'], 'enabled', True)
+    monkeypatch.setitem(conf['message_batch'], 'per_room', True)
+    monkeypatch.setitem(conf['message_batch'], 'interval', 30.0)
+    mgr = Recorder(loop)
+    mgr.connect('left')
+    loop.run_until_complete(asyncio.sleep(5))
+
+    server.post_message(server.get_room('left'), 'someone', 'last words')
+    loop.run_until_complete(asyncio.sleep(1))
+    loop.run_until_complete(mgr.leaveRoom('left'))
+    loop.run_until_complete(asyncio.sleep(0))
+    assert mgr.batches == [['last words']]
+    loop.run_until_complete(asyncio.sleep(60))
+    assert mgr.batches == [['last words']]
+    loop.run_until_complete(mgr.disconnect())
+
+
+def _moderated(loop, server, monkeypatch):
+    monkeypatch.setitem(conf['moderation'], 'batch_size', 2)
+    monkeypatch.setitem(conf['moderation'], 'batch_interval', 1.0)
+    mgr = Recorder(loop)
+    mgr.connect('mod')
+    loop.run_until_complete(asyncio.sleep(5))
+
+    fake = server.get_room('mod')
+    # bob and carol share an ip
+    for index, (name, ip) in enumerate([('alice', 0), ('bob', 1),
+            ('carol', 1), ('dave', 3), ('eve', 4), ('frank', 5)]):
+        server.post_message(fake, name, 'hi', ip='10.0.0.%i' % ip,
+                unid='unid%i' % index)
+    loop.run_until_complete(asyncio.sleep(5))
+
+    room = mgr.getRoom('mod')
+    writes = []
+    send_commands = room._send_commands
+
+    def recording(commands):
+        writes.append((loop.time(), [command[0] for command in commands]))
+        send_commands(commands)
+        # a flood warning after the first write
+        room._floodWarnings += 1
+    monkeypatch.setattr(room, '_send_commands', recording)
+    return mgr, room, writes
+
+
+def test_bulk_ban_resolves_and_coalesces(loop, server, monkeypatch):
+    mgr, room, writes = _moderated(loop, server, monkeypatch)
+    users = [mgr.user_class.create(name) for name in ('alice', 'bob',
+            'carol', 'nobody')]
+    result = loop.run_until_complete(room.bulkModerate(BULK_BAN, users=users,
+            ips=['10.0.0.0'], unids=['unid3', 'unid4', 'unid5']))
+
+    assert dict((str(getattr(target, 'name', target)), status)\
+            for target, status in result.items()) == {
+                'alice': BULK_SENT, 'bob': BULK_SENT,
+                'carol': BULK_DUPLICATE, 'nobody': BULK_NOT_FOUND,
+                '10.0.0.0': BULK_DUPLICATE, 'unid3': BULK_SENT,
+                'unid4': BULK_SENT, 'unid5': BULK_SENT}
+    # 2 commands per write, the interval doubles after a flood warning
+    start = writes[0][0]
+    assert [(when - start, names) for when, names in writes] ==\
+            [(0.0, ['block', 'block']), (1.0, ['block', 'block']),
+            (3.0, ['block'])]
+    loop.run_until_complete(asyncio.sleep(5))
+    assert sorted(server.get_room('mod').banlist) ==\
+            ['alice', 'bob', 'dave', 'eve', 'frank']
+    loop.run_until_complete(mgr.disconnect())
+
+
+def test_bulk_delete_once_per_message(loop, server, monkeypatch):
+    mgr, room, writes = _moderated(loop, server, monkeypatch)
+    messages = list(room._history[-2:])
+    result = loop.run_until_complete(room.bulkModerate(BULK_DELETE,
+            messages=messages * 2 + [messages[0]]))
+
+    assert result == dict((msg, BULK_SENT) for msg in messages)
+    assert [names for _, names in writes] == [['delmsg', 'delmsg']]
+    loop.run_until_complete(asyncio.sleep(5))
+    assert [msg.body for msg in room._history] == ['hi'] * 4
+    loop.run_until_complete(mgr.disconnect())
@@ -0,0 +1,149 @@
+import glob
+import os
+import random
+import types
+
+from chatangobot.core import archive as archive_module
+from chatangobot.core.archive import Archive
+from chatangobot.core.search import SearchIndex, parse_query, tokenize
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'spam', 'buy', 'now']
+
+
+def _fill(loop, archive, count=3000):
+    rng = random.Random(7)
+    room = types.SimpleNamespace(name='r', _export_message=lambda msg: msg)
+    records = []
+    for index in range(count):
+        words = [rng.choice(WORDS[:5]) for _ in range(5)]
+        if index % 500 == 0:
+            words += ['rare', 'buy', 'now']
+        record = [str(index), 1000.0 + index, 'user%i' % (index % 7), '',
+                ' '.join(words), '', '', '', '', '', '', '']
+        records.append(record)
+        archive.append(room, record)
+    loop.run_until_complete(archive.flush())
+    # compactions of rolled segments are queued on the archive thread
+    archive._executor.submit(lambda: None).result()
+    return records
+
+
+def _expected(records, query, since=None, limit=50):
+    tokens, phrases = parse_query(query)
+    result = [r for r in records if tokens.issubset(tokenize(r[4])) and\
+            (since is None or r[1] >= since) and\
+            all(' '.join(p) in ' '.join(tokenize(r[4])) for p in phrases)]
+    result.sort(key=lambda r: -r[1])
+    return [r[0] for r in result[:limit]]
+
+
+def _read_blocks(monkeypatch):
+    read = []
+    original = archive_module._read_segment
+
+    def counting(segment, blocks):
+        read.extend(blocks)
+        return original(segment, blocks)
+    monkeypatch.setattr(archive_module, '_read_segment', counting)
+    return read
+
+
+def test_search_archive(loop, tmp_path, monkeypatch):
+    archive = Archive(loop, str(tmp_path), block_size=64, segment_size=4096)
+    records = _fill(loop, archive)
+    assert glob.glob(os.path.join(str(tmp_path), 'r', '*-c.tok'))
+    index = SearchIndex(archive)
+
+    read = _read_blocks(monkeypatch)
+    found = loop.run_until_complete(index.search_archive('rare', ['r']))
+    assert [msg.msgid for msg in found] == _expected(records, 'rare')
+    # the blocks holding "rare" only
+    assert len(read) <= 6
+
+    found = loop.run_until_complete(index.search_archive('"buy now"',
+            ['r'], since=1500.0))
+    assert [msg.msgid for msg in found] ==\
+            _expected(records, '"buy now"', since=1500.0)
+
+    del read[:]
+    found = loop.run_until_complete(index.search_archive('lorem', ['r'],
+            limit=10))
+    assert [msg.msgid for msg in found] == _expected(records, 'lorem', None,
+            10)
+    # the newest blocks only
+    assert len(read) < 5
+    archive.close()
+
+
+def test_search_archive_without_token_index(loop, tmp_path):
+    archive = Archive(loop, str(tmp_path), block_size=64, segment_size=4096)
+    records = _fill(loop, archive)
+    archive.close()
+    archive._executor.shutdown(wait=True)
+    for path in glob.glob(os.path.join(str(tmp_path), 'r', '*.tok')):
+        os.unlink(path)
+
+    archive = Archive(loop, str(tmp_path), block_size=64, segment_size=4096)
+    found = loop.run_until_complete(SearchIndex(archive).search_archive(
+            'rare', ['r']))
+    assert [msg.msgid for msg in found] == _expected(records, 'rare')
+    archive.close()
+
+
+class Message(object):
+    """A message of room history, hashed by identity."""
+
+    def __init__(self, room_name, index, body):
+        self.room = types.SimpleNamespace(name=room_name)
+        self.user = types.SimpleNamespace(name='user%i' % (index % 5))
+        self.body = body
+        self.time = float(index)
+
+
+def _message(room_name, index, rng):
+    return Message(room_name, index, ' '.join(rng.choice(WORDS)\
+            for _ in range(4)))
+
+
+def _brute_force(messages, query, room_name=None):
+    tokens, phrases = parse_query(query)
+    result = [msg for msg in messages if\
+            (room_name is None or msg.room.name == room_name) and\
+            tokens.issubset(tokenize(msg.body)) and\
+            all(' '.join(p) in ' '.join(tokenize(msg.body)) for p in phrases)]
+    result.sort(key=lambda msg: -msg.time)
+    return result[:50]
+
+
+def test_search_every_room_and_one(monkeypatch):
+    rng = random.Random(3)
+    index = SearchIndex()
+    messages = [_message('room%i' % (number % 3), number, rng)\
+            for number in range(600)]
+    for msg in messages:
+        index.add(msg)
+
+    for query in ('spam', 'buy now', '"buy now"', 'lorem ipsum sit', 'x'):
+        assert index.search(query) == _brute_force(messages, query)
+        assert index.search(query, 'room1') ==\
+                _brute_force(messages, query, 'room1')
+
+    removed = []
+    remove = index.remove
+
+    def counting(msg):
+        removed.append(msg)
+        remove(msg)
+    monkeypatch.setattr(index, 'remove', counting)
+    index.remove_room('room1')
+    # the messages of the room only are visited
+    assert len(removed) == 200
+    left = [msg for msg in messages if msg.room.name != 'room1']
+    assert index.size == 400
+    assert index.search('spam') == _brute_force(left, 'spam')
+    assert index.search('spam', 'room1') == []
+
+    index.remove_room('room0')
+    index.remove_room('room2')
+    assert index.size == 0
+    assert index._postings == index._all_postings == index._rooms == {}
@@ -0,0 +1,51 @@
+import types
+
+from chatangobot.core.spam import SpamDetector, DUPLICATE, FLOOD, RAID
+
+
+def _msg(name, body, mtime, ip=None, unid=None):
+    return types.SimpleNamespace(user=types.SimpleNamespace(name=name),
+            body=body, time=mtime, ip=ip, unid=unid)
+
+
+def test_flood_fires_once_per_window():
+    spam = SpamDetector(window=10.0, message_limit=3)
+    kinds = []
+    for index in range(8):
+        kinds += [(d.kind, d.key) for d in spam.message('r',
+                _msg('fast', 'hello %i' % index, index * 0.5))]
+    assert kinds == [(FLOOD, 'user:fast')]
+
+
+def test_duplicates_from_several_users():
+    spam = SpamDetector(duplicate_limit=3)
+    body = 'visit my great website for free stuff'
+    detections = []
+    for index, name in enumerate(['a', 'b', 'c']):
+        detections += spam.message('r', _msg(name, body + '!' * index,
+                float(index)))
+    assert [d.kind for d in detections] == [DUPLICATE]
+
+
+def test_raid_of_new_users():
+    spam = SpamDetector(raid_window=10.0, raid_limit=5)
+    detections = []
+    for index in range(5):
+        detections += spam.join('r', 'new%i' % index, float(index))
+    assert [d.kind for d in detections] == [RAID]
+
+
+def test_known_users_are_not_new():
+    spam = SpamDetector(raid_window=10.0, raid_limit=5)
+    spam.known('r', ['regular%i' % index for index in range(3)])
+    spam.message('r', _msg('talker0', 'hi', 0.0))
+    spam.message('r', _msg('talker1', 'hi', 0.0))
+
+    detections = []
+    for name in ['regular0', 'regular1', 'regular2', 'talker0', 'talker1']:
+        detections += spam.join('r', name, 1.0)
+    assert detections == []
+    # anons are always new
+    for index in range(5):
+        detections += spam.join('r', None, 2.0)
+    assert [d.kind for d in detections] == [RAID]
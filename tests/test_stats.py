@@ -0,0 +1,64 @@
+import random
+
+from chatangobot.core.stats import CountMinSketch, HyperLogLog, RingCounter,\
+        RoomStats, DAY
+
+
+def test_ring_counter_window():
+    counter = RingCounter(60, 60)
+    for second in range(120):
+        counter.add(second)
+    assert counter.total(119) == 60
+    assert counter.total(150) == 29
+    assert counter.total(1000) == 0
+    # too old for the window
+    counter.add(900)
+    assert counter.total(1000) == 0
+
+
+def test_hyperloglog_accuracy():
+    for size in (100, 5000, 50000):
+        sketch = HyperLogLog()
+        for index in range(size):
+            sketch.add('user%i' % index)
+            sketch.add('user%i' % (index // 2))
+        # 3 standard errors
+        assert abs(sketch.count() - size) <= size * 0.1
+
+
+def test_hyperloglog_merge():
+    first, second = HyperLogLog(), HyperLogLog()
+    for index in range(2000):
+        (first if index % 2 else second).add('user%i' % index)
+    first.merge(second)
+    assert abs(first.count() - 2000) <= 200
+
+
+def test_count_min_top_and_halve():
+    sketch = CountMinSketch(width=256, depth=4, top_size=3)
+    counts = dict(('heavy%i' % index, 200 - index * 50) for index in range(3))
+    counts.update(('light%i' % index, 5) for index in range(300))
+    items = [item for item, count in counts.items() for _ in range(count)]
+    random.Random(1).shuffle(items)
+    for item in items:
+        sketch.add(item)
+
+    for item, count in counts.items():
+        assert sketch.estimate(item) >= count
+    assert [item for item, _ in sketch.top()] ==\
+            ['heavy0', 'heavy1', 'heavy2']
+
+    estimates = dict(sketch.top())
+    sketch.halve()
+    assert dict(sketch.top()) ==\
+            dict((item, count >> 1) for item, count in estimates.items())
+
+
+def test_peak_usercount():
+    stats = RoomStats()
+    stats.set_usercount(40, 0.0)
+    stats.set_usercount(55, 100.0)
+    stats.set_usercount(40, 200.0)
+    assert stats.peak_usercount(300.0) == 55
+    # unchanged for more than a day
+    assert stats.peak_usercount(2 * DAY) == 40
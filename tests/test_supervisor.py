@@ -0,0 +1,135 @@
+import asyncio
+
+from chatangobot.core.settings import conf
+from chatangobot.supervisor import CMD_JOIN, CMD_MIGRATE, CMD_STOP, HashRing,\
+        Supervisor
+
+ROOMS = ['room%i' % index for index in range(2000)]
+
+
+def _owners(ring):
+    return dict((room_name, ring.get(room_name)) for room_name in ROOMS)
+
+
+def test_rooms_are_spread():
+    counts = {}
+    for owner in _owners(HashRing(range(4))).values():
+        counts[owner] = counts.get(owner, 0) + 1
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert all(300 <= count <= 700 for count in counts.values())
+
+
+def test_adding_a_node_moves_rooms_only_to_it():
+    ring = HashRing(range(4))
+    before = _owners(ring)
+    ring.add(4)
+    after = _owners(ring)
+
+    moved = [name for name in ROOMS if before[name] != after[name]]
+    assert all(after[name] == 4 for name in moved)
+    assert 0.1 * len(ROOMS) <= len(moved) <= 0.3 * len(ROOMS)
+
+
+def test_removing_a_node_moves_only_its_rooms():
+    ring = HashRing(range(4))
+    before = _owners(ring)
+    ring.remove(2)
+    after = _owners(ring)
+
+    for name in ROOMS:
+        if before[name] == 2:
+            assert after[name] != 2
+        else:
+            assert after[name] == before[name]
+
+    # and adding it back restores the assignment
+    ring.add(2)
+    assert _owners(ring) == before
+
+
+def test_empty_ring():
+    assert HashRing().get('room') is None
+
+
+class FakeProcess(object):
+    """A worker process, which stops on CMD_STOP unless it hangs."""
+
+    def __init__(self, hangs=False):
+        self.hangs = hangs
+        self.running = True
+        self.joined = False
+        self.terminated = False
+        self.pid = 1
+        self.exitcode = None
+
+
+    def is_alive(self):
+        return self.running
+
+
+    def terminate(self):
+        self.terminated = True
+        self.running = False
+
+
+    def join(self):
+        assert not self.running
+        self.joined = True
+
+
+class FakeConn(object):
+
+    def __init__(self, process):
+        self.process = process
+        self.sent = []
+
+
+    def send(self, command):
+        self.sent.append(command)
+        if command == (CMD_STOP,) and not self.process.hangs:
+            self.process.running = False
+
+
+def _supervisor(loop, hanging):
+    supervisor = Supervisor(loop, workers=3)
+    for handle in supervisor.workers:
+        handle.process = FakeProcess(hangs=handle.index == hanging)
+        handle.conn = FakeConn(handle.process)
+        handle.started_at = loop.time()
+    supervisor.set_rooms(ROOMS[:100])
+    supervisor._watch = asyncio.ensure_future(supervisor._watch_workers())
+    return supervisor
+
+
+def test_removed_workers_are_joined_or_terminated(loop):
+    supervisor = _supervisor(loop, hanging=2)
+    removed = supervisor.workers[1:]
+    supervisor.set_worker_count(1)
+    assert all(handle.conn.sent[-1] == (CMD_STOP,) for handle in removed)
+    assert sorted(supervisor.workers[0].rooms) == sorted(ROOMS[:100])
+    assert len(supervisor.workers[0].conn.sent) == 100
+
+    loop.run_until_complete(asyncio.sleep(2))
+    assert supervisor._retired == [removed[1]]
+    assert removed[0].process.joined
+    loop.run_until_complete(asyncio.sleep(supervisor.stop_timeout))
+    assert supervisor._retired == []
+    assert removed[1].process.terminated and removed[1].process.joined
+    supervisor._watch.cancel()
+
+
+def test_removed_workers_are_stopped_after_migrating(loop, monkeypatch):
+    monkeypatch.setitem(conf['bus'], 'enabled', True)
+    supervisor = _supervisor(loop, hanging=None)
+    removed = supervisor.workers[1:]
+    supervisor.set_worker_count(1)
+    sent = supervisor.workers[0].conn.sent
+    assert set(command for command, _ in sent) == {CMD_JOIN, CMD_MIGRATE}
+
+    loop.run_until_complete(asyncio.sleep(supervisor.migrate_timeout - 5))
+    assert all(handle.alive for handle in removed)
+    loop.run_until_complete(asyncio.sleep(10))
+    assert supervisor._retired == []
+    assert all(handle.process.joined and not handle.process.terminated\
+            for handle in removed)
+    supervisor._watch.cancel()
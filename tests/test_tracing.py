@@ -0,0 +1,25 @@
+import json
+
+from chatangobot.core.tracing import Trace, Tracer
+
+
+def _spans(tracer, count):
+    trace = Trace(1, 'room', 0.0)
+    for index in range(count):
+        tracer.span(trace, 'handler', index, index + 0.5)
+
+
+def test_closed_trace_is_valid_json(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    tracer = Tracer(path)
+    _spans(tracer, 3)
+    tracer.close()
+    events = json.load(open(path))
+    assert [event['ph'] for event in events] == ['X', 'X', 'X', 'M']
+
+    # a later run continues the array
+    tracer = Tracer(path)
+    _spans(tracer, 2)
+    tracer.close()
+    events = json.load(open(path))
+    assert [event['ph'] for event in events].count('X') == 5
@@ -0,0 +1,59 @@
+import itertools
+import random
+import re
+
+from chatangobot.core.wordfilter import WordFilter, normalize
+from chatangobot.utils import create_word_regex
+
+
+def _regex_words(words, text):
+    # the regexes on the normalised text, whitespace runs become one space
+    text = normalize(text)[0]
+    return set(word for word in words\
+            if create_word_regex(re.escape(word)).search(text))
+
+
+def test_same_words_as_the_regexes():
+    alphabet = 'ab .?'
+    words = sorted(set(''.join(chars).strip(' .?')\
+            for size in range(1, 4)\
+            for chars in itertools.product('ab ', repeat=size)) - {''})
+    wordfilter = WordFilter(words)
+    rand = random.Random(4)
+    for _ in range(500):
+        text = ''.join(rand.choice(alphabet)\
+                for _ in range(rand.randint(0, 12)))
+        found = set(match.pattern for match in wordfilter.finditer(text))
+        assert found == _regex_words(words, text), text
+
+
+def test_matches_index_the_original_text():
+    wordfilter = WordFilter(['bad word'])
+    text = 'a ＢＡＤ​  wοrd!'
+    match = wordfilter.search(text)
+    assert match.pattern == 'bad word'
+    assert text[match.start:match.end] == 'ＢＡＤ​  wοrd'
+
+
+def test_normalize():
+    assert normalize('Ѕ́ру  ΤΕΧΤ')[0] == 'spy text'
+    assert 'cаt' in WordFilter(['cat'])
+    assert 'concatenate' not in WordFilter(['cat'])
+
+
+def test_hair_space_is_a_boundary():
+    wordfilter = WordFilter(['bar'])
+    for text in ('foo\u200abar', 'bar\u200a!', '\u200abar'):
+        assert create_word_regex('bar').search(text)
+        assert wordfilter.search(text).pattern == 'bar'
+    # zero width characters are removed
+    assert 'b\u200bar' in wordfilter
+    assert 'foo\u200bbar' not in wordfilter
+
+
+def test_reload(tmpdir):
+    path = tmpdir.join('words.txt')
+    path.write('spam # comment\n\n')
+    wordfilter = WordFilter(path=str(path))
+    assert wordfilter.patterns == ('spam',)
+    assert not wordfilter.reload()